@@ -0,0 +1,262 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Event loop driven Tvheadend HTSP sessions, built on asyncore"""
+
+import asyncore
+import logging
+import socket
+import time
+
+from tvh import htsmsg
+
+from htsp_session import HTSP_PROTO_VERSION, HTSPFuture, HTSPHello, HTSPResponse, HTSPSession
+
+_logger = logging.getLogger(__name__)
+
+
+class _HTSPDispatcher(asyncore.dispatcher):
+	"""asyncore channel carrying the htsp connection of an AsyncHTSPSession"""
+
+	def __init__(self,session,addr,map):
+		asyncore.dispatcher.__init__(self,map=map)
+		self._session=session
+		self._out=bytearray()
+		self.create_socket(socket.AF_INET,socket.SOCK_STREAM)
+		self._reader=htsmsg.HTSMSGStreamReader(self.socket,lazy=session._lazy)
+		self.connect(addr)
+
+	def queue(self,data):
+		self._out.extend(data)
+
+	def writable(self):
+		return not self.connected or len(self._out)>0
+
+	def handle_connect(self):
+		pass
+
+	def handle_write(self):
+		sent=self.send(self._out)
+		del self._out[:sent]
+
+	def handle_read(self):
+		try:
+			self._reader.fill()
+		except StopIteration:
+			self.handle_close()
+			return
+
+		while self._reader.pending():
+			self._session._dispatch(self._reader.next())
+
+	def handle_close(self):
+		self.close()
+		self._session._connection_lost(Exception('Connection closed'))
+
+	def handle_error(self):
+		_logger.exception('htsp connection failed')
+		self.close()
+		self._session._connection_lost(Exception('Connection failed'))
+
+
+class AsyncHTSPSession(HTSPSession):
+	"""HTSPSession driven by an asyncore event loop
+
+	Commands return HTSPFuture instances rather than blocking and notifications are
+	handled as they arrive, so any number of sessions can share one asyncore.loop().
+	Blocking calls (e.g. HTSPFuture.result, HTSPChannel.now) still work, by running
+	the loop until the reply arrives. The blocking properties (e.g. channels, recorded,
+	HTSPChannel.events) run it until the initial sync has completed too, rather than
+	return the part of the metadata received so far."""
+
+	def __init__ (self, host='localhost',port=9982, addr=None,name = 'python-htsp', lazy=False, map=None, event_cache_size=1024, event_cache_ttl=300, journal_size=4096 ):
+		HTSPSession.__init__(self,host,port,addr,name,lazy,event_cache_size=event_cache_size,event_cache_ttl=event_cache_ttl,journal_size=journal_size)
+		self._map=map
+		self._sync_future=None
+		self._dispatching=False
+
+	def hello(self):
+		"""Issue an htsp 'hello' command to the server, returning an HTSPFuture for the HTSPHello response"""
+		if not self._sock:
+			self._sock=_HTSPDispatcher(self,self._addr,self._map)
+
+		def hello(message):
+			self._hello=HTSPHello(self,message)
+			return self._hello
+
+		return self.send_command('hello', {
+			'htspversion' : HTSP_PROTO_VERSION,
+			'clientname'  : self._name
+		}).then(hello)
+
+	def authenticate(self, user, password = None):
+		"""Issue an htsp 'authenticate' command to the server, returning an HTSPFuture"""
+
+		def authenticate(hello):
+			self._user = user
+			self._password = password
+			if password:
+				self._digest = HTSPSession._htsp_digest(user, password, hello.challenge)
+			return self.send_command('authenticate').then(authenticated)
+
+		def authenticated(message):
+			response=HTSPResponse(self,message)
+			if response.access_denied:
+				raise Exception('Authentication failed')
+			return response
+
+		return self._after_hello(authenticate)
+
+	def fetch_initial_data(self,events=False,epg_window=None,columnar=False):
+		"""Issue an htsp 'enableAsyncMetadata' command to the server, returning an HTSPFuture completed by 'initialSyncCompleted'"""
+
+		if self._sync_future:
+			return self._sync_future
+
+		self._reset_events(events,columnar)
+		self._sync_future=HTSPFuture(self)
+
+		def enable(hello):
+			self._enable_async_metadata(events,epg_window)
+
+		self._after_hello(enable).add_done_callback(self._sync_failed)
+		return self._sync_future
+
+	def add_dvr_entry(self,entry):
+		"""Create a new DVR entry, wraps HTSP addDvrEntry, returning an HTSPFuture for the HTSPDVREntry"""
+
+		def added(message):
+			HTSPSession._check_response(message)
+			return self._dvr_entries[message["id"]]
+
+		return self.send_command('addDvrEntry',entry._as_add_dvr_entry_command()).then(added)
+
+	def cancel_dvr_entry(self,entry):
+		"""Cancels a DVR entry, wraps HTSP cancelDvrEntry, returning an HTSPFuture for the HTSPDVREntry"""
+
+		def cancelled(message):
+			HTSPSession._check_response(message)
+			return entry
+
+		return self.send_command('cancelDvrEntry',entry._as_cancel_dvr_entry_command()).then(cancelled)
+
+	def monitor(self,callback):
+		"""Call callback(method,notification) for each notification received once the initial data is in"""
+
+		if not self._initial_data:
+			self.fetch_initial_data()
+
+		self._callbacks.append(callback)
+
+	def _after_hello(self,fn):
+		if self._hello:
+			future=HTSPFuture(self)
+			future._set_result(self._hello)
+		else:
+			future=self.hello()
+		return future.then(fn)
+
+	def _ensure_initial_data(self):
+		"""Start the initial sync unless it has been and run the loop until it completes"""
+		if not self._initial_data:
+			self.fetch_initial_data().result()
+
+	def _wait_for_sync(self):
+		"""Run the loop until a pending initial sync completes
+
+		Reads made while a message is handled (e.g. by a future's callback) are not held up"""
+		if self._sync_future and not self._sync_future.done() and not self._dispatching:
+			self._sync_future.result()
+
+	def _get_channel(self,channel_id):
+		self._wait_for_sync()
+		return HTSPSession._get_channel(self,channel_id)
+
+	def _get_event(self,event_id):
+		self._wait_for_sync()
+		return HTSPSession._get_event(self,event_id)
+
+	def _get_events(self,channel_id):
+		self._wait_for_sync()
+		return HTSPSession._get_events(self,channel_id)
+
+	def _sync_failed(self,future):
+		if future.exception() and self._sync_future and not self._sync_future.done():
+			self._sync_future._set_exception(future.exception())
+
+	def _check_connection(self):
+		if not self._hello:
+			self._connect().result()
+
+	def _enable_async_metadata(self,events,epg_window=None):
+		_logger.info('Fetching initial data')
+		args={
+			'epg':1 if events else 0
+			}
+		if events and epg_window:
+			args['epgMaxTime']=int(time.time())+epg_window
+		self.send_command('enableAsyncMetadata',args)
+
+	def _connect(self):
+		"""Say hello on a new connection, authenticating again if the session had, returning an HTSPFuture"""
+		if self._user:
+			return self.authenticate(self._user,self._password)
+		return self.hello()
+
+	def _invoke_command(self,method,args={}):
+		if not self._sock:
+			self._connect().result()
+		return HTSPSession._invoke_command(self,method,args)
+
+	def _send(self, method, args = {}):
+		args['method'] = method
+		if self._user:
+			args['username'] = self._user
+		if self._digest:
+			args['digest']   = htsmsg.hmf_bin(self._digest)
+		self._sock.queue(htsmsg.encode(args))
+
+	def _pump(self):
+		if not self._sock:
+			raise Exception('Not connected')
+		asyncore.loop(timeout=1.0,count=1,map=self._map)
+
+	def _dispatch(self,message):
+		dispatching,self._dispatching=self._dispatching,True
+		try:
+			HTSPSession._dispatch(self,message)
+			self._process_notifications(notify=self._initial_data)
+		finally:
+			self._dispatching=dispatching
+
+	def _process_notifications(self,notify=True):
+		dispatching,self._dispatching=self._dispatching,True
+		try:
+			HTSPSession._process_notifications(self,notify)
+		finally:
+			self._dispatching=dispatching
+
+	def _handle_initialSyncCompleted(self,message):
+		HTSPSession._handle_initialSyncCompleted(self,message)
+		if self._sync_future and not self._sync_future.done():
+			self._sync_future._set_result(self)
+
+	def _connection_lost(self,exception):
+		HTSPSession._connection_lost(self,exception)
+		if self._sync_future and not self._sync_future.done():
+			self._sync_future._set_exception(exception)
+		self._sync_future=None
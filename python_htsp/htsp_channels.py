@@ -0,0 +1,81 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Indexes over the tags and channels held by an HTSPSession"""
+
+
+class TagIndex(object):
+	"""Two way index of which channels are mapped to which tags
+
+	Both sides describe the mapping: a channel lists its tags and a tag its members.
+	A channel is taken to be mapped to a tag if either says so, each link counting the
+	sides that declare it."""
+
+	def __init__(self):
+		self._channel_side={}		# channel id -> tag ids listed by the channel
+		self._tag_side={}			# tag id -> channel ids listed by the tag
+		self._tag_channels={}		# tag id -> {channel id: sides}
+		self._channel_tags={}		# channel id -> {tag id: sides}
+
+	def channels(self,tag_id):
+		"""The ids of the channels mapped to the tag"""
+		return self._tag_channels.get(tag_id,{}).keys()
+
+	def tags(self,channel_id):
+		"""The ids of the tags the channel is mapped to"""
+		return self._channel_tags.get(channel_id,{}).keys()
+
+	def set_channel_tags(self,channel_id,tag_ids):
+		"""Set the tags listed by a channel"""
+		(old,new)=(self._channel_side.pop(channel_id,frozenset()),frozenset(tag_ids))
+		if new:
+			self._channel_side[channel_id]=new
+		for tag_id in old-new:
+			self._link(tag_id,channel_id,-1)
+		for tag_id in new-old:
+			self._link(tag_id,channel_id,1)
+
+	def set_tag_members(self,tag_id,channel_ids):
+		"""Set the channels listed as members by a tag"""
+		(old,new)=(self._tag_side.pop(tag_id,frozenset()),frozenset(channel_ids))
+		if new:
+			self._tag_side[tag_id]=new
+		for channel_id in old-new:
+			self._link(tag_id,channel_id,-1)
+		for channel_id in new-old:
+			self._link(tag_id,channel_id,1)
+
+	def remove_channel(self,channel_id):
+		self.set_channel_tags(channel_id,())
+
+	def remove_tag(self,tag_id):
+		self.set_tag_members(tag_id,())
+
+	def _link(self,tag_id,channel_id,delta):
+		channels=self._tag_channels.setdefault(tag_id,{})
+		tags=self._channel_tags.setdefault(channel_id,{})
+		sides=channels.get(channel_id,0)+delta
+		if sides:
+			channels[channel_id]=tags[tag_id]=sides
+		else:
+			del channels[channel_id]
+			del tags[tag_id]
+			if not channels:
+				del self._tag_channels[tag_id]
+			if not tags:
+				del self._channel_tags[channel_id]
@@ -0,0 +1,671 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Indexes over the DVR entries held by an HTSPSession"""
+
+import logging
+import random
+import re
+import sre_constants
+import sre_parse
+import time
+
+from htsp_epg import EPGIndex
+
+_logger = logging.getLogger(__name__)
+
+
+class DVRIndex(object):
+	"""Index of DVR entry ids by state bucket, each sorted by start time
+
+	The buckets are those of the HTSPSession properties: 'recorded' (completed),
+	'scheduled' (scheduled or recording) and 'failed' (missed), other states each
+	have a bucket of their own. All the entries are also indexed together for
+	queries by time."""
+
+	_BUCKETS={
+		'completed'	: 'recorded',
+		'scheduled'	: 'scheduled',
+		'recording'	: 'scheduled',
+		'missed'	: 'failed',
+		}
+
+	def __init__(self):
+		# EPGIndex keeps (start, id) keys sorted per key, here per bucket rather than per channel
+		self._buckets=EPGIndex()
+		self._all=EPGIndex()
+
+	def __len__(self):
+		return len(self._all)
+
+	def add(self,entry_id,state,start,stop):
+		"""Index (or re-index) an entry"""
+		self._buckets.add(entry_id,DVRIndex._BUCKETS.get(state,state),start,stop)
+		self._all.add(entry_id,None,start,stop)
+
+	def remove(self,entry_id):
+		"""Remove an entry from the index"""
+		self._buckets.remove(entry_id)
+		self._all.remove(entry_id)
+
+	def bucket(self,bucket):
+		"""The ids of the entries in bucket, in start order"""
+		return self._buckets.events(bucket)
+
+	def between(self,start,stop):
+		"""The ids of the entries overlapping [start, stop), in start order"""
+		return self._all.events_between(None,start,stop)
+
+
+class DVRLinks(object):
+	"""Two way index of which DVR entries record which events
+
+	Both sides describe the link: a DVR entry gives its eventId and an event its dvrId,
+	an entry and an event are taken to be linked if either says so."""
+
+	def __init__(self):
+		self._entry_event={}		# dvr entry id -> event id, from the entry
+		self._event_entries={}		# event id -> set of dvr entry ids, from the entries
+		self._event_entry={}		# event id -> dvr entry id, from the event
+		self._entry_events={}		# dvr entry id -> set of event ids, from the events
+
+	def entries(self,event_id):
+		"""The ids of the dvr entries linked to an event"""
+		entries=set(self._event_entries.get(event_id,()))
+		if event_id in self._event_entry:
+			entries.add(self._event_entry[event_id])
+		return entries
+
+	def events(self,entry_id):
+		"""The ids of the events linked to a dvr entry"""
+		events=set(self._entry_events.get(entry_id,()))
+		if entry_id in self._entry_event:
+			events.add(self._entry_event[entry_id])
+		return events
+
+	def set_entry_event(self,entry_id,event_id):
+		"""Set (or with None clear) the event a dvr entry gives"""
+		DVRLinks._set(self._entry_event,self._event_entries,entry_id,event_id)
+
+	def set_event_entry(self,event_id,entry_id):
+		"""Set (or with None clear) the dvr entry an event gives"""
+		DVRLinks._set(self._event_entry,self._entry_events,event_id,entry_id)
+
+	def clear_events(self):
+		"""Forget the links given by events (e.g. when the EPG is collected again)"""
+		self._event_entry={}
+		self._entry_events={}
+
+	@staticmethod
+	def _set(forward,reverse,key,value):
+		old=forward.pop(key,None)
+		if old is not None:
+			keys=reverse[old]
+			keys.discard(key)
+			if not keys:
+				del reverse[old]
+		if value:
+			forward[key]=value
+			reverse.setdefault(value,set()).add(key)
+
+
+class _Node(object):
+
+	__slots__=('key','start','stop','value','priority','max_stop','left','right')
+
+	def __init__(self,key,start,stop,value):
+		self.key=key
+		self.start=start
+		self.stop=stop
+		self.value=value
+		self.priority=random.random()
+		self.max_stop=stop
+		self.left=None
+		self.right=None
+
+
+class IntervalTree(object):
+	"""Set of keyed [start, stop) intervals supporting overlap queries in O(log n + matches)
+
+	A treap ordered by (start, key), each node also holding the latest stop in its
+	subtree, so subtrees ending before a query are skipped."""
+
+	def __init__(self):
+		self._root=None
+		self._nodes={}		# key -> node
+
+	def __len__(self):
+		return len(self._nodes)
+
+	def __contains__(self,key):
+		return key in self._nodes
+
+	def add(self,key,start,stop,value=None):
+		"""Add (or move) the interval of key"""
+		node=self._nodes.get(key,None)
+		if node is not None:
+			if node.start==start and node.stop==stop:
+				node.value=value
+				return
+			self.remove(key)
+
+		node=self._nodes[key]=_Node(key,start,stop,value)
+		self._root=IntervalTree._insert(self._root,node)
+
+	def remove(self,key):
+		"""Remove the interval of key"""
+		node=self._nodes.pop(key,None)
+		if node is not None:
+			self._root=IntervalTree._delete(self._root,node)
+
+	def overlapping(self,start,stop):
+		"""The (key, start, stop, value) of the intervals overlapping [start, stop), in start order"""
+		result=[]
+		IntervalTree._query(self._root,start,stop,result)
+		return result
+
+	@staticmethod
+	def _update(node):
+		node.max_stop=max(node.stop,
+			node.left.max_stop if node.left else node.stop,
+			node.right.max_stop if node.right else node.stop)
+
+	@staticmethod
+	def _insert(root,node):
+		if root is None:
+			return node
+		if (node.start,node.key)<(root.start,root.key):
+			root.left=IntervalTree._insert(root.left,node)
+			if root.left.priority>root.priority:
+				(pivot,root.left)=(root.left,root.left.right)
+				pivot.right=root
+				IntervalTree._update(root)
+				root=pivot
+		else:
+			root.right=IntervalTree._insert(root.right,node)
+			if root.right.priority>root.priority:
+				(pivot,root.right)=(root.right,root.right.left)
+				pivot.left=root
+				IntervalTree._update(root)
+				root=pivot
+		IntervalTree._update(root)
+		return root
+
+	@staticmethod
+	def _delete(root,node):
+		if root is node:
+			return IntervalTree._merge(root.left,root.right)
+		if (node.start,node.key)<(root.start,root.key):
+			root.left=IntervalTree._delete(root.left,node)
+		else:
+			root.right=IntervalTree._delete(root.right,node)
+		IntervalTree._update(root)
+		return root
+
+	@staticmethod
+	def _merge(left,right):
+		if left is None:
+			return right
+		if right is None:
+			return left
+		if left.priority>right.priority:
+			left.right=IntervalTree._merge(left.right,right)
+			IntervalTree._update(left)
+			return left
+		right.left=IntervalTree._merge(left,right.left)
+		IntervalTree._update(right)
+		return right
+
+	@staticmethod
+	def _query(node,start,stop,result):
+		if node is None or node.max_stop<=start:
+			return
+		IntervalTree._query(node.left,start,stop,result)
+		if node.start<stop:
+			if node.stop>start:
+				result.append((node.key,node.start,node.stop,node.value))
+			IntervalTree._query(node.right,start,stop,result)
+
+
+class DVRConflicts(object):
+	"""Tuner usage of the scheduled DVR entries, to find the recordings a new one conflicts with
+
+	Entries are held in an IntervalTree by their padded (start - start extra, stop + stop
+	extra) times. Recordings on the same mux share a tuner, so the tuners in use at any
+	time are the number of distinct muxes being recorded."""
+
+	def __init__(self):
+		self._tree=IntervalTree()
+
+	def __len__(self):
+		return len(self._tree)
+
+	def add(self,entry_id,start,stop,mux):
+		"""Add (or update) a scheduled entry, start and stop including any padding"""
+		self._tree.add(entry_id,start,stop,mux)
+
+	def remove(self,entry_id):
+		"""Remove an entry, e.g. once it is no longer scheduled"""
+		self._tree.remove(entry_id)
+
+	def conflicts(self,start,stop,mux,tuners,exclude=None):
+		"""The ids of the entries a recording of mux from start to stop conflicts with given tuners
+
+		i.e. those recording at some time when the new recording would need more than tuners
+		tuners, in start order. exclude is an entry id to leave out (e.g. the entry itself)."""
+		entries=[entry for entry in self._tree.overlapping(start,stop) if entry[0]!=exclude]
+
+		# sweep the boundaries within [start, stop), counting the entries recording each mux
+		boundaries=[]
+		for (entry_id,entry_start,entry_stop,entry_mux) in entries:
+			boundaries.append((max(entry_start,start),1,entry_mux))
+			boundaries.append((min(entry_stop,stop),-1,entry_mux))
+		boundaries.sort()
+
+		recording={}
+		conflicted=[]
+		i=0
+		while i<len(boundaries):
+			t=boundaries[i][0]
+			while i<len(boundaries) and boundaries[i][0]==t:
+				(t,delta,entry_mux)=boundaries[i]
+				recording[entry_mux]=recording.get(entry_mux,0)+delta
+				if not recording[entry_mux]:
+					del recording[entry_mux]
+				i+=1
+			if i<len(boundaries) and len(recording)+(0 if mux in recording else 1)>tuners:
+				conflicted.append((t,boundaries[i][0]))
+
+		if not conflicted:
+			return []
+		return [entry_id for (entry_id,entry_start,entry_stop,entry_mux) in entries
+			if any(entry_start<until and entry_stop>since for (since,until) in conflicted)]
+
+
+class KeyIndex(object):
+	"""Index of ids by any number of keys per id"""
+
+	def __init__(self):
+		self._ids={}		# key -> set of ids
+		self._keys={}		# id -> frozenset of keys
+
+	def __len__(self):
+		return len(self._keys)
+
+	def add(self,item_id,keys):
+		"""Index (or re-index) an id under keys"""
+		(old,new)=(self._keys.pop(item_id,frozenset()),frozenset(keys))
+		if new:
+			self._keys[item_id]=new
+		for key in old-new:
+			ids=self._ids[key]
+			ids.discard(item_id)
+			if not ids:
+				del self._ids[key]
+		for key in new-old:
+			self._ids.setdefault(key,set()).add(item_id)
+
+	def remove(self,item_id):
+		self.add(item_id,())
+
+	def keys(self,item_id):
+		"""The keys an id is indexed under"""
+		return self._keys.get(item_id,frozenset())
+
+	def find(self,keys):
+		"""The set of ids indexed under any of keys"""
+		result=set()
+		for key in keys:
+			result.update(self._ids.get(key,()))
+		return result
+
+
+class EpisodeIndex(object):
+	"""Index of events and DVR entries by the episode and the series they are of
+
+	An episode is identified by its episode uri or id, or by its title together with its
+	on screen episode number, a series by its series link uri or id; anything sharing one
+	of these keys is taken to be the same episode (series). A DVR entry is indexed under
+	its own keys and those of its event, and keeps them after the event has left the EPG."""
+
+	def __init__(self):
+		self.event_episodes=KeyIndex()
+		self.event_series=KeyIndex()
+		self.dvr_episodes=KeyIndex()
+		self.dvr_series=KeyIndex()
+		self._dvr_own={}		# dvr entry id -> (episode keys, series keys) of the entry itself
+		self._dvr_from_event={}	# dvr entry id -> (episode keys, series keys) of its event, when last seen
+		self._dvr_event={}		# dvr entry id -> event id
+		self._event_dvr={}		# event id -> set of dvr entry ids
+
+	def add_event(self,event_id,message):
+		self.event_episodes.add(event_id,EpisodeIndex.episode_keys(message))
+		self.event_series.add(event_id,EpisodeIndex.series_keys(message))
+		for entry_id in self._event_dvr.get(event_id,()):
+			self._index_dvr_entry(entry_id)
+
+	def remove_event(self,event_id):
+		self.event_episodes.remove(event_id)
+		self.event_series.remove(event_id)
+
+	def clear_events(self):
+		"""Forget every event (e.g. when the EPG is collected again), keeping the DVR entries' keys"""
+		self.event_episodes=KeyIndex()
+		self.event_series=KeyIndex()
+
+	def add_dvr_entry(self,entry_id,message):
+		event_id=message.get('eventId',None) or None
+		if self._dvr_event.get(entry_id,None)!=event_id:
+			self._unlink(entry_id)
+			if event_id is not None:
+				self._dvr_event[entry_id]=event_id
+				self._event_dvr.setdefault(event_id,set()).add(entry_id)
+		self._dvr_own[entry_id]=(EpisodeIndex.episode_keys(message),EpisodeIndex.series_keys(message))
+		self._index_dvr_entry(entry_id)
+
+	def remove_dvr_entry(self,entry_id):
+		self._unlink(entry_id)
+		self._dvr_own.pop(entry_id,None)
+		self.dvr_episodes.remove(entry_id)
+		self.dvr_series.remove(entry_id)
+
+	def unresolved(self):
+		"""The (dvr entry id, event id) of the entries whose event has not been seen"""
+		return [(entry_id,event_id) for (entry_id,event_id) in self._dvr_event.items() if not entry_id in self._dvr_from_event]
+
+	def resolve(self,entry_id,message):
+		"""Index a dvr entry under the keys of its event, from the event's message (None if there is no such event)"""
+		if entry_id in self._dvr_own:
+			self._dvr_from_event[entry_id]=(EpisodeIndex.episode_keys(message),EpisodeIndex.series_keys(message)) if message else ((),())
+			self._index_dvr_entry(entry_id)
+
+	def _index_dvr_entry(self,entry_id):
+		event_id=self._dvr_event.get(entry_id,None)
+		if event_id is not None and (self.event_episodes.keys(event_id) or self.event_series.keys(event_id)):
+			self._dvr_from_event[entry_id]=(self.event_episodes.keys(event_id),self.event_series.keys(event_id))
+
+		# the keys of an event that has left the EPG are those from when it was last seen
+		(episodes,series)=self._dvr_own[entry_id]
+		(event_episodes,event_series)=self._dvr_from_event.get(entry_id,((),()))
+		self.dvr_episodes.add(entry_id,frozenset(episodes).union(event_episodes))
+		self.dvr_series.add(entry_id,frozenset(series).union(event_series))
+
+	def _unlink(self,entry_id):
+		self._dvr_from_event.pop(entry_id,None)
+		event_id=self._dvr_event.pop(entry_id,None)
+		if event_id is not None:
+			entries=self._event_dvr[event_id]
+			entries.discard(entry_id)
+			if not entries:
+				del self._event_dvr[event_id]
+
+	@staticmethod
+	def episode_keys(message):
+		"""The keys identifying the episode of an event or DVR entry message"""
+		keys=[]
+		if message.get('episodeUri',None):
+			keys.append(('uri',message['episodeUri']))
+		if message.get('episodeId',None):
+			keys.append(('id',message['episodeId']))
+		title=message.get('title',None)
+		onscreen=message.get('episodeOnscreen',None) or message.get('episode',None)
+		if title and onscreen:
+			keys.append(('title',title.lower(),onscreen))
+		return keys
+
+	@staticmethod
+	def series_keys(message):
+		"""The keys identifying the series of an event or DVR entry message"""
+		keys=[]
+		if message.get('serieslinkUri',None):
+			keys.append(('uri',message['serieslinkUri']))
+		if message.get('serieslinkId',None):
+			keys.append(('id',message['serieslinkId']))
+		return keys
+
+
+class AutorecRule(object):
+	"""An autorec entry message compiled to the tests tvheadend applies to an event
+
+	The title is a case insensitive regex searched for in the event title, the other
+	criteria are integer tests: channel, days of week and start time window (both in
+	local time) from 'start'/'startWindow' or within 15 minutes of 'approxTime',
+	duration and content type."""
+
+	def __init__(self,message):
+		self.enabled=bool(message.get('enabled',1))
+		self.title=message.get('title',None) or None
+		self.pattern=None
+		self.literal=''
+		if self.title:
+			try:
+				self.pattern=re.compile(self.title,re.IGNORECASE)
+			except re.error as e:
+				_logger.warning('Autorec title %r is not a valid regex, matching it as text: %s',self.title,e)
+				self.pattern=re.compile(re.escape(self.title),re.IGNORECASE)
+			self.literal=AutorecRule._required_literal(self.pattern.pattern)
+
+		self.channel=message.get('channel',None) or None
+		days=message.get('daysOfWeek',0)&0x7f
+		self.days=days if days and days!=0x7f else None
+
+		(start,window)=(message.get('start',-1),message.get('startWindow',-1))
+		approx=message.get('approxTime',0)
+		if start>=0 and window>=0:
+			self.window=(start,window)
+		elif 0<approx<=24*60:
+			self.window=((approx-15)%(24*60),(approx+15)%(24*60))
+		else:
+			self.window=None
+
+		self.min_duration=message.get('minDuration',0) or None
+		self.max_duration=message.get('maxDuration',0) or None
+		self.content_type=message.get('contentType',0) or None
+
+	def matches_title(self,title):
+		return self.pattern is None or self.pattern.search(title) is not None
+
+	def test(self,channel_id,start,stop,content_type):
+		"""True if the rule is enabled and an event with a matching title passes the other criteria"""
+		if not self.enabled:
+			return False
+		if self.channel is not None and channel_id!=self.channel:
+			return False
+		if self.min_duration is not None and stop-start<self.min_duration:
+			return False
+		if self.max_duration is not None and stop-start>self.max_duration:
+			return False
+		if self.content_type is not None:
+			if content_type is None:
+				return False
+			if self.content_type&0x0f and content_type!=self.content_type:
+				return False
+			if content_type&0xf0!=self.content_type&0xf0:
+				return False
+		if self.days is not None or self.window is not None:
+			local=time.localtime(start)
+			if self.days is not None and not self.days&(1<<local.tm_wday):
+				return False
+			if self.window is not None:
+				(lo,hi)=self.window
+				minute=local.tm_hour*60+local.tm_min
+				if not (lo<=minute<=hi if lo<=hi else minute>=lo or minute<=hi):
+					return False
+		return True
+
+	@staticmethod
+	def _required_literal(pattern):
+		"""The longest text every match of pattern contains (lower case), '' if there is none"""
+		runs=[]
+		run=[]
+		try:
+			for (op,av) in sre_parse.parse(pattern,re.IGNORECASE):
+				if op==sre_constants.LITERAL:
+					run.append(unichr(av) if isinstance(pattern,unicode) else chr(av))
+				else:
+					runs.append(''.join(run))
+					run=[]
+		except Exception:
+			return ''
+		runs.append(''.join(run))
+		return max(runs,key=len).lower()
+
+
+class AutorecEngine(object):
+	"""Predicts the events in the EPG that the autorec entries will record
+
+	Each autorec entry is compiled once to an AutorecRule. Title patterns are matched
+	against the distinct event titles rather than each event, the candidate titles
+	for a pattern coming from a trigram index over the text its matches must contain,
+	which leaves integer tests for the events with a matching title. Titles new to
+	the EPG and changed autorec titles are matched when the engine is next queried."""
+
+	def __init__(self):
+		self._rules={}			# autorec id -> AutorecRule
+		self._events={}			# event id -> (title key, channel id, start, stop, content type)
+		self._titles={}			# title key -> set of event ids
+		self._trigrams={}		# trigram -> set of title keys
+		self._rule_titles={}	# autorec id -> set of matching title keys
+		self._title_rules={}	# title key -> set of matching autorec ids
+		self._dirty_rules=set()
+		self._new_titles=set()
+
+	def __len__(self):
+		return len(self._rules)
+
+	def add_rule(self,rule_id,message):
+		"""Compile (or recompile) an autorec entry, its title is matched again only if it changed"""
+		rule=AutorecRule(message)
+		old=self._rules.get(rule_id,None)
+		self._rules[rule_id]=rule
+		if old is None or old.title!=rule.title:
+			self._unmatch(rule_id)
+			self._dirty_rules.add(rule_id)
+
+	def remove_rule(self,rule_id):
+		self._unmatch(rule_id)
+		self._rules.pop(rule_id,None)
+		self._dirty_rules.discard(rule_id)
+
+	def add_event(self,event_id,message):
+		title=(message.get('title',None) or '').lower()
+		old=self._events.get(event_id,None)
+		if old is not None and old[0]!=title:
+			self.remove_event(event_id)
+		self._events[event_id]=(title,message['channelId'],message['start'],message['stop'],message.get('contentType',None))
+		if not title in self._titles:
+			self._titles[title]=set()
+			for trigram in AutorecEngine._trigrams_of(title):
+				self._trigrams.setdefault(trigram,set()).add(title)
+			self._new_titles.add(title)
+		self._titles[title].add(event_id)
+
+	def remove_event(self,event_id):
+		old=self._events.pop(event_id,None)
+		if old is None:
+			return
+		title=old[0]
+		events=self._titles[title]
+		events.discard(event_id)
+		if events:
+			return
+
+		del self._titles[title]
+		for trigram in AutorecEngine._trigrams_of(title):
+			titles=self._trigrams[trigram]
+			titles.discard(title)
+			if not titles:
+				del self._trigrams[trigram]
+		for rule_id in self._title_rules.pop(title,()):
+			self._rule_titles[rule_id].discard(title)
+		self._new_titles.discard(title)
+
+	def clear_events(self):
+		"""Forget every event (e.g. when the EPG is collected again), keeping the compiled rules"""
+		self._events={}
+		self._titles={}
+		self._trigrams={}
+		self._rule_titles={}
+		self._title_rules={}
+		self._new_titles=set()
+		self._dirty_rules=set(self._rules)
+
+	def matches(self,rule_id):
+		"""The ids of the events an autorec entry matches, in start order"""
+		self._flush()
+		rule=self._rules.get(rule_id,None)
+		if rule is None:
+			return []
+		result=[]
+		for title in self._rule_titles.get(rule_id,()):
+			for event_id in self._titles[title]:
+				(channel_id,start,stop,content_type)=self._events[event_id][1:]
+				if rule.test(channel_id,start,stop,content_type):
+					result.append((start,event_id))
+		result.sort()
+		return [event_id for (start,event_id) in result]
+
+	def rules(self,event_id):
+		"""The ids of the autorec entries matching an event"""
+		self._flush()
+		event=self._events.get(event_id,None)
+		if event is None:
+			return []
+		(title,channel_id,start,stop,content_type)=event
+		return [rule_id for rule_id in self._title_rules.get(title,()) if self._rules[rule_id].test(channel_id,start,stop,content_type)]
+
+	def _unmatch(self,rule_id):
+		for title in self._rule_titles.pop(rule_id,()):
+			rules=self._title_rules[title]
+			rules.discard(rule_id)
+			if not rules:
+				del self._title_rules[title]
+
+	def _flush(self):
+		(dirty,self._dirty_rules)=(self._dirty_rules,set())
+		(new,self._new_titles)=(self._new_titles,set())
+		for rule_id in dirty:
+			self._match(rule_id,None)
+		if new:
+			for rule_id in self._rules:
+				if not rule_id in dirty:
+					self._match(rule_id,new)
+
+	def _match(self,rule_id,titles):
+		"""Match the title of an autorec entry against titles (None for every title)"""
+		rule=self._rules[rule_id]
+		matched=[title for title in self._candidates(rule.literal,titles) if rule.matches_title(title)]
+		if matched:
+			self._rule_titles.setdefault(rule_id,set()).update(matched)
+			for title in matched:
+				self._title_rules.setdefault(title,set()).add(rule_id)
+
+	def _candidates(self,literal,titles):
+		"""The titles (of titles, None for every title) that may contain literal"""
+		if len(literal)<3:
+			return self._titles if titles is None else titles
+		postings=sorted([self._trigrams.get(trigram,()) for trigram in AutorecEngine._trigrams_of(literal)],key=len)
+		result=set(postings[0]) if titles is None else titles.intersection(postings[0])
+		for posting in postings[1:]:
+			if not result:
+				break
+			result.intersection_update(posting)
+		return result
+
+	@staticmethod
+	def _trigrams_of(text):
+		return set(text[i:i+3] for i in xrange(len(text)-2))
@@ -0,0 +1,531 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Indexes over the EPG held by an HTSPSession"""
+
+import array
+import bisect
+import collections
+import re
+import sys
+import threading
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy=None
+
+from tvh import htsmsg
+
+_TOKEN=re.compile(r'\w+',re.UNICODE)
+
+
+def tokenize(text):
+	"""Split text (a utf-8 str or unicode) into case folded words"""
+	if isinstance(text,str):
+		text=text.decode('utf-8','replace')
+	return _TOKEN.findall(text.lower())
+
+
+class EPGIndex(object):
+	"""Per channel index of EPG event ids, sorted by start time
+
+	Each channel holds a sorted list of (start, event id) keys, so range queries are
+	bisections. Events are assumed to be no longer than the longest seen on their
+	channel, which bounds how far back a query has to look for an event still running."""
+
+	def __init__(self):
+		self._keys={}			# channel id -> sorted [(start, event id)]
+		self._entries={}		# event id -> (channel id, start, stop)
+		self._longest={}		# channel id -> longest event duration
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __contains__(self,event_id):
+		return event_id in self._entries
+
+	def add(self,event_id,channel_id,start,stop):
+		"""Index (or re-index) an event"""
+		if event_id in self._entries:
+			if self._entries[event_id]==(channel_id,start,stop):
+				return
+			self.remove(event_id)
+
+		self._entries[event_id]=(channel_id,start,stop)
+		bisect.insort(self._keys.setdefault(channel_id,[]),(start,event_id))
+		if stop-start>self._longest.get(channel_id,0):
+			self._longest[channel_id]=stop-start
+
+	def remove(self,event_id):
+		"""Remove an event from the index"""
+		entry=self._entries.pop(event_id,None)
+		if entry:
+			(channel_id,start,stop)=entry
+			keys=self._keys[channel_id]
+			del keys[bisect.bisect_left(keys,(start,event_id))]
+
+	def has_channel(self,channel_id):
+		"""True if any events on the channel are indexed"""
+		return bool(self._keys.get(channel_id,None))
+
+	def channel(self,event_id):
+		"""The id of the channel of an indexed event"""
+		return self._entries[event_id][0]
+
+	def events(self,channel_id):
+		"""The ids of all the events on a channel, in start order"""
+		return [event_id for (start,event_id) in self._keys.get(channel_id,[])]
+
+	def events_between(self,channel_id,start,stop):
+		"""The ids of the events on a channel overlapping [start, stop), in start order"""
+		keys=self._keys.get(channel_id,None)
+		if not keys:
+			return []
+
+		first=bisect.bisect_left(keys,(start-self._longest[channel_id],))
+		last=bisect.bisect_left(keys,(stop,))
+
+		entries=self._entries
+		return [event_id for (event_start,event_id) in keys[first:last] if entries[event_id][2]>start]
+
+	def event_at(self,channel_id,t):
+		"""The id of the event on a channel running at t, or None"""
+		keys=self._keys.get(channel_id,None)
+		if not keys:
+			return None
+
+		earliest=t-self._longest[channel_id]
+		i=bisect.bisect_right(keys,(t,sys.maxint))
+		while i>0:
+			i-=1
+			(start,event_id)=keys[i]
+			if start<earliest:
+				break
+			if self._entries[event_id][2]>t:
+				return event_id
+		return None
+
+	def next_event(self,channel_id,t):
+		"""The id of the first event on a channel starting at or after t, or None"""
+		keys=self._keys.get(channel_id,None)
+		if not keys:
+			return None
+
+		i=bisect.bisect_left(keys,(t,))
+		return keys[i][1] if i<len(keys) else None
+
+
+class EPGSearchIndex(object):
+	"""Inverted index of the words in the text of EPG events
+
+	The distinct words are also kept sorted, so a prefix matches the run of words
+	found by bisecting for it."""
+
+	def __init__(self):
+		self._postings={}		# word -> set of event ids
+		self._words=[]			# sorted distinct words
+		self._event_words={}	# event id -> frozenset of words
+
+	def __len__(self):
+		return len(self._event_words)
+
+	def add(self,event_id,texts):
+		"""Index (or re-index) the words of texts (strs or None) for an event"""
+		words=frozenset(word for text in texts if text for word in tokenize(text))
+
+		old=self._event_words.get(event_id,frozenset())
+		if words==old:
+			return
+
+		for word in old-words:
+			self._remove_posting(word,event_id)
+		for word in words-old:
+			postings=self._postings.get(word,None)
+			if postings is None:
+				postings=self._postings[word]=set()
+				bisect.insort(self._words,word)
+			postings.add(event_id)
+
+		if words:
+			self._event_words[event_id]=words
+		else:
+			self._event_words.pop(event_id,None)
+
+	def remove(self,event_id):
+		"""Remove an event from the index"""
+		for word in self._event_words.pop(event_id,()):
+			self._remove_posting(word,event_id)
+
+	def search(self,query,prefix=True):
+		"""The set of ids of the events containing every word of query
+
+		If prefix, the words of query also match longer words they are a prefix of
+		(so that partially typed queries match)."""
+		words=tokenize(query)
+		if not words:
+			return set()
+
+		# start from the most selective word, then narrow the candidates down by each
+		# of the others, either by intersecting with its (union of) postings or, when
+		# that would be bigger, by probing its postings for each candidate
+		matches=sorted((self._match(word,prefix) for word in set(words)),key=lambda postings:sum(map(len,postings)))
+
+		result=set()
+		for postings in matches[0]:
+			result.update(postings)
+
+		for postings in matches[1:]:
+			if not result:
+				break
+			if len(postings)==1:
+				result.intersection_update(postings[0])
+			elif len(result)*len(postings)<sum(map(len,postings)):
+				result=set(event_id for event_id in result if any(event_id in p for p in postings))
+			else:
+				found=set()
+				for p in postings:
+					found.update(result.intersection(p))
+				result=found
+		return result
+
+	def _match(self,word,prefix):
+		"""The posting sets of the words matching word"""
+		if not prefix:
+			return [self._postings[word]] if word in self._postings else []
+
+		words=self._words
+		i=bisect.bisect_left(words,word)
+		j=i
+		while j<len(words) and words[j].startswith(word):
+			j+=1
+		return [self._postings[w] for w in words[i:j]]
+
+	def _remove_posting(self,word,event_id):
+		postings=self._postings[word]
+		postings.discard(event_id)
+		if not postings:
+			del self._postings[word]
+			del self._words[bisect.bisect_left(self._words,word)]
+
+
+class EventCache(object):
+	"""Bounded LRU cache of events fetched from the server when the EPG is not collected
+
+	An event is held for at most ttl seconds, and not past its stop time. The event ids of a
+	channel's guide are held alongside for at most ttl seconds, until the first of its events
+	running when cached ends, and only while every one of those events is still cached."""
+
+	def __init__(self,size=1024,ttl=300):
+		self._size=size
+		self._ttl=ttl
+		self._lock=threading.Lock()
+		self._entries=collections.OrderedDict()	# event id -> (expiry, event), least recently used first
+		self._channels={}						# channel id -> (expiry, event ids, set of them)
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self,event_id):
+		"""The cached event with the given id, or None"""
+		with self._lock:
+			entry=self._entries.pop(event_id,None)
+			if entry is None:
+				return None
+			if entry[0]<=time.time():
+				return None
+			self._entries[event_id]=entry
+			return entry[1]
+
+	def put(self,event):
+		"""Cache an event (an HTSPEvent), evicting the least recently used if full"""
+		if self._size<=0:
+			return
+		message=event._message
+		expiry=min(time.time()+self._ttl,message.get('stop',0))
+		with self._lock:
+			self._entries.pop(message['eventId'],None)
+			self._entries[message['eventId']]=(expiry,event)
+			while len(self._entries)>self._size:
+				self._entries.popitem(last=False)
+
+			# an event new to a cached guide means the guide is out of date
+			channel=self._channels.get(message.get('channelId',None),None)
+			if channel is not None and not message['eventId'] in channel[2]:
+				del self._channels[message['channelId']]
+
+	def get_channel(self,channel_id):
+		"""The cached events (HTSPEvent instances) of the channel, in start order, or None"""
+		with self._lock:
+			channel=self._channels.get(channel_id,None)
+			if channel is None:
+				return None
+			entries=[self._entries.get(event_id,None) for event_id in channel[1]]
+			if channel[0]<=time.time() or None in entries:
+				del self._channels[channel_id]
+				return None
+			for event_id in channel[1]:
+				self._entries[event_id]=self._entries.pop(event_id)
+			return [entry[1] for entry in entries]
+
+	def put_channel(self,channel_id,events):
+		"""Cache the events (HTSPEvent instances, in start order, each already put) of the channel"""
+		if self._size<=0:
+			return
+		event_ids=[event._message['eventId'] for event in events]
+		now=time.time()
+		stops=[stop for stop in (event._message.get('stop',0) for event in events) if stop>now]
+		expiry=min([now+self._ttl]+stops)
+		with self._lock:
+			self._channels[channel_id]=(expiry,event_ids,frozenset(event_ids))
+
+	def discard(self,event_id):
+		with self._lock:
+			self._entries.pop(event_id,None)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._channels.clear()
+
+
+class _StringTable(object):
+	"""Deduplicated table of strings, referenced by index (0 is None)"""
+
+	def __init__(self):
+		self._strings=[None]
+		self._indexes={}
+
+	def __len__(self):
+		return len(self._strings)-1
+
+	def __getitem__(self,index):
+		return self._strings[index]
+
+	def add(self,string):
+		if string is None:
+			return 0
+		index=self._indexes.get(string,None)
+		if index is None:
+			index=self._indexes[string]=len(self._strings)
+			self._strings.append(string)
+		return index
+
+	def strings(self):
+		return self._strings
+
+
+class EPGColumnStore(collections.MutableMapping):
+	"""Mapping of event id to HTSPEvent held as columns rather than one object per event
+
+	The ids, channel ids, start/stop times and dvr ids of the events are held in arrays,
+	titles and descriptions in deduplicated string tables, and the rest of each message
+	is packed as HTSMSG, one per row. Events are materialised (by factory, from the
+	message) when looked up, so each lookup returns a new instance and changes to it are
+	only kept by assigning it back to the store.
+
+	Deleted events leave a tombstone in the arrays, which are compacted once at least half
+	of the rows are tombstones."""
+
+	# (field, array typecode) of the integer columns
+	_COLUMNS=(('eventId','I'),('channelId','I'),('start','l'),('stop','l'),('dvrId','I'))
+
+	# fields held in string tables, the column holding each is the table index
+	_TABLES=('title','description')
+
+	_FIELDS=tuple(field for (field,typecode) in _COLUMNS)+_TABLES
+
+	_UNPACKED=frozenset(['eventId','channelId','start','stop','dvrId','title','description','method','seq'])
+
+	_COMPACT_MIN=1024
+
+	def __init__(self,factory):
+		self._factory=factory
+		self._rows={}			# event id -> row
+		self._live=bytearray()	# row -> 1 unless a tombstone
+		self._tombstones=0
+		self._columns={}
+		self._tables={}
+		self._extra=[]			# row -> the other fields packed as HTSMSG, or None
+		self._clear()
+
+	def __len__(self):
+		return len(self._rows)
+
+	def __iter__(self):
+		return iter(self._rows)
+
+	def __contains__(self,event_id):
+		return event_id in self._rows
+
+	def __getitem__(self,event_id):
+		row=self._rows[event_id]
+		columns=self._columns
+		tables=self._tables
+
+		message={}
+		extra=self._extra[row]
+		if extra:
+			message.update(htsmsg.deserialize0(extra))
+		for (field,typecode) in EPGColumnStore._COLUMNS:
+			message[field]=int(columns[field][row])
+		if not message['dvrId']:
+			del message['dvrId']
+		for field in ('title','description'):
+			index=columns[field][row]
+			if index:
+				message[field]=tables[field][index]
+		return self._factory(message)
+
+	def __setitem__(self,event_id,event):
+		message=event._message
+		tables=self._tables
+
+		extra=dict((field,value) for (field,value) in message.items() if not field in EPGColumnStore._UNPACKED)
+		values=[message['eventId'],message['channelId'],message['start'],message['stop'],message.get('dvrId',0),
+			tables['title'].add(message.get('title',None)),
+			tables['description'].add(message.get('description',None))]
+		extra=htsmsg.serialize(extra)[4:] if extra else None
+
+		row=self._rows.get(event_id,None)
+		if row is None:
+			self._rows[event_id]=len(self._live)
+			self._live.append(1)
+			self._extra.append(extra)
+			for (field,value) in zip(EPGColumnStore._FIELDS,values):
+				self._columns[field].append(value)
+		else:
+			self._extra[row]=extra
+			for (field,value) in zip(EPGColumnStore._FIELDS,values):
+				self._columns[field][row]=value
+
+	def __delitem__(self,event_id):
+		row=self._rows.pop(event_id)
+		self._live[row]=0
+		self._extra[row]=None
+		self._tombstones+=1
+		if self._tombstones>=EPGColumnStore._COMPACT_MIN and self._tombstones*2>=len(self._live):
+			self.compact()
+
+	def compact(self):
+		"""Drop the tombstones of deleted events, and the strings only they referenced"""
+		if not self._tombstones:
+			return
+
+		live=[row for (row,flag) in enumerate(self._live) if flag]
+		(columns,tables,extra)=(self._columns,self._tables,self._extra)
+		self._clear()
+
+		for field in EPGColumnStore._FIELDS:
+			column=columns[field]
+			values=[column[row] for row in live]
+			if field in tables:
+				strings=tables[field]
+				values=map(lambda index:self._tables[field].add(strings[index]),values)
+			self._columns[field].extend(values)
+
+		self._extra=[extra[row] for row in live]
+		self._live=bytearray('\x01'*len(live))
+		self._rows=dict((int(event_id),row) for (row,event_id) in enumerate(self._columns['eventId']))
+
+	def columns(self):
+		"""The columns of the store, as a dict of field name to numpy array (array.array without numpy)
+
+		The rows of deleted events are still present until compacted, the 'live' column is
+		false for them. The title and description columns hold indexes into strings(field).
+		The columns are copies, later changes to the store do not show in them."""
+		columns=dict((field,column[:]) for (field,column) in self._columns.items())
+		live=bytearray(self._live)
+		if numpy is None:
+			columns['live']=live
+			return columns
+		# the arrays are views over the copies, which they keep alive
+		columns=dict((field,numpy.frombuffer(column,dtype=column.typecode)) for (field,column) in columns.items())
+		columns['live']=numpy.frombuffer(live,dtype=bool)
+		return columns
+
+	def strings(self,field):
+		"""The string table of field (title or description), indexed by its column"""
+		return self._tables[field].strings()
+
+	def select(self,channel_id=None,start=None,stop=None,recorded=None):
+		"""The ids of the events on channel_id (if given) overlapping start to stop (if given) and,
+		if recorded is not None, with or without a dvr entry"""
+		columns=self.columns()
+
+		if numpy is not None:
+			mask=columns['live'].copy()
+			if channel_id is not None:
+				mask&=columns['channelId']==channel_id
+			if start is not None:
+				mask&=columns['stop']>start
+			if stop is not None:
+				mask&=columns['start']<stop
+			if recorded is not None:
+				mask&=(columns['dvrId']!=0)==bool(recorded)
+			return columns['eventId'][mask].tolist()
+
+		rows=zip(columns['live'],columns['eventId'],columns['channelId'],columns['start'],columns['stop'],columns['dvrId'])
+		return [int(event_id) for (live,event_id,event_channel_id,event_start,event_stop,dvr_id) in rows
+			if live and (channel_id is None or event_channel_id==channel_id)
+			and (start is None or event_stop>start)
+			and (stop is None or event_start<stop)
+			and (recorded is None or bool(dvr_id)==bool(recorded))]
+
+	def _clear(self):
+		self._columns=dict((field,array.array(typecode)) for (field,typecode) in EPGColumnStore._COLUMNS)
+		self._tables={}
+		for field in EPGColumnStore._TABLES:
+			self._columns[field]=array.array('I')
+			self._tables[field]=_StringTable()
+		self._extra=[]
+		self._rows={}
+		self._live=bytearray()
+		self._tombstones=0
+
+
+class HTSPGrid(object):
+	"""Columnar result of HTSPSession.grid
+
+	The events of every channel are held in parallel lists, channel by channel in
+	start order; rows maps each channel id to the slice of the lists holding its events."""
+
+	def __init__(self,start,stop):
+		self.start=start
+		self.stop=stop
+		self.rows={}
+		self.channel_ids=[]
+		self.event_ids=[]
+		self.starts=[]
+		self.stops=[]
+		self.titles=[]
+
+	def __len__(self):
+		return len(self.event_ids)
+
+	def add_row(self,channel_id,events):
+		"""Append the events (HTSPEvent instances, in start order) of one channel"""
+		first=len(self.event_ids)
+		for event in events:
+			message=event._message
+			self.channel_ids.append(channel_id)
+			self.event_ids.append(message['eventId'])
+			self.starts.append(message['start'])
+			self.stops.append(message['stop'])
+			self.titles.append(message.get('title',None))
+		self.rows[channel_id]=slice(first,len(self.event_ids))
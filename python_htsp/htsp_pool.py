@@ -0,0 +1,220 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Pool of warm, authenticated Tvheadend HTSP sessions for multi-threaded callers"""
+
+import contextlib
+import logging
+import Queue
+import threading
+import time
+
+from htsp_session import HTSPSession, RequestError
+from htsp_threaded import ThreadedHTSPSession
+
+_logger = logging.getLogger(__name__)
+
+
+class _PooledHTSPSession(ThreadedHTSPSession):
+	"""A pool connection; its metadata is the pool's shared cache, kept current by the pool's metadata session
+
+	The metadata attributes are not copied, they are looked up on the metadata session
+	whenever used, so they stay current if it replaces them (e.g. on a resync). Responses
+	to this session's commands are applied by the metadata session, under its lock."""
+
+	# read through to the pool's metadata session
+	_SHARED=frozenset([
+		'_tags','_channels','_tag_index','_events','_event_cache','_epg_index','_search_index',
+		'_dvr_entries','_dvr_index','_dvr_conflicts','_episode_index','_dvr_links',
+		'_auto_record_entries','_autorec_engine','_state','_initial_data',
+		])
+
+	# the wait for the metadata session to receive the notification of a change
+	_NOTIFICATION_TIMEOUT=30
+
+	def __init__(self,pool,addr,name,lazy):
+		ThreadedHTSPSession.__init__(self,addr=addr,name=name,lazy=lazy)
+		self._pool=pool
+		self._last_used=time.time()
+		for attr in _PooledHTSPSession._SHARED:
+			del self.__dict__[attr]
+
+	def __getattr__(self,attr):
+		if attr in _PooledHTSPSession._SHARED:
+			return getattr(self._pool._metadata,attr)
+		raise AttributeError(attr)
+
+	def fetch_initial_data(self,events=False,epg_window=None):
+		"""The initial data is the pool's metadata session's"""
+		self._pool._metadata._wait_for_initial_data()
+
+	def snapshot(self):
+		"""An immutable SessionSnapshot of the pool's metadata, see HTSPSession.snapshot"""
+		return self._pool._metadata.snapshot()
+
+	def changes_since(self,version):
+		"""The changes to the pool's metadata since version, see HTSPSession.changes_since"""
+		return self._pool._metadata.changes_since(version)
+
+	def monitor(self,callback):
+		"""Call callback(method,notification) for each notification received by the pool's metadata session"""
+		self._pool._metadata.monitor(callback)
+
+	def add_dvr_entry(self,entry):
+		"""Create a new DVR entry, wraps HTSP addDvrEntry"""
+		message=self._invoke_command('addDvrEntry',entry._as_add_dvr_entry_command())
+		HTSPSession._check_response(message)
+
+		# the dvrEntryAdd notification goes to the metadata session
+		metadata=self._pool._metadata
+		if not metadata._wait_until(lambda:message["id"] in metadata._dvr_entries,_PooledHTSPSession._NOTIFICATION_TIMEOUT):
+			raise RequestError('No dvrEntryAdd received for dvr entry {0}'.format(message["id"]))
+		return metadata._dvr_entries[message["id"]]
+
+	def _handleMessage(self,message):
+		with self._pool._metadata._lock:
+			return self._pool._metadata._handleMessage(message)
+
+	def _handle_channelAdd(self,message):
+		with self._pool._metadata._lock:
+			return self._pool._metadata._handle_channelAdd(message)
+
+	def _handle_eventAdd(self,message):
+		with self._pool._metadata._lock:
+			return self._pool._metadata._handle_eventAdd(message)
+
+	def _resolve_dvr_episodes(self):
+		with self._pool._metadata._lock:
+			HTSPSession._resolve_dvr_episodes(self)
+
+	def _autorec_matches(self,rule_id):
+		with self._pool._metadata._lock:
+			return HTSPSession._autorec_matches(self,rule_id)
+
+	def _event_autorecs(self,event_id):
+		with self._pool._metadata._lock:
+			return HTSPSession._event_autorecs(self,event_id)
+
+
+class HTSPSessionPool(object):
+	"""A pool of authenticated HTSP connections sharing one metadata cache
+
+	One metadata session does the initial sync and monitors the server to keep the
+	tags, channels, dvr entries etc. current, the pooled sessions handed out by
+	session() share its cache rather than doing their own initial sync."""
+
+	def __init__(self,host='localhost',port=9982,addr=None,size=4,user=None,password=None,
+		name='python-htsp',events=False,lazy=False,check_interval=30):
+
+		self._addr=addr if addr else (host,port)
+		self._size=size
+		self._user=user
+		self._password=password
+		self._name=name
+		self._lazy=lazy
+		self._check_interval=check_interval
+
+		self._lock=threading.Lock()
+		self._idle=Queue.LifoQueue()
+		self._sessions=[]
+		self._closed=False
+
+		self._metadata=ThreadedHTSPSession(addr=self._addr,name=name,lazy=lazy,reconnect=True)
+		self._connect(self._metadata)
+		self._metadata.fetch_initial_data(events)
+
+		for i in range(size):
+			self._idle.put(self._create())
+
+	@property
+	def metadata(self):
+		"""The session maintaining the shared metadata cache"""
+		return self._metadata
+
+	@contextlib.contextmanager
+	def session(self,timeout=None):
+		"""Context manager handing out a pooled session, waiting up to timeout seconds for one to be free"""
+		session=self._acquire(timeout)
+		try:
+			yield session
+		finally:
+			self._release(session)
+
+	def close(self):
+		"""Close every connection in the pool"""
+		with self._lock:
+			self._closed=True
+			sessions,self._sessions=self._sessions,[]
+		for session in sessions:
+			session.close()
+		self._metadata.close()
+
+	def _connect(self,session):
+		session.hello()
+		if self._user:
+			session.authenticate(self._user,self._password)
+
+	def _create(self):
+		session=_PooledHTSPSession(self,self._addr,self._name,self._lazy)
+		self._connect(session)
+		session.fetch_initial_data()
+		with self._lock:
+			self._sessions.append(session)
+		return session
+
+	def _discard(self,session):
+		with self._lock:
+			if session in self._sessions:
+				self._sessions.remove(session)
+		session.close()
+
+	def _healthy(self,session):
+		if not session._sock:
+			return False
+		if time.time()-session._last_used<self._check_interval:
+			return True
+		try:
+			session.system_time
+			return True
+		except Exception as e:
+			_logger.warning('Discarding pooled session: %s',e)
+			return False
+
+	def _acquire(self,timeout):
+		if self._closed:
+			raise Exception('Pool is closed')
+		try:
+			session=self._idle.get(timeout=timeout)
+		except Queue.Empty:
+			raise Exception('No pooled session available')
+
+		if not self._healthy(session):
+			self._discard(session)
+			try:
+				session=self._create()
+			except Exception:
+				# keep the pool at size, the next acquire will try to connect again
+				self._idle.put(_PooledHTSPSession(self,self._addr,self._name,self._lazy))
+				raise
+		return session
+
+	def _release(self,session):
+		session._last_used=time.time()
+		if self._closed:
+			session.close()
+		else:
+			self._idle.put(session)
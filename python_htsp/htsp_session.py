@@ -19,14 +19,22 @@
 
 # Original example code at <https://github.com/tvheadend/tvheadend/blob/master/lib/py/tvh/htsp.py>
 
+import collections
 import datetime
 import hashlib
 import logging
+import mmap
+import os
 import socket
 import time
 
 from tvh import htsmsg
 
+from htsp_channels import TagIndex
+from htsp_dvr import AutorecEngine, DVRConflicts, DVRIndex, DVRLinks, EpisodeIndex
+from htsp_epg import EPGColumnStore, EPGIndex, EPGSearchIndex, EventCache, HTSPGrid
+from htsp_state import SessionState
+
 HTSP_PROTO_VERSION = 17
 
 class NullHandler(logging.Handler):
@@ -43,8 +51,17 @@ class ProtocolVersionException(Exception):
 class RequestError(Exception):
 	"""Raised when an HTSP request fails"""	
 
+class NotConnectedError(Exception):
+	"""Raised when an HTSP command is issued while the session is not connected"""
+
 class HTSPResponse(object):
 	"""Base class for HTSPResponse classes"""
+
+	# responses are held in their thousands (e.g. the EPG), so they carry no __dict__:
+	# the decoded message is the only store of their fields, plus a slot per converted
+	# field in the subclasses that convert any (see _datetime)
+	__slots__=('_session','_message')
+
 	def __init__(self,session,message):
 		self._session=session
 		self._message=message if message else {}
@@ -71,17 +88,40 @@ class HTSPResponse(object):
 	def _checkProtocol(self,required_version):
 		self._session._checkProtocol(required_version)
 
+	def _frozen(self):
+		"""A copy sharing this response's message, as recorded in the session's SessionState"""
+		copy=object.__new__(type(self))
+		copy._session=self._session
+		copy._message=self._message
+		return copy
+
+	def _datetime(self,field):
+		"""The UNIX time field of the message as a datetime, converted once while the field is unchanged
+
+		The conversion is kept in the slot named '_'+field, which the subclass declares"""
+		timestamp=self._message[field]
+		slot='_'+field
+		cached=getattr(self,slot,None)
+		if cached is None or cached[0]!=timestamp:
+			cached=(timestamp,self._datetime_from_timestamp(timestamp))
+			setattr(self,slot,cached)
+		return cached[1]
+
 	def _datetime_from_timestamp(self,timestamp):
 		# TODO: Adjust for server timezone?
 		return datetime.datetime.fromtimestamp(timestamp)
 
-	def _timestamp_from_datetime(self,datetime):
+	@staticmethod
+	def _timestamp_from_datetime(datetime):
 		# TODO: Adjust for server timezone?
 		return int(time.mktime(datetime.timetuple()))
 
 
 class HTSPHello(HTSPResponse):
 	"""Represents an HTSP 'hello' reply message"""
+
+	__slots__=()
+
 	def __init__(self,session,message):
 		super(HTSPHello, self).__init__(session,message)
 
@@ -127,6 +167,9 @@ class HTSPHello(HTSPResponse):
 
 class HTSPDiskSpace(HTSPResponse):
 	"""Represents an HTSP 'getDiskSpace' reply message"""
+
+	__slots__=()
+
 	def __init__(self,session,message):
 		super(HTSPDiskSpace, self).__init__(session,message)
 
@@ -151,6 +194,8 @@ class HTSPDiskSpace(HTSPResponse):
 class HTSPSystemTime(HTSPResponse):
 	"""Represents an HTSP 'getSysTime' reply message"""
 
+	__slots__=('_time',)
+
 	def __init__(self,session,message):
 		super(HTSPSystemTime, self).__init__(session,message)
 
@@ -166,11 +211,13 @@ class HTSPSystemTime(HTSPResponse):
 
 	@property
 	def datetime(self):
-		return self._datetime_from_timestamp(self.time)
+		return self._datetime('time')
 
 class HTSPService(HTSPResponse):
 	"""Represents an HTSP service"""
 
+	__slots__=()
+
 	# Note: HTSP gives limited information about services, the code
 	# here attempts to infer additional information, but this is
 	# based on incomplete and quite possibly incorrect knowledge
@@ -224,6 +271,8 @@ class HTSPService(HTSPResponse):
 class HTSPChannel(HTSPResponse):
 	"""Represents an HTSP 'channelAdd' reply message"""
 
+	__slots__=()
+
 	def __init__(self,session,message):
 		super(HTSPChannel, self).__init__(session,message)
 
@@ -279,12 +328,7 @@ class HTSPChannel(HTSPResponse):
 	@property
 	def tags(self):
 		"""Tags this channel is mapped to, as an array of HTSPTag instances"""
-		result=[]
-		for tag_id in self._message['tags']:
-			tag=self._session._tags[tag_id]
-			result.append(tag)
-
-		return result
+		return self._session._get_channel_tags(self.id)
 	
 	# services           msg[] optional   List of available services (Added in version 5)
 	@property
@@ -305,6 +349,8 @@ class HTSPChannel(HTSPResponse):
 class HTSPTag(HTSPResponse):
 	"""Represents an HTSP 'tagAdd' reply message"""
 
+	__slots__=()
+
 	def __init__(self,session,message):
 		super(HTSPTag, self).__init__(session,message)
 
@@ -327,13 +373,17 @@ class HTSPTag(HTSPResponse):
 	# members            u32[] optional   Channel IDs of those that belong to the tag
 	@property
 	def channels(self):
-		"""Channel that belong to the tag"""
+		"""Channels that belong to the tag, as an array of HTSPChannel instances, or None if the tag has no members
+
+		The members come first, in the tag's order, followed by any other channels listing the tag"""
 		if 'members' in self._message:
-			return map(lambda channel_id:self._session._get_channel(channel_id),self._message['members'])
+			return self._session._get_tag_channels(self.id,self._message['members'])
 
 class HTSPDVREntry(HTSPResponse):
 	"""Represents an HTSP 'dvrEntryAdd' reply message"""
 
+	__slots__=('_start','_stop')
+
 	def __init__(self,session,message):
 		super(HTSPDVREntry, self).__init__(session,message)
 
@@ -358,7 +408,7 @@ class HTSPDVREntry(HTSPResponse):
 	@property
 	def start(self):
 		"""Start time of this entry"""
-		return self._datetime_from_timestamp(self._message['start'])
+		return self._datetime('start')
 
 	@start.setter
 	def start(self,value):
@@ -368,7 +418,7 @@ class HTSPDVREntry(HTSPResponse):
 	@property
 	def stop(self):
 		"""End time of this entry"""
-		return self._datetime_from_timestamp(self._message['stop'])
+		return self._datetime('stop')
 
 	@stop.setter
 	def stop(self,value):
@@ -515,6 +565,8 @@ class HTSPDVREntry(HTSPResponse):
 class HTSPAutoRecordEntry(HTSPResponse):
 	"""Represents an HTSP 'autorecEntryAdd ' reply message"""
 
+	__slots__=()
+
 	def __init__(self,session,message):
 		super(HTSPAutoRecordEntry, self).__init__(session,message)
 
@@ -573,9 +625,23 @@ class HTSPAutoRecordEntry(HTSPResponse):
 class HTSPEvent(HTSPResponse):
 	"""Represents an HTSP 'eventAdd' reply message"""
 
+	__slots__=('_start','_stop')
+
 	def __init__(self,session,message):
 		super(HTSPEvent, self).__init__(session,message)
 
+		# titles and series links recur throughout the EPG, share one copy of each; other
+		# texts (e.g. descriptions) are mostly one-offs, interning them would only grow
+		# the interned string table
+		if type(message) is dict:
+			for field in HTSPEvent._SHARED_FIELDS:
+				value=message.get(field,None)
+				if type(value) is str and len(value)<=HTSPEvent._SHARED_LENGTH:
+					message[field]=intern(value)
+
+	_SHARED_FIELDS=('title','serieslinkUri')
+	_SHARED_LENGTH=128
+
 	# eventId            u32   required   Event ID
 	@property
 	def id(self):
@@ -590,12 +656,12 @@ class HTSPEvent(HTSPResponse):
 	# start              u64   required   Start time of event, UNIX time.
 	@property
 	def start(self):
-		return self._datetime_from_timestamp(self._message['start'])
+		return self._datetime('start')
 
 	# stop               u64   required   Ending time of event, UNIX time.
 	@property
 	def stop(self):
-		return self._datetime_from_timestamp(self._message['stop'])
+		return self._datetime('stop')
 
 	@property
 	def duration(self):
@@ -661,7 +727,17 @@ class HTSPEvent(HTSPResponse):
 	# dvrId              u32   optional   ID of a recording (Added in version 5).
 	@property
 	def dvr_id(self):
-		return self._message['dvrId']
+		"""ID of a recording of this event, or None"""
+		entry=self.dvr_entry
+		if entry:
+			return entry.id
+		# the event's dvrId outlives a deleted entry, so it only stands in while the entries are unknown
+		return None if self._session._initial_data else self._message.get('dvrId',None)
+
+	@property
+	def dvr_entry(self):
+		"""A recording of this event (preferring a scheduled or current one), as an HTSPDVREntry instance, or None"""
+		return self._session._get_event_dvr_entry(self.id)
 	
 
 	# nextEventId        u32   optional   ID of next event on the same channel.
@@ -682,9 +758,102 @@ class HTSPEvent(HTSPResponse):
 
 
 
+class HTSPFuture(object):
+	"""The pending result of an htsp operation"""
+
+	def __init__(self,session):
+		self._session=session
+		self._done=False
+		self._result=None
+		self._exception=None
+		self._callbacks=[]
+
+	def done(self):
+		"""True if the result is available"""
+		return self._done
+
+	def result(self):
+		"""Wait for and return the result, raising the exception if the operation failed
+
+		Notifications received while waiting are handled before returning, except by
+		a ThreadedHTSPSession, whose receiver thread handles them as they arrive"""
+		self._session._wait(self)
+		self._session._process_notifications(notify=self._session._initial_data)
+		if self._exception:
+			raise self._exception
+		return self._result
+
+	def exception(self):
+		"""The exception the operation failed with, if any"""
+		return self._exception
+
+	def add_done_callback(self,fn):
+		"""Call fn with this future once the result is available"""
+		if self._done:
+			self._session._call_soon(fn,self)
+		else:
+			self._callbacks.append(fn)
+
+	def then(self,fn):
+		"""Return a new HTSPFuture for the result of fn(result), chaining on if fn returns an HTSPFuture"""
+		future=HTSPFuture(self._session)
+
+		def done(_):
+			try:
+				if self._exception:
+					raise self._exception
+				value=fn(self._result)
+			except Exception as e:
+				future._set_exception(e)
+				return
+			if isinstance(value,HTSPFuture):
+				value.add_done_callback(lambda other:future._set_exception(other._exception) if other._exception else future._set_result(other._result))
+			else:
+				future._set_result(value)
+
+		self.add_done_callback(done)
+		return future
+
+	def _set_result(self,result):
+		self._result=result
+		self._set_done()
+
+	def _set_exception(self,exception):
+		self._exception=exception
+		self._set_done()
+
+	def _set_done(self):
+		self._done=True
+		callbacks,self._callbacks=self._callbacks,[]
+		for fn in callbacks:
+			try:
+				fn(self)
+			except Exception:
+				_logger.exception('HTSPFuture callback failed')
+
+
+class HTSPCommandFuture(HTSPFuture):
+	"""The pending reply to an htsp command issued by HTSPSession.send_command"""
+
+	def __init__(self,session,method,sequence):
+		super(HTSPCommandFuture, self).__init__(session)
+		self._method=method
+		self._sequence=sequence
+
+	@property
+	def method(self):
+		"""The htsp method of the command"""
+		return self._method
+
+	@property
+	def sequence(self):
+		"""The sequence number of the command"""
+		return self._sequence
+
+
 class HTSPSession:
 		
- 	def __init__ (self, host='localhost',port=9982, addr=None,name = 'python-htsp' ):
+ 	def __init__ (self, host='localhost',port=9982, addr=None,name = 'python-htsp', lazy=False, reconnect=False, max_backoff=60, event_cache_size=1024, event_cache_ttl=300, journal_size=4096 ):
  		if addr:
  			self._addr=addr
  		else:
@@ -692,22 +861,44 @@ class HTSPSession:
 			
 		self._name = name
 		self._sock = None
+		self._reader = None
+		self._lazy = lazy
 
 		self._auth = None
 		self._user = None
+		self._password = None
 		self._digest = None
 
 		self._hello=None
 
+		self._reconnect_enabled=reconnect
+		self._max_backoff=max_backoff
+		self._closed=False
+
 		self._sequence=0
-		self._command_pending=False
+		self._pending={}
+		self._notify_queue=collections.deque()
 
 		self._initial_data=False
+		self._metadata_args=None
+		self._last_update=None
+		self._resync_seen=None
+		self._resync_changes=[]
 		self._tags={}
 		self._channels={}
+		self._tag_index=TagIndex()
 		self._events=None
+		self._event_cache=EventCache(event_cache_size,event_cache_ttl)
+		self._epg_index=EPGIndex()
+		self._search_index=EPGSearchIndex()
 		self._dvr_entries={}
+		self._dvr_index=DVRIndex()
+		self._dvr_conflicts=DVRConflicts()
+		self._episode_index=EpisodeIndex()
+		self._dvr_links=DVRLinks()
 		self._auto_record_entries={}
+		self._autorec_engine=AutorecEngine()
+		self._state=SessionState(journal_size)
 
 		self._callbacks=[]
 
@@ -715,6 +906,7 @@ class HTSPSession:
 		"""Issue an htsp 'hello' command to the server and return an HTSPHello response instance"""
 		if not self._sock:
 			self._sock = socket.create_connection(self._addr)
+			self._reader = htsmsg.HTSMSGStreamReader(self._sock,lazy=self._lazy)
 
 		message=self._invoke_command('hello', {
 			'htspversion' : HTSP_PROTO_VERSION,
@@ -729,6 +921,7 @@ class HTSPSession:
 		self._check_connection()
 
 		self._user = user
+		self._password = password
 		if password:
 			self._digest = HTSPSession._htsp_digest(user, password, self._hello.challenge)
 
@@ -738,16 +931,17 @@ class HTSPSession:
 			raise Exception('Authentication failed')
 
 
-	def fetch_initial_data(self,events=False):
-		"""Issue an htsp 'enableAsyncMetadata' command to the server and collect the initial data"""
+	def fetch_initial_data(self,events=False,epg_window=None,columnar=False):
+		"""Issue an htsp 'enableAsyncMetadata' command to the server and collect the initial data
+
+		If events, the EPG is also collected, limited to epg_window seconds ahead if given,
+		and if columnar held in an EPGColumnStore rather than as HTSPEvent instances"""
 		
 
-		self._events={} if events else None
+		self._reset_events(events,columnar)
 		self._check_connection()		
-		self._enable_async_metadata(events)
-		while not self._initial_data:
-			message = self._recv()
-			self._handleMessage(message)
+		self._enable_async_metadata(events,epg_window)
+		self._wait_for_initial_data()
 
 
 	@property
@@ -784,10 +978,7 @@ class HTSPSession:
 	def tags(self):
 		"""The set of tags defined on the server, as an array of HTSPTag instances"""
 		
-		self._check_connection()
-
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
 		return self._tags.values()
 
@@ -796,49 +987,135 @@ class HTSPSession:
 	def channels(self):
 		"""The set of channels defined on the server, as an array of HTSPChannel instances"""
 		
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
 		return self._channels.values()
 
 	@property
 	def recorded(self):
-		"""The set of recorded items on the server, as an array of HTSPDVREntry instances"""
+		"""The set of recorded items on the server, as an array of HTSPDVREntry instances in start order"""
 		
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
-		return filter(lambda entry:entry.state=='completed',self._dvr_entries.values())
+		return self._dvr_bucket('recorded')
 
 	@property
 	def scheduled(self):
-		"""The set of scheduled items on the server, as an array of HTSPDVREntry instances"""
+		"""The set of scheduled items on the server, as an array of HTSPDVREntry instances in start order"""
 		
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
-		return filter(lambda entry:entry.state=='scheduled' or entry.state=='recording',self._dvr_entries.values())
+		return self._dvr_bucket('scheduled')
 
 
 	@property
 	def failed(self):
-		"""The set of failed items on the server, as an array of HTSPDVREntry instances"""
+		"""The set of failed items on the server, as an array of HTSPDVREntry instances in start order"""
 		
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
-		return filter(lambda entry:entry.state=='missed',self._dvr_entries.values())
+		return self._dvr_bucket('failed')
 
 
 	@property
 	def auto_record_entries(self):
 		"""The set of auto record items on the server, as an array of HTSPAutoRecordEntry instances"""
 		
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
 		return self._auto_record_entries.values()
 
+	def snapshot(self):
+		"""An immutable SessionSnapshot of the tags, channels, events, dvr and autorec entries
+
+		Taking one is O(1) until the next change, a snapshot is then taken in proportion
+		to the number of shards and the writer copies only the shards it changes after,
+		so threads can read snapshots without locking while notifications are applied."""
+
+		self._ensure_initial_data()
+
+		if not self._state.capturing:
+			self._capture_state()
+		return self._state.snapshot()
+
+	def changes_since(self,version):
+		"""The changes to the tags, channels, events, dvr and autorec entries since version, as a ChangeDelta
+
+		The delta's changes are Changes compacted to one per response, or resync is set when
+		the changes since version are no longer in the journal (of the last journal_size
+		changes) and the caller has to start again from a snapshot(). Either way the
+		delta's version is the one to ask for the changes since next time."""
+		return self._state.changes_since(version)
+
+	def recordings_between(self,start,stop):
+		"""The DVR entries (in any state) overlapping start to stop (datetimes or UNIX times), in start order"""
+
+		self._ensure_initial_data()
+
+		return [self._dvr_entries[entry_id] for entry_id in self._dvr_index.between(HTSPSession._timestamp(start),HTSPSession._timestamp(stop))]
+
+	def dvr_conflicts(self,entry,tuners):
+		"""The scheduled DVR entries that entry (an HTSPDVREntry, e.g. one about to be added) conflicts with given tuners
+
+		i.e. those that would be recording when recording entry too would need more than tuners
+		tuners, in start order. Recordings from the same mux are taken to share a tuner."""
+
+		self._ensure_initial_data()
+
+		(start,stop,mux)=self._dvr_recording(entry._message)
+		return [self._dvr_entries[entry_id] for entry_id in self._dvr_conflicts.conflicts(start,stop,mux,tuners,entry._message.get('id',None))]
+
+	def is_scheduled(self,event):
+		"""True if a DVR entry is scheduled to record, or is recording, event (an HTSPEvent or event id)"""
+
+		entry=self._get_event_dvr_entry(event.id if isinstance(event,HTSPEvent) else event)
+		return entry is not None and entry._message.get('state',None) in ('scheduled','recording')
+
+	def dedupe_candidates(self,event):
+		"""The DVR entries that have recorded, are recording or will record the same episode as event, in start order
+
+		Episodes are matched by episode uri or id, or by title and on screen episode number"""
+
+		self._ensure_initial_data()
+
+		self._resolve_dvr_episodes()
+
+		keys=self._episode_index.event_episodes.keys(event.id).union(EpisodeIndex.episode_keys(event._message))
+		entries=[self._dvr_entries[entry_id] for entry_id in self._episode_index.dvr_episodes.find(keys) if entry_id in self._dvr_entries]
+		entries=[entry for entry in entries if entry._message.get('state',None) in ('completed','recording','scheduled')]
+		entries.sort(key=lambda entry:entry._message['start'])
+		return entries
+
+	def episode_events(self,event):
+		"""The airings in the EPG of the same episode as event (including event), in start order"""
+		keys=self._episode_index.event_episodes.keys(event.id).union(EpisodeIndex.episode_keys(event._message))
+		return self._indexed_events(self._episode_index.event_episodes.find(keys))
+
+	def series_events(self,event):
+		"""The events in the EPG of the same series as event (including event), in start order"""
+		keys=self._episode_index.event_series.keys(event.id).union(EpisodeIndex.series_keys(event._message))
+		return self._indexed_events(self._episode_index.event_series.find(keys))
+
+	def autorec_matches(self,entry):
+		"""The events in the EPG that entry (an HTSPAutoRecordEntry or autorec id) would record, in start order
+
+		This is predicted from the cached EPG, so needs fetch_initial_data(events=True)"""
+
+		self._ensure_initial_data()
+
+		return self._autorec_matches(entry.id if isinstance(entry,HTSPAutoRecordEntry) else entry)
+
+	def autorec_preview(self):
+		"""A dict of the enabled autorec entries' ids to the events in the EPG each would record, in start order"""
+
+		self._ensure_initial_data()
+
+		return dict((entry_id,self.autorec_matches(entry_id)) for (entry_id,entry) in self._auto_record_entries.items() if entry._message.get('enabled',1))
+
+	def event_autorecs(self,event):
+		"""The autorec entries that match event (an HTSPEvent or event id)"""
+		return self._event_autorecs(event.id if isinstance(event,HTSPEvent) else event)
+
 	def create_dvr_entry(self):
 		"""Create a new HTSPDVREntry instance"""
 		return HTSPDVREntry(self,None)
@@ -849,6 +1126,242 @@ class HTSPSession:
 		HTSPSession._check_response(message)
 		return self._dvr_entries[message["id"]]
 
+	def send_command(self,method,args=None):
+		"""Issue an htsp command without waiting for the reply and return an HTSPCommandFuture for it
+
+		Any number of commands may be outstanding, replies are matched to them by sequence number"""
+
+		args=dict(args) if args else {}
+
+		_logger.debug('> %s:%s',method,args)
+
+		sequence=self._sequence
+		self._sequence+=1
+
+		future=HTSPCommandFuture(self,method,sequence)
+		self._pending[sequence]=future
+
+		args['seq']=sequence
+		try:
+			self._send(method,args)
+		except socket.error as e:
+			self._connection_lost(e)
+			raise
+
+		return future
+
+	def get_events(self,event_ids):
+		"""Get the events with the given ids, as an array of HTSPEvent instances (None for unknown ids)
+
+		Without a full EPG the getEvent requests are pipelined, costing one round trip in total"""
+
+		if self._events!=None:
+			return map(lambda event_id:self._events.get(event_id,None),event_ids)
+
+		events=map(self._event_cache.get,event_ids)
+		if None in events:
+			self._check_connection()
+		futures=[(i,self.send_command('getEvent',{'eventId':event_id})) for (i,event_id) in enumerate(event_ids) if events[i] is None]
+
+		for (i,future) in futures:
+			message=future.result()
+			events[i]=None if 'error' in message else self._handle_eventAdd(message)
+		return events
+
+	def iter_events(self,channel,start=None,max_time=None,page=100,prefetch=True):
+		"""Iterate over the events on channel (an HTSPChannel or channel id) in start order
+
+		Iteration begins at the current event, or at start (an HTSPEvent or event id) if given,
+		and ends with the last event starting before max_time (a datetime or UNIX time) if given.
+		Without a full EPG the events are fetched page events at a time with getEvents, yielding
+		each page as it arrives, and if prefetch the request for the next page is sent before
+		the current page is yielded"""
+
+		self._checkProtocol(4)
+
+		channel_id=HTSPSession._channel_id(channel)
+		start_id=start.id if isinstance(start,HTSPEvent) else start
+		max_time=HTSPSession._timestamp(max_time) if max_time is not None else None
+
+		if self._events!=None:
+			event_ids=self._epg_index.events(channel_id)
+			if start_id is not None:
+				event_ids=event_ids[event_ids.index(start_id):] if start_id in event_ids else []
+			elif event_ids:
+				now=self._epg_index.event_at(channel_id,time.time())
+				event_ids=event_ids[event_ids.index(now):] if now is not None else event_ids
+			for event_id in event_ids:
+				event=self._events[event_id]
+				if max_time is not None and event._message['start']>max_time:
+					return
+				yield event
+			return
+
+		def request(anchor):
+			# the page following anchor (the last event of the previous page) starts with anchor
+			args={'numFollowing':page+1 if anchor is not None else page}
+			if anchor is not None:
+				args['eventId']=anchor
+			elif start_id is not None:
+				args['eventId']=start_id
+			else:
+				args['channelId']=channel_id
+			if max_time is not None:
+				args['maxTime']=max_time
+			return self.send_command('getEvents',args)
+
+		anchor=None
+		future=request(anchor)
+		while future is not None:
+			message=future.result()
+			if 'error' in message:
+				raise RequestError(message['error'])
+
+			events=[event for event in message.get('events',[]) if event['eventId']!=anchor]
+			if not events:
+				return
+			anchor=events[-1]['eventId']
+
+			future=request(anchor) if prefetch else None
+			for event in events:
+				yield self._handle_eventAdd(event)
+			if not prefetch:
+				future=request(anchor)
+
+	def events_between(self,channel,start,stop):
+		"""Get the events on channel (an HTSPChannel or channel id) overlapping start to stop, in start order
+
+		start and stop are datetimes or UNIX times. With the EPG collected by fetch_initial_data
+		this is a lookup in the per channel EPG index, rather than a scan of every event"""
+
+		return self._get_events_between(HTSPSession._channel_id(channel),HTSPSession._timestamp(start),HTSPSession._timestamp(stop))
+
+	def event_at(self,channel,t):
+		"""Get the event on channel (an HTSPChannel or channel id) at t (a datetime or UNIX time), or None"""
+
+		channel_id=HTSPSession._channel_id(channel)
+		t=HTSPSession._timestamp(t)
+
+		if self._events!=None:
+			event_id=self._epg_index.event_at(channel_id,t)
+			return self._events[event_id] if event_id is not None else None
+
+		events=self._get_events_between(channel_id,t,t+1)
+		return events[0] if events else None
+
+	def grid(self,start,stop,channels=None,columnar=False):
+		"""Get the events overlapping start to stop on each of channels (HTSPChannels or ids, default all)
+
+		Returns a dict of channel id to a list of HTSPEvent instances in start order, or if columnar
+		an HTSPGrid. Channels with no events in the EPG index are fetched with getEvents requests,
+		pipelined so they cost one round trip in total"""
+
+		start=HTSPSession._timestamp(start)
+		stop=HTSPSession._timestamp(stop)
+		channel_ids=self._grid_channels(channels)
+
+		missing=[channel_id for channel_id in channel_ids if not self._epg_index.has_channel(channel_id)]
+		fetched=self._fetch_events([(channel_id,{'channelId':channel_id,'maxTime':stop}) for channel_id in missing])
+
+		rows={}
+		for channel_id in channel_ids:
+			if channel_id in fetched:
+				rows[channel_id]=[event for event in fetched[channel_id] if event._message['stop']>start and event._message['start']<stop]
+			else:
+				rows[channel_id]=[self._events[event_id] for event_id in self._epg_index.events_between(channel_id,start,stop)]
+
+		if not columnar:
+			return rows
+
+		grid=HTSPGrid(start,stop)
+		for channel_id in channel_ids:
+			grid.add_row(channel_id,rows[channel_id])
+		return grid
+
+	def now_next(self,t=None,channels=None):
+		"""Get the events on each of channels (HTSPChannels or ids, default all) at and after t (default now)
+
+		Returns a dict of channel id to a (now, next) tuple of HTSPEvent instances (or None).
+		Channels with no events in the EPG index are fetched with pipelined getEvent(s) requests"""
+
+		channel_ids=self._grid_channels(channels)
+		missing=[channel_id for channel_id in channel_ids if not self._epg_index.has_channel(channel_id)]
+
+		if t is None:
+			result=self._now_next_current(missing)
+			t=time.time()
+		else:
+			t=HTSPSession._timestamp(t)
+			result=self._now_next_fetch(missing,t)
+
+		for channel_id in channel_ids:
+			if not channel_id in result:
+				now=self._epg_index.event_at(channel_id,t)
+				following=self._epg_index.next_event(channel_id,self._events[now]._message['stop'] if now is not None else t)
+				result[channel_id]=(
+					self._events[now] if now is not None else None,
+					self._events[following] if following is not None else None)
+		return result
+
+	def search_events(self,query,channel=None,tag=None,start=None,stop=None,content_type=None):
+		"""Get the events whose title, summary or description contain every word of query, in start order
+
+		Words match case insensitively and as prefixes. The results can be limited to a channel
+		or tag (instances or ids), to events overlapping start to stop (datetimes or UNIX times)
+		and to a DVB content type (a content level 1 code, e.g. 0x10, matches all of its genres).
+		With the EPG collected by fetch_initial_data the search is answered from a local index,
+		otherwise it wraps HTSP epgQuery"""
+
+		channel_id=HTSPSession._channel_id(channel) if channel is not None else None
+		tag_id=tag.id if isinstance(tag,HTSPTag) else tag
+		start=HTSPSession._timestamp(start) if start is not None else None
+		stop=HTSPSession._timestamp(stop) if stop is not None else None
+
+		if self._events!=None:
+			events=[self._events[event_id] for event_id in self._search_index.search(query)]
+		else:
+			events=self.epg_query(query,channel_id,tag_id,content_type)
+
+		members=None
+		if tag_id is not None:
+			self._ensure_initial_data()
+			members=set(self._tag_index.channels(tag_id))
+
+		result=[]
+		for event in events:
+			message=event._message
+			if channel_id is not None and message['channelId']!=channel_id:
+				continue
+			if members is not None and not message['channelId'] in members:
+				continue
+			if start is not None and message['stop']<=start:
+				continue
+			if stop is not None and message['start']>=stop:
+				continue
+			if content_type is not None and not HTSPSession._content_type_matches(content_type,message.get('contentType',None)):
+				continue
+			result.append(event)
+
+		result.sort(key=lambda event:event._message['start'])
+		return result
+
+	def epg_query(self,query,channel=None,tag=None,content_type=None):
+		"""Search the EPG on the server, wraps HTSP epgQuery, returning an array of HTSPEvent instances"""
+
+		args={
+			'query':query
+			}
+		if channel is not None:
+			args['channelId']=HTSPSession._channel_id(channel)
+		if tag is not None:
+			args['tagId']=tag.id if isinstance(tag,HTSPTag) else tag
+		if content_type is not None:
+			args['contentType']=content_type
+
+		self._check_connection()
+		message=self._invoke_command('epgQuery',args)
+		return [event for event in self.get_events(message.get('eventIds',[])) if event is not None]
+
 	def cancel_dvr_entry(self,entry):
 		"""Cancels a DVR entry, wraps HTSP cancelDvrEntry"""
 		message=self._invoke_command('cancelDvrEntry',entry._as_cancel_dvr_entry_command())
@@ -857,18 +1370,99 @@ class HTSPSession:
 
 
 
+	def save_snapshot(self,path):
+		"""Save the cached metadata (including any EPG) to a snapshot file, see load_snapshot"""
+
+		self._ensure_initial_data()
+
+		(events,epg_window)=self._metadata_args if self._metadata_args else (False,None)
+		header={
+			'method'	: 'snapshot',
+			'version'	: HTSPSession._SNAPSHOT_VERSION,
+			'events'	: 1 if self._events!=None else 0,
+			'columnar'	: 1 if isinstance(self._events,EPGColumnStore) else 0,
+			}
+		if self._last_update:
+			header['lastUpdate']=self._last_update
+		if epg_window:
+			header['epgWindow']=epg_window
+
+		sections=[
+			('tagAdd',self._tags),
+			('channelAdd',self._channels),
+			('dvrEntryAdd',self._dvr_entries),
+			('autorecEntryAdd',self._auto_record_entries),
+			('eventAdd',self._events if self._events!=None else {}),
+			]
+
+		with open(path+'.tmp','wb') as f:
+			buf=htsmsg.encode(header)
+			for (method,responses) in sections:
+				for response in responses.values():
+					message=dict(response._message)
+					message.pop('seq',None)
+					message['method']=method
+					htsmsg.encode(message,buf)
+					if len(buf)>=65536:
+						f.write(buf)
+						del buf[:]
+			f.write(buf)
+		os.rename(path+'.tmp',path)
+
+	def load_snapshot(self,path,refresh=True):
+		"""Restore the cached metadata from a snapshot file written by save_snapshot
+
+		If refresh, the session then connects (authenticate first if required) and
+		resyncs, fetching only the EPG events changed since the snapshot was taken.
+		Returns False, leaving the session as it was, if the file is empty or cut short
+		(so holds no usable snapshot) and the initial data has to be fetched instead"""
+
+		with open(path,'rb') as f:
+			if os.fstat(f.fileno()).st_size==0:
+				_logger.warning('Empty snapshot: %s',path)
+				return False
+			data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+		try:
+			if not htsmsg.complete(data):
+				_logger.warning('Truncated snapshot: %s',path)
+				return False
+
+			messages=htsmsg.deserialize_all(data,self._lazy)
+			header=next(messages)
+			if header.get('method')!='snapshot' or header.get('version')!=HTSPSession._SNAPSHOT_VERSION:
+				raise Exception('Not a snapshot: {0}'.format(path))
+
+			self._reset_events(header['events'],header.get('columnar',0))
+			for message in messages:
+				self._handleMessage(message)
+		finally:
+			data.close()
+
+		self._last_update=header.get('lastUpdate',None)
+		self._metadata_args=(self._events!=None,header.get('epgWindow',None))
+		self._initial_data=True
+
+		if refresh:
+			self._resync()
+		return True
+
 	def monitor(self,callback):
 
-		if not self._initial_data:
-			self.fetch_initial_data()
+		self._ensure_initial_data()
 
 		self._callbacks.append(callback)
 
 		try:
 			while True:
-				message=self._recv()
-				n=self._handleMessage(message)
-				self._notify(message,n)
+				try:
+					self._pump()
+				except Exception as e:
+					if not self._reconnect_enabled:
+						raise
+					self._connection_lost(e)
+					self._reconnect()
+					continue
+				self._process_notifications()
 		except KeyboardInterrupt: 
 			self._callbacks.remove(callback)
 		except Exception as e:
@@ -879,7 +1473,7 @@ class HTSPSession:
 	def _get_channel(self,channel_id):
 		"""Get the channel with the given id, as an HTSPChannel instance"""
 
-		if channel_id in self._channels.keys():
+		if channel_id in self._channels:
 			return self._channels[channel_id]
 		else:
 			self._check_connection()
@@ -891,28 +1485,148 @@ class HTSPSession:
 
 			return self._handle_channelAdd(message)
 
+	def _dvr_recording(self,message):
+		"""The padded start and stop times, and the mux, of a recording of the dvr entry message"""
+		if 'start' in message:
+			(channel_id,start,stop)=(message['channel'],message['start'],message['stop'])
+		else:
+			event=self._get_event(message['eventId'])._message
+			(channel_id,start,stop)=(event['channelId'],event['start'],event['stop'])
+
+		start-=60*message.get('startExtra',0)
+		stop+=60*message.get('stopExtra',0)
+
+		# the mux of the channel's (first) service, channels without one get a tuner of their own
+		mux=None
+		channel=self._channels.get(channel_id,None)
+		if channel is not None and channel._message.get('services',None):
+			mux=HTSPService(self,channel._message['services'][0]).resource
+		return (start,stop,mux if mux else ('channel',channel_id))
+
+	def _get_event_dvr_entry(self,event_id):
+		entries=[self._dvr_entries[entry_id] for entry_id in self._dvr_links.entries(event_id) if entry_id in self._dvr_entries]
+		if not entries:
+			return None
+		entries.sort(key=lambda entry:entry._message.get('state',None) not in ('scheduled','recording'))
+		return entries[0]
+
+	def _resolve_dvr_episodes(self):
+		# the events of dvr entries that are not in the EPG are fetched (pipelined) once
+		unresolved=self._episode_index.unresolved()
+		events=self.get_events([event_id for (entry_id,event_id) in unresolved])
+		for ((entry_id,event_id),event) in zip(unresolved,events):
+			self._episode_index.resolve(entry_id,event._message if event is not None else None)
+
+	def _autorec_matches(self,rule_id):
+		# the engine matches the rules changed since it was last asked, so this writes as well as reads
+		return self._indexed_events(self._autorec_engine.matches(rule_id))
+
+	def _event_autorecs(self,event_id):
+		rule_ids=self._autorec_engine.rules(event_id)
+		return [self._auto_record_entries[rule_id] for rule_id in rule_ids if rule_id in self._auto_record_entries]
+
+	def _indexed_events(self,event_ids):
+		events=[self._events[event_id] for event_id in event_ids if self._events!=None and event_id in self._events]
+		events.sort(key=lambda event:event._message['start'])
+		return events
+
+	def _dvr_bucket(self,bucket):
+		return [self._dvr_entries[entry_id] for entry_id in self._dvr_index.bucket(bucket)]
+
+	def _get_tag_channels(self,tag_id,members):
+		listed=set(members)
+		channel_ids=list(members)+sorted(channel_id for channel_id in self._tag_index.channels(tag_id) if not channel_id in listed)
+		return map(self._get_channel,channel_ids)
+
+	def _get_channel_tags(self,channel_id):
+		return [self._tags[tag_id] for tag_id in self._tag_index.tags(channel_id) if tag_id in self._tags]
+
 	def _get_events(self,channel_id):
 		"""Get the list of events on the channel identified by channel_id"""
 
 		self._checkProtocol(4)
 
 		if self._events!=None:
-			events=filter(lambda event:event.channel.id==channel_id,self._events)
+			events=[self._events[event_id] for event_id in self._epg_index.events(channel_id)]
 		else:
-			messages=self._invoke_command('getEvents',{
-				'channelId':channel_id
-				})
-
-			events=map(lambda message:self._handle_eventAdd(message),messages['events'])
+			events=self._event_cache.get_channel(channel_id)
+			if events is None:
+				events=list(self.iter_events(channel_id))
+				self._event_cache.put_channel(channel_id,events)
 
 		return events
 
+	def _grid_channels(self,channels):
+		if channels is None:
+			return [channel.id for channel in sorted(self._channels.values(),key=lambda channel:channel.number)]
+		return map(HTSPSession._channel_id,channels)
+
+	def _fetch_events(self,requests):
+		"""Issue a pipelined getEvents for each (key, args) of requests, returning a dict of key to HTSPEvent instances"""
+		if requests:
+			self._check_connection()
+		futures=[(key,self.send_command('getEvents',args)) for (key,args) in requests]
+
+		result={}
+		for (key,future) in futures:
+			message=future.result()
+			result[key]=map(self._handle_eventAdd,message.get('events',[]))
+		return result
+
+	def _now_next_current(self,channel_ids):
+		# the channels know their current and next events, fetch them all in one go
+		event_ids=[]
+		for channel_id in channel_ids:
+			message=self._get_channel(channel_id)._message
+			event_ids.extend([message.get('eventId',None),message.get('nextEventId',None)])
+
+		wanted=[event_id for event_id in event_ids if event_id is not None]
+		events=dict(zip(wanted,self.get_events(wanted)))
+
+		result={}
+		for (i,channel_id) in enumerate(channel_ids):
+			result[channel_id]=(events.get(event_ids[2*i],None),events.get(event_ids[2*i+1],None))
+		return result
+
+	def _now_next_fetch(self,channel_ids,t):
+		# first the events up to t, which end with the event at t if there is one ...
+		fetched=self._fetch_events([(channel_id,{'channelId':channel_id,'maxTime':t}) for channel_id in channel_ids])
+
+		result={}
+		anchors=[]
+		for channel_id in channel_ids:
+			events=fetched[channel_id]
+			now=events[-1] if events and events[-1]._message['stop']>t else None
+			result[channel_id]=(now,None)
+			if events:
+				anchors.append((channel_id,{'eventId':events[-1].id,'numFollowing':1}))
+			else:
+				anchors.append((channel_id,{'channelId':channel_id,'numFollowing':1}))
+
+		# ... then the event following it
+		for (channel_id,events) in self._fetch_events(anchors).items():
+			now=result[channel_id][0]
+			after=now._message['stop'] if now else t
+			events=[event for event in events if event._message['start']>=after]
+			result[channel_id]=(now,events[0] if events else None)
+		return result
+
+	def _get_events_between(self,channel_id,start,stop):
+		if self._events!=None:
+			return [self._events[event_id] for event_id in self._epg_index.events_between(channel_id,start,stop)]
+
+		return [event for event in self._get_events(channel_id) if event._message['start']<stop and event._message['stop']>start]
+
 	def _get_event(self,event_id):
 		"""Get the event with the given id, as an HTSPEvent instance"""
 
 		if self._events!=None:
 			event=self._events[event_id]
 		else:
+			event=self._event_cache.get(event_id)
+			if event is not None:
+				return event
+
 			message=self._invoke_command('getEvent',{
 				'eventId':event_id
 				})
@@ -924,50 +1638,157 @@ class HTSPSession:
 
 	def _check_connection(self):
 		if not self._sock:
-			self.hello()
+			self._connect()
 
+	def _connect(self):
+		"""Say hello on a new connection, authenticating again if the session had authenticated
 
-	def _enable_async_metadata(self,events):
+		The digest is bound to the challenge of the hello, so it has to be computed afresh"""
+		self.hello()
+		if self._user:
+			self.authenticate(self._user,self._password)
+
+	def close(self):
+		"""Close the connection"""
+		self._closed=True
+		if self._sock:
+			self._sock.close()
+			self._connection_lost(Exception('Connection closed'))
+
+	def _enable_async_metadata(self,events,epg_window=None):
 		_logger.info('Fetching initial data')
-		self._invoke_command('enableAsyncMetadata',{
+
+		args={
 			'epg':1 if events else 0
-			})
+			}
+		if events and epg_window:
+			args['epgMaxTime']=int(time.time())+epg_window
 
+		if events and self.protocol_version>=6:
+			# events changed after this can be fetched incrementally after a reconnect
+			self._last_update=self.system_time.time
 
-	def _invoke_command(self,method,args={}):
+		self._metadata_args=(events,epg_window)
+		self._invoke_command('enableAsyncMetadata',args)
 
-		_logger.debug('> {0}:{1}'.format(method,args))
+	def _ensure_initial_data(self):
+		"""Fetch the initial data unless it has been"""
+		if not self._initial_data:
+			self.fetch_initial_data()
 
-		if self._command_pending:
-			raise Exception("A command is already pending: {0}".format(method))
+	def _wait_for_initial_data(self):
+		while not self._initial_data:
+			self._pump()
+			self._process_notifications(notify=False)
 
-		self._command_pending=True
+	def _connection_lost(self,exception):
+		"""Forget the connection, failing any outstanding commands"""
+		_logger.warning('Connection lost: %s',exception)
+		sock,self._sock=self._sock,None
+		self._hello=None
+		self._digest=None
+		if sock:
+			try:
+				sock.close()
+			except socket.error:
+				pass
+		pending,self._pending=self._pending,{}
+		for future in pending.values():
+			future._set_exception(exception)
+
+	def _reconnect(self):
+		"""Reconnect, backing off exponentially between attempts, and resync the metadata"""
+		delay=1
+		while not self._closed:
+			try:
+				self._resync()
+				return
+			except Exception as e:
+				self._connection_lost(e)
+				_logger.warning('Reconnect failed, retrying in %ss',delay)
+				time.sleep(delay)
+				delay=min(delay*2,self._max_backoff)
+
+	def _resync(self):
+		"""Re-authenticate and reconcile the cached metadata with the server
+
+		Tags, channels, dvr and autorec entries are resent in full by the server, so
+		anything not resent has been deleted. EPG events are only fetched if they changed
+		since the previous sync (lastUpdate), ended events are dropped. Callbacks are
+		then notified of the real changes only"""
 
-		args['seq']=self._sequence
-		self._send(method,args)
+		if not self._sock:
+			self._connect()
 
-		message=self._recv()
-		_logger.debug('< {0}'.format(message))
+		if not self._metadata_args:
+			return
 
-		notify_queue=[]
-		while not 'seq' in message:
-			notify_queue.append(message)
-			message=self._recv()
+		(events,epg_window)=self._metadata_args
+		last_update=self._last_update
 
-		if message['seq'] != self._sequence:
-			raise Exception("Message out of sequence")
+		self._resync_seen=dict((kind,set()) for kind in HTSPSession._RESYNC_KINDS)
+		self._resync_changes=[]
+		self._initial_data=False
+		try:
+			if events and last_update and self.protocol_version>=6:
+				args={'epg':1,'lastUpdate':last_update}
+				if epg_window:
+					args['epgMaxTime']=int(time.time())+epg_window
+				self._last_update=self.system_time.time
+				self._invoke_command('enableAsyncMetadata',args)
+			else:
+				self._enable_async_metadata(events,epg_window)
+			self._wait_for_initial_data()
+		finally:
+			changes,self._resync_changes=self._resync_changes,[]
+			self._resync_seen=None
 
-		self._sequence+=1
+		_logger.info('Resynced: %d changes',len(changes))
+		self._notify_changes(changes)
 
-		self._command_pending=False
+	def _notify_changes(self,changes):
+		for (method,notification) in changes:
+			self._notify({'method':method},notification)
 
-		for queued_message in notify_queue:
-			n=self._handleMessage(queued_message)
-			self._notify(queued_message,n)
 
+	def _invoke_command(self,method,args={}):
+		return self.send_command(method,args).result()
+
+	def _wait(self,future):
+		"""Receive and dispatch messages until future is done, forgetting the connection if it fails"""
+		while not future.done():
+			try:
+				self._pump()
+			except Exception as e:
+				self._connection_lost(e if not isinstance(e,StopIteration) else Exception('Connection closed'))
+				raise
+
+	def _pump(self):
+		"""Receive and dispatch one message"""
+		self._dispatch(self._recv())
+
+	def _dispatch(self,message):
+		"""Complete the command a message replies to, or queue it as a notification"""
+		if 'seq' in message:
+			_logger.debug('< %s',message)
+			future=self._pending.pop(message['seq'],None)
+			if future is not None:
+				future._set_result(message)
+			else:
+				_logger.warning("Reply rxed for an unknown sequence: %s",message['seq'])
+		else:
+			self._notify_queue.append(message)
 
-		return message
+	def _call_soon(self,fn,future):
+		"""Call fn(future) for a future that is already done, on the thread that runs callbacks"""
+		fn(future)
 
+	def _process_notifications(self,notify=True):
+		while self._notify_queue:
+			message=self._notify_queue.popleft()
+			n=self._handleMessage(message)
+			if notify:
+				self._notify(message,n)
 
 	def _send ( self, method, args = {} ):
 		args['method'] = method
@@ -975,106 +1796,279 @@ class HTSPSession:
 			args['username'] = self._user
 		if self._digest: 
 			args['digest']   = htsmsg.hmf_bin(self._digest)
-		self._sock.send(htsmsg.serialize(args))
+		self._sock.sendall(htsmsg.encode(args))
 
 	def _recv ( self ):
-		return  htsmsg.deserialize(self._sock, False)
+		return self._reader.next()
 
 	def _checkProtocol(self,required_version):
 		if (self.protocol_version<required_version):
 			raise ProtocolVersionException("HTSP version %s required, but the server only supports version %s"%(required_version,self.protocol_version))
 
 	def _handle_initialSyncCompleted(self,message):
+		if self._resync_seen is not None:
+			self._finish_resync()
 		self._initial_data=True
 
+	def _finish_resync(self):
+		for (kind,responses) in [
+				('tag',self._tags),
+				('channel',self._channels),
+				('dvrEntry',self._dvr_entries),
+				('autorecEntry',self._auto_record_entries)]:
+			seen=self._resync_seen[kind]
+			for response_id in [response_id for response_id in responses if not response_id in seen]:
+				self._resync_changes.append((kind+'Delete',self._remove_response(kind,responses,response_id)))
+
+		if self._events!=None:
+			now=time.time()
+			for event in [event for event in self._events.values() if event._message.get('stop',now)<now]:
+				self._resync_changes.append(('eventDelete',self._remove_response('event',self._events,event.id)))
+
+	def _add_response(self,kind,responses,response):
+		"""Add response to responses, or while resyncing reconcile it with the instance already held"""
+		if self._resync_seen is not None:
+			if kind in self._resync_seen:
+				self._resync_seen[kind].add(response.id)
+			old=responses.get(response.id,None)
+			if old is not None:
+				changed=HTSPSession._changed_fields(old._message,response._message)
+				# the resent message replaces the one held, so fields it lacks are gone
+				for key in old._message.keys():
+					if not key in response._message and not key in HTSPSession._ENVELOPE_FIELDS:
+						changed[key]=None
+				if changed:
+					old._message=response._message
+					responses[response.id]=old
+					self._index_response(kind,old)
+					self._state.record(kind,'update',old.id,old,changed)
+					self._resync_changes.append((kind+'Update',old))
+				return old
+			self._resync_changes.append((kind+'Add',response))
+		existed=response.id in responses
+		responses[response.id]=response
+		self._index_response(kind,response)
+		self._state.record(kind,'add',response.id,response,response._message,existed)
+		return response
+
+	def _update_response(self,kind,responses,response):
+		old=responses[response.id]
+		changed=HTSPSession._update_reponse(old,response)
+		responses[response.id]=old
+		self._index_response(kind,old)
+		self._state.record(kind,'update',old.id,old,changed)
+		return old
+
+	def _remove_response(self,kind,responses,response_id):
+		response=responses.pop(response_id,None)
+		if response is not None:
+			self._unindex_response(kind,response)
+			self._state.record(kind,'delete',response_id,None,None)
+		return response
+
+	def _index_response(self,kind,response):
+		"""Bring the indexes over responses of kind up to date with a new or changed response"""
+		if kind=='tag':
+			self._tag_index.set_tag_members(response.id,response._message.get('members',()))
+		elif kind=='channel':
+			self._tag_index.set_channel_tags(response.id,response._message.get('tags',()))
+		elif kind=='event':
+			# the indexes read most of the fields, a lazy message is decoded for them in one pass
+			message=HTSPSession._decoded(response._message)
+			event_id=message['eventId']
+			self._epg_index.add(event_id,message['channelId'],message['start'],message['stop'])
+			self._search_index.add(event_id,[message.get(field,None) for field in HTSPSession._SEARCH_FIELDS])
+			self._episode_index.add_event(event_id,message)
+			self._dvr_links.set_event_entry(event_id,message.get('dvrId',None))
+			self._autorec_engine.add_event(event_id,message)
+		elif kind=='dvrEntry':
+			message=HTSPSession._decoded(response._message)
+			entry_id=message['id']
+			self._dvr_index.add(entry_id,message.get('state',None),message['start'],message['stop'])
+			self._episode_index.add_dvr_entry(entry_id,message)
+			self._dvr_links.set_entry_event(entry_id,message.get('eventId',None))
+			if message.get('state',None) in ('scheduled','recording'):
+				(start,stop,mux)=self._dvr_recording(message)
+				self._dvr_conflicts.add(entry_id,start,stop,mux)
+			else:
+				self._dvr_conflicts.remove(entry_id)
+		elif kind=='autorecEntry':
+			self._autorec_engine.add_rule(response.id,response._message)
+
+	def _unindex_response(self,kind,response):
+		"""Remove a response of kind from the indexes"""
+		if kind=='tag':
+			self._tag_index.remove_tag(response.id)
+		elif kind=='channel':
+			self._tag_index.remove_channel(response.id)
+		elif kind=='event':
+			self._epg_index.remove(response.id)
+			self._search_index.remove(response.id)
+			self._episode_index.remove_event(response.id)
+			self._dvr_links.set_event_entry(response.id,None)
+			self._autorec_engine.remove_event(response.id)
+		elif kind=='dvrEntry':
+			self._dvr_index.remove(response.id)
+			self._dvr_conflicts.remove(response.id)
+			self._episode_index.remove_dvr_entry(response.id)
+			self._dvr_links.set_entry_event(response.id,None)
+		elif kind=='autorecEntry':
+			self._autorec_engine.remove_rule(response.id)
+
+	def _reset_events(self,events,columnar=False):
+		self._event_cache.clear()
+		self._episode_index.clear_events()
+		self._dvr_links.clear_events()
+		self._autorec_engine.clear_events()
+		self._state.reset_events(events and not columnar)
+		if not events:
+			self._events=None
+		elif columnar:
+			self._events=EPGColumnStore(lambda message:HTSPEvent(self,message))
+		else:
+			self._events={}
+		self._epg_index=EPGIndex()
+		self._search_index=EPGSearchIndex()
+
+	def _capture_state(self):
+		"""Start keeping the versioned maps the snapshots are taken from, from the responses held now"""
+		self._state.capture({
+			'tag'			: self._tags.items(),
+			'channel'		: self._channels.items(),
+			'event'			: self._events.items() if type(self._events) is dict else (),
+			'dvrEntry'		: self._dvr_entries.items(),
+			'autorecEntry'	: self._auto_record_entries.items(),
+			})
+
 	def _handle_tagAdd(self,message):
-		tag=HTSPTag(self,message)
-		self._tags[tag.id]=tag
-		return tag
+		return self._add_response('tag',self._tags,HTSPTag(self,message))
 
 	def _handle_tagUpdate(self,message):
-		new=HTSPTag(self,message)
-		old=self._tags[new.id]
-		HTSPSession._update_reponse(old,new)
-		return old
+		return self._update_response('tag',self._tags,HTSPTag(self,message))
+
+	def _handle_tagDelete(self,message):
+		return self._remove_response('tag',self._tags,HTSPTag(self,message).id)
 
 	def _handle_channelAdd(self,message):
-		channel=HTSPChannel(self,message)
-		self._channels[channel.id]=channel
-		return channel
+		return self._add_response('channel',self._channels,HTSPChannel(self,message))
 
 	def _handle_channelUpdate(self,message):
-		new =HTSPChannel(self,message)
-		old=self._channels[new.id]
-		HTSPSession._update_reponse(old,new)
-		return old
+		return self._update_response('channel',self._channels,HTSPChannel(self,message))
 
+	def _handle_channelDelete(self,message):
+		return self._remove_response('channel',self._channels,HTSPChannel(self,message).id)
 
 	def _handle_eventAdd(self,message):
 		event=HTSPEvent(self,message)
 		if self._events!=None:
-			self._events[event.id]=event
+			return self._add_response('event',self._events,event)
+		if not 'error' in message:
+			self._event_cache.put(event)
+		return event
+
+	def _handle_eventUpdate(self,message):
+		event=HTSPEvent(self,message)
+		if self._events!=None:
+			if event.id in self._events:
+				return self._update_response('event',self._events,event)
+			return self._add_response('event',self._events,event)
+		self._event_cache.discard(event.id)
 		return event
 
 	def _handle_eventDelete(self,message):
+		self._event_cache.discard(message['eventId'])
 		if self._events!=None:
 			event=HTSPEvent(self,message)
 			if event.id in self._events:
-				return self._events.pop(event.id,None)
+				return self._remove_response('event',self._events,event.id)
 			else:
 				_logger.warning("eventDelete rxed for an unknown event")	
-		else:
-			_logger.warning("eventDelete rxed but no event map")
 
 	def _handle_dvrEntryAdd(self,message):
-		entry=HTSPDVREntry(self,message)
-		#print "_handle_dvrEntryAdd: id=%s"%(entry.id)
-		self._dvr_entries[entry.id]=entry
-		return entry
+		return self._add_response('dvrEntry',self._dvr_entries,HTSPDVREntry(self,message))
 
 	def _handle_dvrEntryDelete(self,message):
 		entry=HTSPDVREntry(self,message)
 		if entry.id in self._dvr_entries:
-			return self._dvr_entries.pop(entry.id,None)
+			return self._remove_response('dvrEntry',self._dvr_entries,entry.id)
 
 	def _handle_dvrEntryUpdate(self,message):
-
-		new=HTSPDVREntry(self,message)
-		old=self._dvr_entries[new.id]
-		HTSPSession._update_reponse(old,new)
-		return old
+		return self._update_response('dvrEntry',self._dvr_entries,HTSPDVREntry(self,message))
 
 	def  _handle_autorecEntryAdd(self,message):
-		entry=HTSPAutoRecordEntry(self,message)
-		self._auto_record_entries[entry.id]=entry
-		return entry
+		return self._add_response('autorecEntry',self._auto_record_entries,HTSPAutoRecordEntry(self,message))
 
 	def _handle_autorecEntryUpdate(self,message):
-		new=HTSPAutoRecordEntry(self,message)
-		old=self._auto_record_entries[new.id]
-		HTSPSession._update_reponse(old,new)
-		return old
+		return self._update_response('autorecEntry',self._auto_record_entries,HTSPAutoRecordEntry(self,message))
+
+	def _handle_autorecEntryDelete(self,message):
+		return self._remove_response('autorecEntry',self._auto_record_entries,HTSPAutoRecordEntry(self,message).id)
 
 	def _handleMessage(self,message):
 		if 'method' in message:
 			method='_handle_'+message['method']
-			if hasattr(HTSPSession,method):
-				fn=getattr(HTSPSession,method)
-				return fn(self,message)
+			if hasattr(self,method):
+				fn=getattr(self,method)
+				return fn(message)
 			else:
 				pass
 				print "Not handled: %s: %s"%(method,message)
 
+	_RESYNC_KINDS=('tag','channel','dvrEntry','autorecEntry')
+
+	_SEARCH_FIELDS=('title','summary','description')
+
+	# fields of the messages that are not part of the response they carry
+	_ENVELOPE_FIELDS=frozenset(['method','seq'])
+
+	_SNAPSHOT_VERSION=1
+
 	@staticmethod
 	def _htsp_digest ( user, passwd, chal ):
 		return hashlib.sha1(passwd + chal).digest()
 
 	@staticmethod
 	def _update_reponse(old,new):
+		# the message is replaced rather than modified, it may be shared with a snapshot; copying
+		# a view keeps the fields the update does not touch encoded
+		message=old._message.copy()
+		changed={}
 		for (key,value) in new._message.items():
 			if value:
 				#print "update key=%s old value=%s new value=%s"%(key,old._message[key] if key in old._message else "N/A",new._message[key])
-				old._message[key]=new._message[key]
+				if not key in HTSPSession._ENVELOPE_FIELDS and message.get(key,None)!=value:
+					changed[key]=value
+				message[key]=new._message[key]
+		old._message=message
+		return changed
+
+	@staticmethod
+	def _decoded(message):
+		"""message as a dict, decoding a lazy HTSMSGView in one pass"""
+		return message.decode() if isinstance(message,htsmsg.HTSMSGView) else message
+
+	@staticmethod
+	def _changed_fields(old,new):
+		return dict((key,value) for (key,value) in new.items() if old.get(key,None)!=value and not key in HTSPSession._ENVELOPE_FIELDS)
+
+	@staticmethod
+	def _channel_id(channel):
+		return channel.id if isinstance(channel,HTSPChannel) else channel
+
+	@staticmethod
+	def _timestamp(value):
+		"""value as a UNIX time, a datetime is taken to be local time like those the responses return"""
+		if isinstance(value,datetime.datetime):
+			return HTSPResponse._timestamp_from_datetime(value)
+		return value
+
+	@staticmethod
+	def _content_type_matches(content_type,event_content_type):
+		if event_content_type is None:
+			return False
+		if content_type&0x0f:
+			return event_content_type==content_type
+		return event_content_type&0xf0==content_type
 
 	@staticmethod
 	def _check_response(message):
@@ -0,0 +1,266 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Versioned, copy-on-write state of an HTSPSession, for lock-free readers"""
+
+import collections
+import itertools
+import threading
+
+
+class FrozenMap(collections.Mapping):
+	"""An immutable version of a VersionedMap, sharing its shards with the other versions"""
+
+	def __init__(self,shards,size):
+		self._shards=shards
+		self._size=size
+
+	def __len__(self):
+		return self._size
+
+	def __getitem__(self,key):
+		return self._shards[hash(key)%len(self._shards)][key]
+
+	def __contains__(self,key):
+		return key in self._shards[hash(key)%len(self._shards)]
+
+	def __iter__(self):
+		return itertools.chain.from_iterable(self._shards)
+
+	def get(self,key,default=None):
+		return self._shards[hash(key)%len(self._shards)].get(key,default)
+
+
+class VersionedMap(object):
+	"""A map that can be frozen into FrozenMap versions sharing its unchanged parts
+
+	The keys are spread over shards by hash. Freezing costs in proportion to the number
+	of shards, after which the first change to a shard copies it, so each version
+	costs in proportion to what changed since the one before."""
+
+	def __init__(self,shards=64):
+		self._shards=[{} for i in range(shards)]
+		self._owned=[True]*shards		# whether a shard is not shared with a frozen version
+		self._size=0
+		self._frozen=None
+
+	def __len__(self):
+		return self._size
+
+	def set(self,key,value):
+		shard=self._shard(key)
+		if not key in shard:
+			self._size+=1
+		shard[key]=value
+		self._frozen=None
+
+	def discard(self,key):
+		shard=self._shard(key)
+		if key in shard:
+			del shard[key]
+			self._size-=1
+			self._frozen=None
+
+	def clear(self):
+		self._shards=[{} for shard in self._shards]
+		self._owned=[True]*len(self._shards)
+		self._size=0
+		self._frozen=None
+
+	def freeze(self):
+		"""The current version as a FrozenMap, the same instance until the map changes"""
+		if self._frozen is None:
+			self._frozen=FrozenMap(tuple(self._shards),self._size)
+			self._owned=[False]*len(self._shards)
+		return self._frozen
+
+	def _shard(self,key):
+		i=hash(key)%len(self._shards)
+		if not self._owned[i]:
+			self._shards[i]=dict(self._shards[i])
+			self._owned[i]=True
+		return self._shards[i]
+
+
+class SessionSnapshot(object):
+	"""An immutable view of the responses held by an HTSPSession at one version
+
+	tags, channels, events, dvr_entries and auto_record_entries are FrozenMaps of ids to
+	responses as they were at the version; events is None when the session does not
+	cache the EPG, or caches it columnar. Snapshots can be read from any thread."""
+
+	__slots__=('version','tags','channels','events','dvr_entries','auto_record_entries')
+
+	def __init__(self,version,tags,channels,events,dvr_entries,auto_record_entries):
+		self.version=version
+		self.tags=tags
+		self.channels=channels
+		self.events=events
+		self.dvr_entries=dvr_entries
+		self.auto_record_entries=auto_record_entries
+
+
+class Change(collections.namedtuple('Change',('version','kind','action','id','fields'))):
+	"""A change to a response: action is 'add' (fields are its message), 'update' (the changed fields) or 'delete'"""
+	__slots__=()
+
+
+class ChangeDelta(collections.namedtuple('ChangeDelta',('version','resync','changes'))):
+	"""The Changes up to version since the version asked for, or resync if they are no longer known"""
+	__slots__=()
+
+
+class ChangeJournal(object):
+	"""A bounded ring of the most recent Changes, in version order
+
+	Each Change is held with whether its response existed before it, so that compact
+	knows what a client holding the version before a window of changes has."""
+
+	def __init__(self,size):
+		self._changes=collections.deque(maxlen=size)
+		self._floor=0		# changes up to this version are no longer known
+
+	def __len__(self):
+		return len(self._changes)
+
+	def append(self,change,existed):
+		if len(self._changes)==self._changes.maxlen:
+			self._floor=self._changes[0][0].version
+		self._changes.append((change,existed))
+
+	def reset(self,version):
+		"""Forget the changes up to version (e.g. when they can no longer be told apart)"""
+		self._changes.clear()
+		self._floor=version
+
+	def since(self,version):
+		"""The (Change, existed before it) after version, None if some are no longer known"""
+		if version<self._floor:
+			return None
+		first=self._changes[0][0].version if self._changes else self._floor+1
+		return list(itertools.islice(self._changes,max(version+1-first,0),None))
+
+	@staticmethod
+	def compact(entries):
+		"""Collapse the Changes (of (Change, existed before it) entries) to each response into one, ordered by their last change
+
+		Updates are merged into the add or update before them. A response that existed before
+		the first of its changes and not after the last is deleted, one that existed at neither
+		end is dropped, and one deleted and then added again is added, i.e. replaced."""
+		merged=collections.OrderedDict()
+		for (change,existed) in entries:
+			key=(change.kind,change.id)
+			if key in merged:
+				(base,action,fields,version)=merged.pop(key)
+			else:
+				(base,action,fields)=(existed,None,None)
+			if change.action=='update' and action in ('add','update'):
+				fields=dict(fields)
+				fields.update(change.fields)
+			else:
+				(action,fields)=(change.action,change.fields)
+			merged[key]=(base,action,fields,change.version)
+		return [Change(version,kind,action,response_id,fields) for ((kind,response_id),(base,action,fields,version)) in merged.items()
+			if base or action!='delete']
+
+
+class SessionState(object):
+	"""The versioned maps, by kind, of the responses held by an HTSPSession, and a journal of their changes
+
+	The session's writer path records each change here and readers take a
+	SessionSnapshot, in O(1) while nothing has changed since the last one, or the
+	changes since the version of one. The maps are only kept once capture() has been
+	called (on the first snapshot), until then recording a change costs its journal
+	entry alone. The maps hold a frozen version (response._frozen()) of each response,
+	sharing its message, which updates replace rather than modify."""
+
+	_KINDS=('tag','channel','event','dvrEntry','autorecEntry')
+
+	def __init__(self,journal_size=4096):
+		self._lock=threading.Lock()
+		self._maps=dict((kind,VersionedMap(256 if kind=='event' else 16)) for kind in SessionState._KINDS)
+		self._journal=ChangeJournal(journal_size)
+		self._events=False
+		self._capturing=False
+		self._version=0
+		self._snapshot=None
+
+	@property
+	def version(self):
+		"""Incremented by each change"""
+		return self._version
+
+	@property
+	def capturing(self):
+		"""True once the maps are kept for snapshots"""
+		return self._capturing
+
+	def capture(self,responses):
+		"""Start keeping the maps, from responses: a dict of kind to the (id, response) held now"""
+		with self._lock:
+			for (kind,items) in responses.items():
+				if kind!='event' or self._events:
+					versions=self._maps[kind]
+					versions.clear()
+					for (response_id,response) in items:
+						versions.set(response_id,response._frozen())
+			self._capturing=True
+			self._snapshot=None
+
+	def record(self,kind,action,response_id,response,fields,existed=None):
+		"""Record a response (None if deleted) added, updated or deleted, with its (changed) fields
+
+		existed tells whether the response was held before the change, by default unless added"""
+		if action=='update' and not fields:
+			return
+		with self._lock:
+			if self._capturing and (kind!='event' or self._events):
+				if response is None:
+					self._maps[kind].discard(response_id)
+				else:
+					self._maps[kind].set(response_id,response._frozen())
+			self._version+=1
+			self._snapshot=None
+			self._journal.append(Change(self._version,kind,action,response_id,fields),action!='add' if existed is None else existed)
+
+	def reset_events(self,events):
+		"""Forget every event, recording them from now on only if events"""
+		with self._lock:
+			self._maps['event'].clear()
+			self._events=bool(events)
+			self._version+=1
+			self._snapshot=None
+			self._journal.reset(self._version)
+
+	def snapshot(self):
+		snapshot=self._snapshot
+		if snapshot is None:
+			with self._lock:
+				if self._snapshot is None:
+					maps=self._maps
+					self._snapshot=SessionSnapshot(self._version,maps['tag'].freeze(),maps['channel'].freeze(),
+						maps['event'].freeze() if self._events else None,maps['dvrEntry'].freeze(),maps['autorecEntry'].freeze())
+				snapshot=self._snapshot
+		return snapshot
+
+	def changes_since(self,version):
+		with self._lock:
+			current=self._version
+			changes=self._journal.since(version) if version<=current else None
+		if changes is None:
+			return ChangeDelta(current,True,[])
+		return ChangeDelta(current,False,ChangeJournal.compact(changes))
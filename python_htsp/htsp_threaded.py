@@ -0,0 +1,250 @@
+# Copyright (c) 2014 d.charlton (https://github.com/dpcharlton)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial
+# portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT
+# NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Tvheadend HTSP sessions with a background receiver thread"""
+
+import collections
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+from tvh import htsmsg
+
+from htsp_session import HTSPCommandFuture, HTSPSession, NotConnectedError
+
+_logger = logging.getLogger(__name__)
+
+
+class ThreadedHTSPSession(HTSPSession):
+	"""HTSPSession whose socket is drained by a dedicated receiver thread
+
+	Replies complete their HTSPCommandFuture on the receiver thread and notifications
+	are applied there under the session lock, so any number of threads can issue
+	commands concurrently while monitoring continues. If reconnect is enabled, the
+	receiver thread is also the one that reconnects after the connection is lost,
+	commands issued meanwhile fail with NotConnectedError. HTSPFuture callbacks run on
+	the receiver thread too, those added to a future that is already done are handed
+	to it."""
+
+	def __init__ (self, host='localhost',port=9982, addr=None,name = 'python-htsp', lazy=False, reconnect=False, max_backoff=60, event_cache_size=1024, event_cache_ttl=300, journal_size=4096 ):
+		HTSPSession.__init__(self,host,port,addr,name,lazy,reconnect,max_backoff,event_cache_size,event_cache_ttl,journal_size)
+
+		self._lock=threading.RLock()
+		self._send_lock=threading.RLock()
+		self._cond=threading.Condition()
+		self._thread=None
+		self._error=None
+		self._reconnecting=False
+		self._soon=collections.deque()
+		self._wake=None
+
+	def hello(self):
+		"""Issue an htsp 'hello' command to the server and return an HTSPHello response instance"""
+		receiver=threading.current_thread() is self._thread
+		with self._send_lock:
+			if not self._sock:
+				if self._reconnecting and not receiver:
+					raise NotConnectedError('Reconnecting')
+				self._sock = socket.create_connection(self._addr)
+				self._reader = htsmsg.HTSMSGStreamReader(self._sock,lazy=self._lazy)
+				self._error = None
+			if not self._thread:
+				# written to hand callbacks to the receiver thread, which closes it when it ends
+				self._wake = os.pipe()
+				self._thread = threading.Thread(target=self._receive,name='htsp-receiver')
+				self._thread.daemon = True
+				self._thread.start()
+		return HTSPSession.hello(self)
+
+	def monitor(self,callback):
+		"""Call callback(method,notification) on the receiver thread for each notification received"""
+
+		if not self._initial_data:
+			self.fetch_initial_data()
+
+		with self._lock:
+			self._callbacks.append(callback)
+
+	def close(self):
+		"""Close the connection and stop the receiver thread"""
+		self._closed=True
+		sock,thread=self._sock,self._thread
+		if sock:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+			sock.close()
+		if thread and thread is not threading.current_thread():
+			thread.join()
+
+	def send_command(self,method,args=None):
+		"""Issue an htsp command without waiting for the reply and return an HTSPCommandFuture for it
+
+		While the session is not connected the future fails with NotConnectedError"""
+		with self._send_lock:
+			if not self._sock:
+				future=HTSPCommandFuture(self,method,None)
+				future._set_exception(NotConnectedError('Not connected'))
+				return future
+			return HTSPSession.send_command(self,method,args)
+
+	def _receive(self):
+		while True:
+			try:
+				while True:
+					self._dispatch(self._recv())
+			except Exception as e:
+				if not isinstance(e,StopIteration):
+					_logger.warning('htsp receiver stopped: %s',e)
+				self._connection_lost(e if not isinstance(e,StopIteration) else Exception('Connection closed'))
+
+			if self._reconnecting:
+				self._reconnect()
+
+			# carry on receiving if reconnected (here, or by hello on another thread), else end
+			with self._send_lock:
+				self._reconnecting=False
+				if not self._sock:
+					self._thread=None
+					wake,self._wake=self._wake,None
+					break
+
+		# no more callbacks are handed over once the thread is gone
+		for fd in wake:
+			os.close(fd)
+		self._run_soon()
+
+	def _recv(self):
+		# wait for a complete message, running the callbacks handed over meanwhile
+		reader=self._reader
+		while not reader.pending():
+			(readable,_,_)=select.select([self._sock,self._wake[0]],[],[])
+			if self._wake[0] in readable:
+				os.read(self._wake[0],4096)
+				self._run_soon()
+			if self._sock in readable:
+				reader.fill()
+		return reader.next()
+
+	def _call_soon(self,fn,future):
+		with self._send_lock:
+			if self._thread is not None and threading.current_thread() is not self._thread:
+				self._soon.append((fn,future))
+				os.write(self._wake[1],'\0')
+				return
+		fn(future)
+
+	def _run_soon(self):
+		while self._soon:
+			(fn,future)=self._soon.popleft()
+			try:
+				fn(future)
+			except Exception:
+				_logger.exception('HTSPFuture callback failed')
+
+	def _connection_lost(self,exception):
+		sock=self._sock
+		if sock:
+			# a sender blocked on the dead connection gives up the send lock
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+		with self._send_lock:
+			if threading.current_thread() is self._thread:
+				self._reconnecting=self._reconnect_enabled and not self._closed
+			HTSPSession._connection_lost(self,exception)
+		with self._cond:
+			self._error=exception
+			self._cond.notify_all()
+
+	def _check_receiver(self):
+		if self._error:
+			raise self._error
+
+	def _wait(self,future):
+		if threading.current_thread() is self._thread:
+			# e.g. a callback issuing a command, the receiver thread has to read the reply itself
+			HTSPSession._wait(self,future)
+			return
+
+		with self._cond:
+			while not future.done():
+				self._check_receiver()
+				self._cond.wait(1.0)
+
+	def _wait_until(self,predicate,timeout=None):
+		"""Wait until predicate() holds, re-testing it as messages are dispatched; False on timeout"""
+		deadline=time.time()+timeout if timeout else None
+		if threading.current_thread() is self._thread:
+			while not predicate():
+				if deadline and time.time()>deadline:
+					return False
+				self._pump()
+			return True
+
+		with self._cond:
+			while not predicate():
+				self._check_receiver()
+				if deadline and time.time()>deadline:
+					return False
+				self._cond.wait(1.0)
+		return True
+
+	def _wait_for_initial_data(self):
+		if threading.current_thread() is self._thread:
+			# e.g. resyncing after a reconnect, the receiver thread has to read the data itself
+			HTSPSession._wait_for_initial_data(self)
+			return
+
+		self._wait_until(lambda:self._initial_data)
+
+	def _notify_changes(self,changes):
+		with self._lock:
+			HTSPSession._notify_changes(self,changes)
+
+	def _capture_state(self):
+		# the receiver thread applies notifications under the lock
+		with self._lock:
+			HTSPSession._capture_state(self)
+
+	def _autorec_matches(self,rule_id):
+		with self._lock:
+			return HTSPSession._autorec_matches(self,rule_id)
+
+	def _event_autorecs(self,event_id):
+		with self._lock:
+			return HTSPSession._event_autorecs(self,event_id)
+
+	def _dispatch(self,message):
+		HTSPSession._dispatch(self,message)
+		if not 'seq' in message:
+			self._process_notifications(notify=self._initial_data)
+		with self._cond:
+			self._cond.notify_all()
+
+	def _process_notifications(self,notify=True):
+		if threading.current_thread() is not self._thread:
+			# the receiver thread handles them as they arrive
+			return
+		with self._lock:
+			HTSPSession._process_notifications(self,notify)
+
@@ -46,6 +46,7 @@ class HTSPClient:
 
     # Setup
     self._sock = socket.create_connection(addr)
+    self._reader = htsmsg.HTSMSGStreamReader(self._sock)
     self._name = name
     self._auth = None
     self._user = None
@@ -58,11 +59,11 @@ class HTSPClient:
     if self._pass: args['digest']   = htsmsg.hmf_bin(self._pass)
     log.debug('htsp tx:')
     log.debug(args, pretty=True)
-    self._sock.send(htsmsg.serialize(args))
+    self._sock.sendall(htsmsg.encode(args))
 
   # Receive
   def recv ( self ):
-    ret = htsmsg.deserialize(self._sock, False)
+    ret = self._reader.next()
     log.debug('htsp rx:')
     log.debug(ret, pretty=True)
     return ret
@@ -0,0 +1,194 @@
+"""A fake htsp server for the session tests"""
+
+import hashlib
+import os
+import socket
+import threading
+import time
+
+from python_htsp.tvh import htsmsg
+
+NOW=int(time.time())
+
+def make_data(channels=5,events=20):
+	"""The tags, channels, dvr entries, autorec entries and events the server holds
+
+	Each channel has events 30 minutes long from an hour ago, with ids from 1000 up"""
+	tags=[
+		{'method':'tagAdd','tagId':1,'tagName':'All','members':range(1,channels+1)},
+		{'method':'tagAdd','tagId':2,'tagName':'HD','members':[1,2]},
+		]
+	channel_list=[]
+	event_list=[]
+	event_id=1000
+	for channel_id in range(1,channels+1):
+		first=event_id
+		start=NOW-3600
+		for i in range(events):
+			event_list.append({'method':'eventAdd','eventId':event_id,'channelId':channel_id,'start':start,'stop':start+1800,
+				'title':'Show %d %d'%(channel_id,i),'summary':'Summary','description':'Show %d on channel %d'%(i,channel_id),
+				'nextEventId':event_id+1,'episodeUri':'ep://%d'%(i%7),'serieslinkUri':'sl://%d'%channel_id,'contentType':16})
+			event_id+=1
+			start+=1800
+		event_list[-1].pop('nextEventId')
+		channel_list.append({'method':'channelAdd','channelId':channel_id,'channelNumber':channel_id,'channelName':'Channel %d'%channel_id,
+			'eventId':first+2,'nextEventId':first+3,'tags':[1]+([2] if channel_id<=2 else []),
+			'services':[{'name':'Network/%d/Channel %d'%(500+channel_id%2,channel_id),'type':'SDTV'}]})
+	dvr_entries=[
+		{'method':'dvrEntryAdd','id':1,'channel':1,'start':NOW+3600,'stop':NOW+5400,'startExtra':2,'stopExtra':5,
+			'retention':31,'title':'Show 1 4','state':'scheduled','eventId':1004},
+		{'method':'dvrEntryAdd','id':2,'channel':2,'start':NOW-86400,'stop':NOW-84600,'startExtra':0,'stopExtra':0,
+			'retention':31,'title':'Old','state':'completed'},
+		{'method':'dvrEntryAdd','id':3,'channel':3,'start':NOW-86400,'stop':NOW-84600,'startExtra':0,'stopExtra':0,
+			'retention':31,'title':'Missed','state':'missed'},
+		]
+	autorec_entries=[
+		{'method':'autorecEntryAdd','id':'abc','enabled':1,'retention':0,'priority':2,'title':'Show 1','channel':1,
+			'daysOfWeek':0x7f,'approxTime':0,'minDuration':0,'maxDuration':0,'startExtra':0,'stopExtra':0},
+		]
+	return (tags,channel_list,dvr_entries,autorec_entries,event_list)
+
+def _reply_fields(message):
+	return dict((name,value) for (name,value) in message.items() if name!='method')
+
+
+class FakeServer(threading.Thread):
+	"""An htsp server on a free local port answering the commands the sessions use
+
+	Every connection gets its own challenge and, once a user is set, commands after
+	authenticate are refused unless they carry the digest for that challenge."""
+
+	def __init__(self,channels=5,events=20,user=None,password=None):
+		threading.Thread.__init__(self)
+		self.daemon=True
+		self.listener=socket.socket()
+		self.listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+		self.listener.bind(('127.0.0.1',0))
+		self.listener.listen(5)
+		self.port=self.listener.getsockname()[1]
+		(self.tags,self.channels,self.dvr_entries,self.autorec_entries,self.events)=make_data(channels,events)
+		self.user=user
+		self.password=password
+		self.received=[]
+		self.refused=[]
+		self.push=[]
+		self.sync_delay=0
+		self.notify_dvr=True
+		self.connections=[]
+		self.monitoring=[]
+		self.lock=threading.Lock()
+		self.start()
+
+	def run(self):
+		while True:
+			try:
+				(connection,_)=self.listener.accept()
+			except Exception:
+				return
+			self.connections.append(connection)
+			thread=threading.Thread(target=self._serve,args=(connection,))
+			thread.daemon=True
+			thread.start()
+
+	def drop(self):
+		"""Drop every connection"""
+		connections,self.connections=self.connections,[]
+		self.monitoring=[]
+		for connection in connections:
+			try:
+				connection.shutdown(socket.SHUT_RDWR)
+				connection.close()
+			except socket.error:
+				pass
+
+	def notify(self,message):
+		"""Send a notification to the connections that enabled async metadata"""
+		for connection in list(self.monitoring):
+			self._send(connection,message)
+
+	def close(self):
+		self.drop()
+		self.listener.close()
+
+	def _send(self,connection,message):
+		with self.lock:
+			connection.sendall(htsmsg.serialize(message))
+
+	def _serve(self,connection):
+		challenge=os.urandom(32)
+		try:
+			for message in htsmsg.HTSMSGStreamReader(connection):
+				self.received.append(message)
+				reply=self._reply(connection,message,challenge)
+				if reply is not None:
+					if 'seq' in message:
+						reply['seq']=message['seq']
+					self._send(connection,reply)
+		except Exception:
+			pass
+
+	def _authorized(self,message,challenge):
+		if self.user is None or message['method']=='hello':
+			return True
+		digest=hashlib.sha1(self.password+challenge).digest()
+		return message.get('username')==self.user and message.get('digest')==digest
+
+	def _reply(self,connection,message,challenge):
+		method=message['method']
+		if not self._authorized(message,challenge):
+			self.refused.append(message)
+			return {'noaccess':1}
+
+		if method=='hello':
+			return {'htspversion':25,'servername':'fake','serverversion':'1','challenge':htsmsg.hmf_bin(challenge),'servercapability':[]}
+		elif method=='authenticate':
+			return {}
+		elif method=='getSysTime':
+			return {'time':int(time.time()),'timezone':0}
+		elif method=='getDiskSpace':
+			return {'freediskspace':10,'totaldiskspace':100}
+		elif method=='enableAsyncMetadata':
+			self.monitoring.append(connection)
+			self._send(connection,{'seq':message['seq']})
+			for notification in self.tags+self.channels+self.dvr_entries+self.autorec_entries:
+				self._send(connection,notification)
+				time.sleep(self.sync_delay)
+			if message.get('epg'):
+				for event in self.events:
+					self._send(connection,event)
+			self._send(connection,{'method':'initialSyncCompleted'})
+			for notification in self.push:
+				self._send(connection,notification)
+			return None
+		elif method=='getEvent':
+			events=[event for event in self.events if event['eventId']==message['eventId']]
+			return _reply_fields(events[0]) if events else {'error':'Event does not exist'}
+		elif method=='getEvents':
+			events=self.events
+			if 'eventId' in message:
+				first=[i for (i,event) in enumerate(events) if event['eventId']==message['eventId']][0]
+				events=[event for event in events[first:] if event['channelId']==events[first]['channelId']]
+			elif 'channelId' in message:
+				events=[event for event in events if event['channelId']==message['channelId']]
+			if 'maxTime' in message:
+				events=[event for event in events if event['start']<=message['maxTime']]
+			if 'numFollowing' in message:
+				events=events[:message['numFollowing']+(1 if 'eventId' in message else 0)]
+			return {'events':map(_reply_fields,events)}
+		elif method=='getChannel':
+			channels=[channel for channel in self.channels if channel['channelId']==message['channelId']]
+			return _reply_fields(channels[0]) if channels else {'error':'Channel does not exist'}
+		elif method=='addDvrEntry':
+			entry={'method':'dvrEntryAdd','id':max(entry['id'] for entry in self.dvr_entries)+1,'channel':1,'start':NOW,'stop':NOW+60,
+				'startExtra':0,'stopExtra':0,'retention':1,'title':message.get('title',''),'state':'scheduled'}
+			if 'eventId' in message:
+				entry['eventId']=message['eventId']
+			self.dvr_entries.append(entry)
+			if self.notify_dvr:
+				self.notify(entry)
+			return {'success':1,'id':entry['id']}
+		elif method=='cancelDvrEntry':
+			return {'success':1}
+		elif method=='epgQuery':
+			return {'eventIds':[event['eventId'] for event in self.events if message['query'].lower() in event['title'].lower()]}
+		return {'error':'Unknown method'}
@@ -0,0 +1,69 @@
+"""Tests for AsyncHTSPSession"""
+
+import asyncore
+import unittest
+
+from python_htsp.htsp_async import AsyncHTSPSession
+from tests.support import FakeServer
+
+class AsyncSessionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=AsyncHTSPSession('127.0.0.1',self.server.port,map={})
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def test_future(self):
+		self.session.hello().result()
+		future=self.session.send_command('getDiskSpace')
+		self.assertFalse(future.done())
+		self.assertEqual(future.result()['freediskspace'],10)
+
+	def test_properties_wait_for_sync(self):
+		self.server.sync_delay=0.01
+		future=self.session.fetch_initial_data(events=True)
+		while not self.session._channels:
+			asyncore.loop(timeout=0.1,count=1,map=self.session._map)
+		self.assertFalse(future.done())
+		self.assertEqual(len(self.session.channels),5)
+		self.assertTrue(future.done())
+		self.assertEqual(len(self.session.scheduled),1)
+
+	def test_entity_properties_wait_for_sync(self):
+		self.server.sync_delay=0.01
+		self.session.fetch_initial_data(events=True)
+		while not self.session._channels:
+			asyncore.loop(timeout=0.1,count=1,map=self.session._map)
+		channel=self.session._channels[1]
+		self.assertEqual(len(channel.events),20)
+		self.assertEqual(channel.now.id,1002)
+
+	def test_properties_start_sync(self):
+		self.assertEqual(len(self.session.tags),2)
+
+	def test_sync_failure(self):
+		future=self.session.fetch_initial_data()
+		self.session.close()
+		self.assertRaises(Exception,future.result)
+
+class AsyncReauthenticateTest(unittest.TestCase):
+
+	def test_reconnect_on_demand(self):
+		server=FakeServer(user='user',password='secret')
+		session=AsyncHTSPSession('127.0.0.1',server.port,map={})
+		try:
+			session.authenticate('user','secret').result()
+			server.drop()
+			while session._sock:
+				asyncore.loop(timeout=0.1,count=1,map=session._map)
+			self.assertEqual(session.diskspace.free_disk_space,10)
+			self.assertEqual(server.refused,[])
+		finally:
+			session.close()
+			server.close()
+
+if __name__=='__main__':
+	unittest.main()
@@ -0,0 +1,59 @@
+"""Tests for the tag and channel indexes"""
+
+import unittest
+
+from python_htsp.htsp_channels import TagIndex
+from python_htsp.htsp_session import HTSPSession
+from tests.support import FakeServer
+
+class TagIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index=TagIndex()
+		self.index.set_channel_tags(1,[10,11])
+		self.index.set_channel_tags(2,[10])
+		self.index.set_tag_members(10,[1,3])
+
+	def test_both_sides(self):
+		self.assertEqual(sorted(self.index.channels(10)),[1,2,3])
+		self.assertEqual(sorted(self.index.tags(3)),[10])
+		self.assertEqual(sorted(self.index.tags(1)),[10,11])
+
+	def test_unlink(self):
+		# channel 1 is still a member of tag 10 once it no longer lists it
+		self.index.set_channel_tags(1,[11])
+		self.assertEqual(sorted(self.index.channels(10)),[1,2,3])
+		self.index.set_tag_members(10,[3])
+		self.assertEqual(sorted(self.index.channels(10)),[2,3])
+		self.index.remove_channel(2)
+		self.index.remove_tag(10)
+		self.assertEqual(self.index.channels(10),[])
+		self.assertEqual(self.index.tags(1),[11])
+
+class SessionTagTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.server.tags[1]['members']=[2,1]
+		self.server.channels[2]['tags'].append(2)
+		self.server.tags.append({'method':'tagAdd','tagId':3,'tagName':'Empty'})
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data()
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _tag(self,tag_id):
+		return [tag for tag in self.session.tags if tag.id==tag_id][0]
+
+	def test_tag_channels(self):
+		# members in the tag's order, then the other channels listing the tag
+		self.assertEqual([channel.id for channel in self._tag(2).channels],[2,1,3])
+		self.assertEqual(self._tag(3).channels,None)
+
+	def test_channel_tags(self):
+		self.assertEqual(sorted(tag.id for tag in self.session._get_channel(3).tags),[1,2])
+
+if __name__=='__main__':
+	unittest.main()
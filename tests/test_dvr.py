@@ -0,0 +1,450 @@
+"""Tests for the DVR entry indexes"""
+
+import random
+import unittest
+
+from python_htsp.htsp_dvr import AutorecEngine, DVRConflicts, DVRIndex, DVRLinks, EpisodeIndex, IntervalTree, KeyIndex
+from python_htsp.htsp_session import HTSPDVREntry, HTSPSession
+from tests.support import FakeServer, NOW
+
+class DVRIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index=DVRIndex()
+		for (entry_id,state,start,stop) in ((1,'scheduled',300,400),(2,'completed',0,100),(3,'recording',100,350),(4,'missed',50,60),(5,'completed',-100,0)):
+			self.index.add(entry_id,state,start,stop)
+
+	def test_buckets(self):
+		self.assertEqual(self.index.bucket('scheduled'),[3,1])
+		self.assertEqual(self.index.bucket('recorded'),[5,2])
+		self.assertEqual(self.index.bucket('failed'),[4])
+		self.assertEqual(self.index.bucket('invalid'),[])
+		self.assertEqual(len(self.index),5)
+
+	def test_between(self):
+		self.assertEqual(self.index.between(50,150),[2,4,3])
+		self.assertEqual(self.index.between(400,500),[])
+
+	def test_update_remove(self):
+		self.index.add(3,'completed',100,350)
+		self.assertEqual(self.index.bucket('scheduled'),[1])
+		self.assertEqual(self.index.bucket('recorded'),[5,2,3])
+		self.index.remove(2)
+		self.assertEqual(self.index.bucket('recorded'),[5,3])
+		self.assertEqual(self.index.between(0,100),[4])
+
+class DVRLinksTest(unittest.TestCase):
+
+	def setUp(self):
+		self.links=DVRLinks()
+		self.links.set_entry_event(1,10)
+		self.links.set_event_entry(11,2)
+
+	def test_sides(self):
+		self.assertEqual(self.links.entries(10),set([1]))
+		self.assertEqual(self.links.events(1),set([10]))
+		self.assertEqual(self.links.entries(11),set([2]))
+		self.assertEqual(self.links.events(2),set([11]))
+		self.assertEqual(self.links.entries(12),set())
+		self.links.set_entry_event(3,0)
+		self.assertEqual(self.links.events(3),set())
+
+	def test_either_side(self):
+		self.links.set_event_entry(10,1)
+		self.links.set_entry_event(1,None)
+		self.assertEqual(self.links.entries(10),set([1]))
+		self.links.set_event_entry(10,None)
+		self.assertEqual(self.links.entries(10),set())
+		self.assertEqual(self.links.events(1),set())
+
+	def test_relink(self):
+		self.links.set_entry_event(1,12)
+		self.links.set_event_entry(11,3)
+		self.assertEqual(self.links.entries(10),set())
+		self.assertEqual(self.links.entries(12),set([1]))
+		self.assertEqual(self.links.events(2),set())
+		self.assertEqual(self.links.events(3),set([11]))
+
+	def test_clear_events(self):
+		self.links.clear_events()
+		self.assertEqual(self.links.entries(10),set([1]))
+		self.assertEqual(self.links.entries(11),set())
+
+class IntervalTreeTest(unittest.TestCase):
+
+	def test_overlapping(self):
+		rnd=random.Random(7)
+		tree=IntervalTree()
+		intervals={}
+		for key in range(300):
+			start=rnd.randint(0,1000)
+			intervals[key]=(start,start+rnd.randint(1,100))
+			tree.add(key,intervals[key][0],intervals[key][1],-key)
+		for key in range(0,300,3):
+			tree.remove(key)
+			del intervals[key]
+		for key in range(1,300,3):
+			start=rnd.randint(0,1000)
+			intervals[key]=(start,start+rnd.randint(1,100))
+			tree.add(key,intervals[key][0],intervals[key][1],-key)
+		self.assertEqual(len(tree),200)
+		self.assertNotIn(0,tree)
+
+		for i in range(100):
+			start=rnd.randint(-50,1100)
+			stop=start+rnd.randint(1,200)
+			expected=sorted((interval[0],key) for (key,interval) in intervals.items() if interval[0]<stop and interval[1]>start)
+			self.assertEqual(tree.overlapping(start,stop),[(key,intervals[key][0],intervals[key][1],-key) for (t,key) in expected])
+
+	def test_empty(self):
+		self.assertEqual(IntervalTree().overlapping(0,100),[])
+
+class DVRConflictsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.conflicts=DVRConflicts()
+		self.conflicts.add(1,0,100,'a')
+		self.conflicts.add(2,50,150,'b')
+		self.conflicts.add(3,200,300,'a')
+
+	def test_tuners(self):
+		self.assertEqual(self.conflicts.conflicts(60,80,'c',2),[1,2])
+		self.assertEqual(self.conflicts.conflicts(60,80,'c',3),[])
+		self.assertEqual(self.conflicts.conflicts(120,220,'c',1),[2,3])
+
+	def test_shared_mux(self):
+		# recordings of one mux share a tuner
+		self.assertEqual(self.conflicts.conflicts(60,80,'a',2),[])
+		self.assertEqual(self.conflicts.conflicts(60,80,'a',1),[1,2])
+
+	def test_boundaries(self):
+		# entries ending as the recording starts (or starting as it stops) do not overlap it
+		self.assertEqual(self.conflicts.conflicts(150,200,'c',1),[])
+
+	def test_exclude_remove(self):
+		self.assertEqual(self.conflicts.conflicts(60,80,'c',2,exclude=1),[])
+		self.conflicts.remove(2)
+		self.assertEqual(self.conflicts.conflicts(60,80,'c',1),[1])
+		self.assertEqual(len(self.conflicts),2)
+
+class AutorecEngineTest(unittest.TestCase):
+
+	def setUp(self):
+		self.engine=AutorecEngine()
+		for (event_id,title,channel_id,start,stop,content_type) in (
+				(1,'The News',1,0,1800,0x20),(2,'Late News',2,100,400,0x20),(3,'Newsround',1,50,3600,0x50),
+				(4,'Film',1,200,7400,0x10),(5,'the news',2,5,1805,0x21)):
+			self.engine.add_event(event_id,{'title':title,'channelId':channel_id,'start':start,'stop':stop,'contentType':content_type})
+
+	def test_title(self):
+		self.engine.add_rule('a',{'title':'news$'})
+		self.assertEqual(self.engine.matches('a'),[1,5,2])
+		self.engine.add_rule('b',{'title':'^(the|late) news'})
+		self.assertEqual(self.engine.matches('b'),[1,5,2])
+		self.assertEqual(sorted(self.engine.rules(1)),['a','b'])
+		self.assertEqual(self.engine.rules(3),[])
+
+	def test_criteria(self):
+		self.engine.add_rule('a',{'title':'news','channel':1})
+		self.assertEqual(self.engine.matches('a'),[1,3])
+		self.engine.add_rule('a',{'title':'news','minDuration':1800,'maxDuration':3000})
+		self.assertEqual(self.engine.matches('a'),[1,5])
+		self.engine.add_rule('a',{'title':'news','contentType':0x20})
+		self.assertEqual(self.engine.matches('a'),[1,5,2])
+		self.engine.add_rule('a',{'title':'news','contentType':0x21})
+		self.assertEqual(self.engine.matches('a'),[5])
+
+	def test_disabled(self):
+		self.engine.add_rule('a',{'title':'news','enabled':0})
+		self.assertEqual(self.engine.matches('a'),[])
+		self.assertEqual(self.engine.rules(1),[])
+		self.engine.add_rule('a',{'title':'news','enabled':1})
+		self.assertEqual(self.engine.matches('a'),[1,5,3,2])
+
+	def test_events_change(self):
+		self.engine.add_rule('a',{'title':'news'})
+		self.assertEqual(self.engine.matches('a'),[1,5,3,2])
+		self.engine.add_event(4,{'title':'More news','channelId':1,'start':200,'stop':7400})
+		self.engine.remove_event(2)
+		self.engine.remove_rule('b')
+		self.assertEqual(self.engine.matches('a'),[1,5,3,4])
+		self.engine.remove_rule('a')
+		self.assertEqual(self.engine.matches('a'),[])
+		self.assertEqual(len(self.engine),0)
+
+	def test_invalid_regex(self):
+		self.engine.add_rule('a',{'title':'the news ('})
+		self.engine.add_event(6,{'title':'The News (Repeat)','channelId':1,'start':0,'stop':10})
+		self.assertEqual(self.engine.matches('a'),[6])
+
+class KeyIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index=KeyIndex()
+		self.index.add(1,['a','b'])
+		self.index.add(2,['b'])
+
+	def test_find(self):
+		self.assertEqual(self.index.find(['b']),set([1,2]))
+		self.assertEqual(self.index.find(['a','c']),set([1]))
+		self.assertEqual(self.index.find([]),set())
+		self.assertEqual(self.index.keys(1),frozenset(['a','b']))
+		self.assertEqual(self.index.keys(3),frozenset())
+		self.assertEqual(len(self.index),2)
+
+	def test_rekey_remove(self):
+		self.index.add(1,['b','c'])
+		self.assertEqual(self.index.find(['a']),set())
+		self.assertEqual(self.index.find(['c']),set([1]))
+		self.index.remove(2)
+		self.index.remove(3)
+		self.assertEqual(self.index.find(['b']),set([1]))
+		self.index.add(1,[])
+		self.assertEqual(self.index.find(['b','c']),set())
+		self.assertEqual(len(self.index),0)
+
+class EpisodeIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index=EpisodeIndex()
+		self.index.add_event(10,{'episodeUri':'ep://1','serieslinkUri':'sl://1'})
+		self.index.add_event(11,{'episodeUri':'ep://1','serieslinkUri':'sl://1'})
+		self.index.add_dvr_entry(1,{'eventId':10,'title':'Show'})
+
+	def _dvr(self,uri):
+		return self.index.dvr_episodes.find([('uri',uri)])
+
+	def test_keys(self):
+		self.assertEqual(EpisodeIndex.episode_keys({'episodeUri':'u','episodeId':5,'title':'Show','episodeOnscreen':'S01E02'}),
+			[('uri','u'),('id',5),('title','show','S01E02')])
+		self.assertEqual(EpisodeIndex.episode_keys({'title':'Show'}),[])
+		self.assertEqual(EpisodeIndex.series_keys({'serieslinkUri':'s','serieslinkId':6}),[('uri','s'),('id',6)])
+
+	def test_lookup(self):
+		self.assertEqual(self.index.event_episodes.find([('uri','ep://1')]),set([10,11]))
+		self.assertEqual(self.index.event_series.find([('uri','sl://1')]),set([10,11]))
+		self.assertEqual(self._dvr('ep://1'),set([1]))
+		self.assertEqual(self.index.dvr_series.find([('uri','sl://1')]),set([1]))
+		self.assertEqual(self.index.unresolved(),[])
+
+	def test_event_rekeyed(self):
+		self.index.add_event(10,{'episodeUri':'ep://2','serieslinkUri':'sl://2'})
+		self.assertEqual(self.index.event_episodes.find([('uri','ep://1')]),set([11]))
+		self.assertEqual(self._dvr('ep://1'),set())
+		self.assertEqual(self._dvr('ep://2'),set([1]))
+		self.assertEqual(self.index.dvr_series.find([('uri','sl://2')]),set([1]))
+
+	def test_event_removed(self):
+		# the entry keeps the keys its event had when last seen
+		self.index.remove_event(10)
+		self.assertEqual(self.index.event_episodes.find([('uri','ep://1')]),set([11]))
+		self.assertEqual(self._dvr('ep://1'),set([1]))
+		self.index.clear_events()
+		self.assertEqual(self.index.event_episodes.find([('uri','ep://1')]),set())
+		self.assertEqual(self._dvr('ep://1'),set([1]))
+
+	def test_entry_relinked(self):
+		self.index.add_event(12,{'episodeUri':'ep://3'})
+		self.index.add_dvr_entry(1,{'eventId':12,'episodeUri':'ep://own'})
+		self.assertEqual(self._dvr('ep://1'),set())
+		self.assertEqual(self._dvr('ep://3'),set([1]))
+		self.assertEqual(self._dvr('ep://own'),set([1]))
+		# a change to the old event no longer reaches the entry
+		self.index.add_event(10,{'episodeUri':'ep://1'})
+		self.assertEqual(self._dvr('ep://1'),set())
+
+	def test_entry_removed(self):
+		self.index.remove_dvr_entry(1)
+		self.assertEqual(self._dvr('ep://1'),set())
+		self.assertEqual(len(self.index.dvr_series),0)
+		self.index.add_event(10,{'episodeUri':'ep://1'})
+		self.assertEqual(self._dvr('ep://1'),set())
+
+	def test_resolve(self):
+		self.index.add_dvr_entry(2,{'eventId':20})
+		self.assertEqual(self.index.unresolved(),[(2,20)])
+		self.index.resolve(2,{'episodeUri':'ep://1'})
+		self.assertEqual(self.index.unresolved(),[])
+		self.assertEqual(self._dvr('ep://1'),set([1,2]))
+		self.index.add_dvr_entry(3,{'eventId':21})
+		self.index.resolve(3,None)
+		self.assertEqual(self.index.unresolved(),[])
+		self.assertEqual(len(self.index.dvr_episodes),2)
+
+class SessionDVRTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data(events=True)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def test_buckets(self):
+		self.assertEqual([entry.id for entry in self.session.scheduled],[1])
+		self.assertEqual([entry.id for entry in self.session.recorded],[2])
+		self.assertEqual([entry.id for entry in self.session.failed],[3])
+
+	def test_recordings_between(self):
+		self.assertEqual([entry.id for entry in self.session.recordings_between(NOW-90000,NOW)],[2,3])
+		self.assertEqual([entry.id for entry in self.session.recordings_between(NOW,NOW+86400)],[1])
+
+	def _entry(self,channel_id):
+		return HTSPDVREntry(self.session,{'channel':channel_id,'start':NOW+3000,'stop':NOW+4000,'title':'New'})
+
+	def test_conflicts(self):
+		self.assertEqual([entry.id for entry in self.session.dvr_conflicts(self._entry(2),1)],[1])
+		self.assertEqual(self.session.dvr_conflicts(self._entry(2),2),[])
+		# channel 3 shares a mux with channel 1, the scheduled entry's channel
+		self.assertEqual(self.session.dvr_conflicts(self._entry(3),1),[])
+		# and the scheduled entry does not conflict with itself
+		self.assertEqual(self.session.dvr_conflicts(self.session.scheduled[0],1),[])
+
+	def test_autorec(self):
+		self.assertEqual([event.id for event in self.session.autorec_matches('abc')],range(1000,1020))
+		self.assertEqual([entry.id for entry in self.session.event_autorecs(1005)],['abc'])
+		self.session._handleMessage(dict(self.server.autorec_entries[0],id='off',enabled=0))
+		self.assertEqual(self.session.autorec_matches('off'),[])
+		self.assertEqual([entry.id for entry in self.session.event_autorecs(1005)],['abc'])
+		self.assertEqual(self.session.autorec_preview().keys(),['abc'])
+
+class SessionLinkTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _link(self,event_id):
+		event=self.session._get_event(event_id)
+		entry=event.dvr_entry
+		return (entry.id if entry else None,event.dvr_id,self.session.is_scheduled(event),self.session.is_scheduled(event_id))
+
+	def test_entry_side(self):
+		self.session.fetch_initial_data(events=True)
+		self.assertEqual(self._link(1004),(1,1,True,True))
+		self.assertEqual(self._link(1001),(None,None,False,False))
+
+	def test_event_side(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage({'method':'eventUpdate','eventId':1010,'dvrId':2})
+		self.session._handleMessage({'method':'eventUpdate','eventId':1011,'dvrId':1})
+		self.assertEqual(self._link(1010),(2,2,False,False))
+		self.assertEqual(self._link(1011),(1,1,True,True))
+
+	def test_entry_deleted(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage({'method':'eventUpdate','eventId':1010,'dvrId':2})
+		self.session._handleMessage({'method':'dvrEntryDelete','id':1})
+		self.session._handleMessage({'method':'dvrEntryDelete','id':2})
+		self.assertEqual(self._link(1004),(None,None,False,False))
+		self.assertEqual(self._link(1010),(None,None,False,False))
+
+	def test_event_deleted(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage({'method':'eventUpdate','eventId':1010,'dvrId':2})
+		self.session._handleMessage({'method':'eventDelete','eventId':1010})
+		self.session._handleMessage({'method':'eventDelete','eventId':1004})
+		self.assertEqual(self.session._dvr_links.events(2),set())
+		# entry 1 still gives its event
+		self.assertEqual(self.session._dvr_links.events(1),set([1004]))
+		self.assertTrue(self.session.is_scheduled(1004))
+		self.session._handleMessage({'method':'dvrEntryDelete','id':1})
+		self.assertEqual(self.session._dvr_links.entries(1004),set())
+
+	def test_entry_updated(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage({'method':'dvrEntryUpdate','id':1,'eventId':1005})
+		self.assertEqual(self._link(1004),(None,None,False,False))
+		self.assertEqual(self._link(1005),(1,1,True,True))
+		self.session._handleMessage({'method':'dvrEntryUpdate','id':1,'state':'recording'})
+		self.assertEqual(self._link(1005),(1,1,True,True))
+		self.session._handleMessage({'method':'dvrEntryUpdate','id':1,'state':'completed'})
+		self.assertEqual(self._link(1005),(1,1,False,False))
+
+	def test_recording_preferred(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage(dict(self.server.dvr_entries[1],method='dvrEntryAdd',id=4,eventId=1004))
+		self.assertEqual(self._link(1004),(1,1,True,True))
+		self.session._handleMessage({'method':'dvrEntryUpdate','id':1,'state':'missed'})
+		self.assertEqual(self.session._get_event(1004).dvr_entry._message['state'],'missed')
+		self.assertFalse(self.session.is_scheduled(1004))
+
+	def test_without_entries(self):
+		# before the DVR entries are collected only the event's dvrId is known
+		self.server.events[3]['dvrId']=7
+		self.assertEqual(self.session.get_events([1003])[0].dvr_id,7)
+		self.assertEqual(self.session.get_events([1003])[0].dvr_entry,None)
+
+class SessionEpisodeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _ids(self,responses):
+		return [response.id for response in responses]
+
+	def _events(self,events):
+		starts=[event.start for event in events]
+		self.assertEqual(starts,sorted(starts))
+		return sorted(self._ids(events))
+
+	def test_episodes(self):
+		self.session.fetch_initial_data(events=True)
+		event=self.session._get_event(1000)
+		# every channel airs episode ep://0 as its shows 0, 7 and 14
+		self.assertEqual(self._events(self.session.episode_events(event)),
+			sorted(1000+20*channel+i for channel in range(5) for i in (0,7,14)))
+		self.assertEqual(self._events(self.session.series_events(event)),range(1000,1020))
+
+	def test_rekeyed(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage({'method':'eventUpdate','eventId':1000,'episodeUri':'ep://new','serieslinkUri':'sl://new'})
+		event=self.session._get_event(1000)
+		self.assertEqual(self._events(self.session.episode_events(event)),[1000])
+		self.assertEqual(self._events(self.session.series_events(event)),[1000])
+		self.assertNotIn(1000,self._ids(self.session.episode_events(self.session._get_event(1007))))
+		self.assertEqual(self._events(self.session.series_events(self.session._get_event(1001))),range(1001,1020))
+		self.session._handleMessage({'method':'eventDelete','eventId':1007})
+		self.assertEqual(self._events(self.session.episode_events(self.session._get_event(1014))),
+			sorted([1014]+[1000+20*channel+i for channel in range(1,5) for i in (0,7,14)]))
+
+	def test_dedupe(self):
+		self.session.fetch_initial_data(events=True)
+		# channel 2's show 4 is the episode entry 1 schedules from channel 1
+		event=self.session._get_event(1024)
+		self.assertEqual(self._ids(self.session.dedupe_candidates(event)),[1])
+		self.session._handleMessage(dict(self.server.dvr_entries[1],method='dvrEntryAdd',id=4,eventId=1011))
+		self.assertEqual(self._ids(self.session.dedupe_candidates(event)),[4,1])
+		# a missed recording is no candidate
+		self.session._handleMessage({'method':'dvrEntryUpdate','id':4,'state':'missed'})
+		self.assertEqual(self._ids(self.session.dedupe_candidates(event)),[1])
+		self.session._handleMessage({'method':'dvrEntryUpdate','id':4,'state':'completed','eventId':1012})
+		self.assertEqual(self._ids(self.session.dedupe_candidates(event)),[1])
+		self.session._handleMessage({'method':'dvrEntryDelete','id':1})
+		self.assertEqual(self.session.dedupe_candidates(event),[])
+		self.assertEqual(self._ids(self.session.dedupe_candidates(self.session._get_event(1005))),[4])
+
+	def test_dedupe_lazy(self):
+		# without the EPG entry 1's event is fetched to find its episode, once
+		self.session.fetch_initial_data()
+		event=self.session.get_events([1024])[0]
+		self.assertEqual(self._ids(self.session.dedupe_candidates(event)),[1])
+		fetches=[message['eventId'] for message in self.server.received if message['method']=='getEvent']
+		self.assertEqual(fetches,[1024,1004])
+		self.assertEqual(self._ids(self.session.dedupe_candidates(event)),[1])
+		self.assertEqual(len([message for message in self.server.received if message['method']=='getEvent']),2)
+		self.assertEqual(self.session.dedupe_candidates(self.session.get_events([1025])[0]),[])
+
+if __name__=='__main__':
+	unittest.main()
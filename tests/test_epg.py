@@ -0,0 +1,337 @@
+"""Tests for the EPG indexes and the session's EPG queries"""
+
+import datetime
+import unittest
+
+from python_htsp import htsp_epg
+from python_htsp.htsp_epg import EPGColumnStore, EPGIndex, EPGSearchIndex, EventCache
+from python_htsp.htsp_session import HTSPEvent, HTSPSession
+from tests.support import NOW, FakeServer, make_data
+
+class EPGIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index=EPGIndex()
+		for (event_id,channel_id,start,stop) in ((3,1,200,300),(1,1,0,100),(2,1,100,200),(4,2,0,500),(5,1,300,1000)):
+			self.index.add(event_id,channel_id,start,stop)
+
+	def test_events(self):
+		self.assertEqual(self.index.events(1),[1,2,3,5])
+		self.assertEqual(self.index.events(3),[])
+		self.assertEqual(len(self.index),5)
+
+	def test_between(self):
+		self.assertEqual(self.index.events_between(1,150,250),[2,3])
+		self.assertEqual(self.index.events_between(1,100,200),[2])
+		self.assertEqual(self.index.events_between(1,900,2000),[5])
+		self.assertEqual(self.index.events_between(2,100,200),[4])
+
+	def test_at(self):
+		self.assertEqual(self.index.event_at(1,100),2)
+		self.assertEqual(self.index.event_at(1,999),5)
+		self.assertEqual(self.index.event_at(1,1000),None)
+		self.assertEqual(self.index.next_event(1,150),3)
+		self.assertEqual(self.index.next_event(1,400),None)
+
+	def test_update_remove(self):
+		self.index.add(2,1,120,180)
+		self.assertEqual(self.index.event_at(1,110),None)
+		self.index.remove(3)
+		self.assertEqual(self.index.events(1),[1,2,5])
+		self.assertNotIn(3,self.index)
+
+class ColumnStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.store=EPGColumnStore(lambda message:HTSPEvent(None,message))
+		for message in make_data(2,5)[4]:
+			self.store[message['eventId']]=HTSPEvent(None,dict(message))
+
+	def test_lookup(self):
+		event=self.store[1006]
+		self.assertEqual(event.title,'Show 2 1')
+		self.assertEqual(event._message['serieslinkUri'],'sl://2')
+		self.assertEqual(len(self.store),10)
+
+	def test_delete_keeps_tombstone(self):
+		del self.store[1001]
+		columns=self.store.columns()
+		self.assertEqual(len(columns['eventId']),10)
+		self.assertEqual(sum(1 for live in columns['live'] if live),9)
+		self.assertEqual(self.store.select(channel_id=1),[1000,1002,1003,1004])
+		self.assertNotIn(1001,self.store)
+
+	def test_compact(self):
+		del self.store[1001]
+		self.store.compact()
+		self.assertEqual(len(self.store.columns()['eventId']),9)
+		self.assertEqual(self.store.select(channel_id=1),[1000,1002,1003,1004])
+		self.assertEqual(self.store[1002].title,'Show 1 2')
+		self.assertEqual(self.store[1002]._message['episodeUri'],'ep://2')
+
+	def _change(self):
+		message=dict(self.store[1000]._message,eventId=2000,start=0)
+		self.store[2000]=HTSPEvent(None,message)
+		self.store[1002]=HTSPEvent(None,dict(self.store[1002]._message,start=1))
+		del self.store[1003]
+
+	def _check_isolated(self,columns):
+		starts=list(columns['start'])
+		self._change()
+		self.assertEqual(len(columns['eventId']),10)
+		self.assertEqual(list(columns['start']),starts)
+		self.assertEqual(sum(1 for live in columns['live'] if live),10)
+		self.assertEqual(len(self.store.columns()['eventId']),11)
+
+	def test_columns_isolated(self):
+		numpy=htsp_epg.numpy
+		htsp_epg.numpy=None
+		try:
+			self._check_isolated(self.store.columns())
+		finally:
+			htsp_epg.numpy=numpy
+
+	@unittest.skipIf(htsp_epg.numpy is None,'needs numpy')
+	def test_columns_numpy(self):
+		columns=self.store.columns()
+		self.assertEqual(columns['live'].dtype,bool)
+		self.assertEqual(columns['eventId'][columns['channelId']==2].tolist(),range(1005,1010))
+		self._check_isolated(columns)
+		# appending many rows reallocates the store's arrays, not those of the copies
+		for event_id in range(3000,5000):
+			self.store[event_id]=HTSPEvent(None,dict(self.store[1000]._message,eventId=event_id))
+		self.assertEqual(columns['eventId'].tolist()[:3],[1000,1001,1002])
+		self.assertEqual(self.store.select(channel_id=2,recorded=False),range(1005,1010))
+
+class SearchIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		self.index=EPGSearchIndex()
+		self.index.add(1,['The News at Ten',None,'Headlines'])
+		self.index.add(2,['Newsround','Children\'s news'])
+		self.index.add(3,['Film','A newsworthy story'])
+
+	def test_search(self):
+		self.assertEqual(self.index.search('news'),set([1,2,3]))
+		self.assertEqual(self.index.search('NEWS',prefix=False),set([1,2]))
+		self.assertEqual(self.index.search('head'),set([1]))
+		self.assertEqual(self.index.search('weather'),set())
+		self.assertEqual(self.index.search(''),set())
+		self.assertEqual(len(self.index),3)
+
+	def test_prefix(self):
+		# 'new' lies before every word it prefixes and 'newt' past them
+		self.index.add(4,['Newt','Nettles and nexus'])
+		self.assertEqual(self.index.search('new'),set([1,2,3,4]))
+		self.assertEqual(self.index.search('news'),set([1,2,3]))
+		self.assertEqual(self.index.search('newt'),set([4]))
+		self.assertEqual(self.index.search('ne'),set([1,2,3,4]))
+		self.assertEqual(self.index.search('newz'),set())
+
+	def test_words(self):
+		self.assertEqual(self.index.search('news ten'),set([1]))
+		self.assertEqual(self.index.search('chil new'),set([2]))
+		self.assertEqual(self.index.search('news story film'),set([3]))
+		self.assertEqual(self.index.search('ten story'),set())
+
+	def test_update(self):
+		self.index.add(1,['Weather'])
+		self.assertEqual(self.index.search('news'),set([2,3]))
+		self.assertEqual(self.index.search('head'),set())
+		self.assertEqual(self.index.search('weather'),set([1]))
+		self.index.add(2,[None])
+		self.assertEqual(self.index.search('news'),set([3]))
+		self.assertEqual(len(self.index),2)
+
+	def test_remove(self):
+		self.index.remove(2)
+		self.index.remove(2)
+		self.assertEqual(self.index.search('news'),set([1,3]))
+		self.assertEqual(self.index.search('newsround'),set())
+		self.assertEqual(len(self.index),2)
+
+class SessionSearchTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		events=self.server.events
+		for (i,title,content_type) in ((1,'Evening News',0x10),(22,'News at Ten',0x21),(43,'Newsnight',0x30),(84,'Late News',0x10)):
+			events[i].update(title=title,contentType=content_type)
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _search(self,query,**filters):
+		return [event.id for event in self.session.search_events(query,**filters)]
+
+	def _searches(self):
+		self.assertEqual(self._search('news'),[1001,1022,1043,1084])
+		self.assertEqual(self._search('news',channel=2),[1022])
+		self.assertEqual(self._search('news',channel=self.session._get_channel(3)),[1043])
+		self.assertEqual(self._search('news',tag=2),[1001,1022])
+		self.assertEqual(self._search('news',tag=self.session._tags[2],channel=1),[1001])
+		self.assertEqual(self._search('news',start=NOW,stop=NOW+1800),[1022])
+		self.assertEqual(self._search('news',start=datetime.datetime.fromtimestamp(NOW+1800)),[1043,1084])
+		self.assertEqual(self._search('news',stop=NOW),[1001])
+		self.assertEqual(self._search('news',content_type=0x10),[1001,1084])
+		self.assertEqual(self._search('news',content_type=0x20),[1022])
+		self.assertEqual(self._search('news',content_type=0x22),[])
+
+	def test_local(self):
+		self.session.fetch_initial_data(events=True)
+		del self.server.received[:]
+		self._searches()
+		self.assertEqual(self._search('new at'),[1022])
+		self.assertNotIn('epgQuery',[message['method'] for message in self.server.received])
+
+	def test_local_update(self):
+		self.session.fetch_initial_data(events=True)
+		self.session._handleMessage({'method':'eventUpdate','eventId':1001,'title':'Weather'})
+		self.session._handleMessage({'method':'eventDelete','eventId':1022})
+		self.assertEqual(self._search('news'),[1043,1084])
+		self.assertEqual(self._search('weather'),[1001])
+
+	def test_server(self):
+		self._searches()
+		self.assertIn('epgQuery',[message['method'] for message in self.server.received])
+
+	def test_epg_query(self):
+		self.assertEqual(sorted(event.id for event in self.session.epg_query('news',channel=2,content_type=0x20)),[1001,1022,1043,1084])
+		query=[message for message in self.server.received if message['method']=='epgQuery'][-1]
+		self.assertEqual((query['query'],query['channelId'],query['contentType']),('news',2,0x20))
+
+class SessionEPGTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _queries(self):
+		events=self.server.events
+		start=events[2]['start']
+		as_datetime=datetime.datetime.fromtimestamp(start)
+		for t in (start,as_datetime):
+			self.assertEqual([event.id for event in self.session.events_between(1,t,start+3600)],[1002,1003])
+			self.assertEqual(self.session.event_at(self.session._get_channel(1),t).id,1002)
+
+	def test_cached_epg(self):
+		self.session.fetch_initial_data(events=True)
+		self._queries()
+
+	def test_server_epg(self):
+		self._queries()
+
+	def test_server_epg_cached(self):
+		self._queries()
+		fetches=len([message for message in self.server.received if message['method']=='getEvents'])
+		self._queries()
+		self.assertEqual(len([message for message in self.server.received if message['method']=='getEvents']),fetches)
+
+class IterEventsTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _requests(self):
+		return [message for message in self.server.received if message['method']=='getEvents']
+
+	def test_pages(self):
+		for prefetch in (True,False):
+			del self.server.received[:]
+			events=list(self.session.iter_events(2,page=6,prefetch=prefetch))
+			self.assertEqual([event.id for event in events],range(1020,1040))
+			# 20 events in pages, each after the first anchored on the last event of the one before
+			self.assertEqual([message.get('eventId',None) for message in self._requests()],[None,1025,1032,1039])
+
+	def test_start_max_time(self):
+		server_events=self.server.events
+		events=self.session.iter_events(1,start=1004,max_time=server_events[8]['start'],page=2)
+		self.assertEqual([event.id for event in events],range(1004,1009))
+
+	def test_lazy(self):
+		events=self.session.iter_events(1,page=5)
+		self.assertEqual(next(events).id,1000)
+		# the first page and at most the prefetch of the second, not the whole guide
+		self.assertLessEqual(len(self._requests()),2)
+
+	def test_cached_epg(self):
+		self.session.fetch_initial_data(events=True)
+		self.assertEqual([event.id for event in self.session.iter_events(1,start=1010)],range(1010,1020))
+		self.assertEqual([event.id for event in self.session.iter_events(1)][0],1002)
+		self.assertEqual(self._requests(),[])
+
+class EventCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cache=EventCache(size=10)
+		self.events=[HTSPEvent(None,dict(message)) for message in make_data(1,5)[4]]
+		for event in self.events:
+			self.cache.put(event)
+		self.cache.put_channel(1,self.events)
+
+	def test_channel(self):
+		self.assertEqual([event.id for event in self.cache.get_channel(1)],[1000,1001,1002,1003,1004])
+		self.assertEqual(self.cache.get_channel(2),None)
+
+	def test_channel_discarded_event(self):
+		self.cache.discard(1002)
+		self.assertEqual(self.cache.get_channel(1),None)
+
+	def test_channel_new_event(self):
+		self.cache.put(self.events[1])
+		self.assertNotEqual(self.cache.get_channel(1),None)
+		message=dict(self.events[4]._message,eventId=1005)
+		self.cache.put(HTSPEvent(None,message))
+		self.assertEqual(self.cache.get_channel(1),None)
+
+	def test_channel_expired(self):
+		cache=EventCache(size=10,ttl=0)
+		cache.put(self.events[0])
+		cache.put_channel(1,self.events[:1])
+		self.assertEqual(cache.get_channel(1),None)
+
+class NowNextTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _ids(self,result):
+		return dict((channel_id,tuple(event.id if event else None for event in events)) for (channel_id,events) in result.items())
+
+	def test_current(self):
+		self.server.channels[1].pop('nextEventId')
+		self.server.channels[2].pop('eventId')
+		result=self.session.now_next(channels=[1,2,3,4])
+		self.assertEqual(self._ids(result),{1:(1002,1003),2:(1022,None),3:(None,1043),4:(1062,1063)})
+
+	def test_at(self):
+		t=self.server.events[5]['start']+60
+		for events in (False,True):
+			if events:
+				self.session.fetch_initial_data(events=True)
+			result=self.session.now_next(t,channels=[1,2])
+			self.assertEqual(self._ids(result),{1:(1005,1006),2:(1025,1026)})
+
+	def test_grid(self):
+		start=self.server.events[2]['start']
+		grid=self.session.grid(start,start+3600,channels=[1,3])
+		self.assertEqual(dict((channel_id,[event.id for event in events]) for (channel_id,events) in grid.items()),{1:[1002,1003],3:[1042,1043]})
+
+if __name__=='__main__':
+	unittest.main()
@@ -0,0 +1,210 @@
+"""Tests for the HTSMSG codec"""
+
+import unittest
+
+from python_htsp.tvh import htsmsg
+
+def _field(typ,name,data):
+	"""A raw HTSMSG field"""
+	return htsmsg._HDR.pack(typ,len(name),len(data))+name+data
+
+class DecodeTest(unittest.TestCase):
+	"""Decoding by offset"""
+
+	def test_scalars(self):
+		data=_field(htsmsg.HMF_STR,'title','News')+_field(htsmsg.HMF_S64,'id','\x2a')+_field(htsmsg.HMF_BIN,'challenge','\x00\x01')
+		msg=htsmsg.deserialize0(data)
+		self.assertEqual(msg,{'title':'News','id':42,'challenge':'\x00\x01'})
+		self.assertIs(type(msg['challenge']),htsmsg.hmf_bin)
+
+	def test_s64_lengths(self):
+		for value in (0,1,255,256,65535,65536,2**24+5,2**32-1,2**32,2**40+3,2**63-1,-1,-2**63):
+			data=_field(htsmsg.HMF_S64,'v',htsmsg._U64.pack(value&0xFFFFFFFFFFFFFFFF).rstrip('\0'))
+			self.assertEqual(htsmsg.deserialize0(data),{'v':value})
+
+	def test_nested(self):
+		inner=_field(htsmsg.HMF_STR,'name','a')+_field(htsmsg.HMF_S64,'n','\x02')
+		items=_field(htsmsg.HMF_S64,'','\x01')+_field(htsmsg.HMF_MAP,'',inner)
+		data=_field(htsmsg.HMF_LIST,'items',items)+_field(htsmsg.HMF_STR,'after','x')
+		self.assertEqual(htsmsg.deserialize0(data),{'items':[1,{'name':'a','n':2}],'after':'x'})
+
+	def test_names_interned(self):
+		first=htsmsg.deserialize0(_field(htsmsg.HMF_STR,'channelName','a'))
+		second=htsmsg.deserialize0(_field(htsmsg.HMF_STR,'channelName','b'))
+		self.assertIs(first.keys()[0],second.keys()[0])
+
+	def test_truncated(self):
+		data=_field(htsmsg.HMF_STR,'title','News')
+		self.assertRaises(Exception,htsmsg.deserialize0,data[:-1])
+
+	def test_buffer_types(self):
+		data=_field(htsmsg.HMF_STR,'title','News')
+		for buf in (bytearray(data),memoryview(data)):
+			self.assertEqual(htsmsg.deserialize0(buf),{'title':'News'})
+
+class EncodeTest(unittest.TestCase):
+	"""Single pass encoding"""
+
+	def test_round_trip(self):
+		msg={'method':'hello','htspversion':25,'negative':-5,'big':2**40,'flag':True,'name':u'caf\xe9',
+			'challenge':htsmsg.hmf_bin('\x00\xff'),'list':[1,'a',{'k':[2,3]}],'map':{'inner':{'x':'y'}},'empty':{}}
+		data=htsmsg.serialize(msg)
+		self.assertEqual(htsmsg._LEN.unpack_from(data)[0],len(data)-4)
+		decoded=htsmsg.deserialize0(data[4:])
+		self.assertEqual(decoded['name'],'caf\xc3\xa9')
+		self.assertEqual(decoded['flag'],1)
+		del decoded['name'],decoded['flag'],msg['name'],msg['flag']
+		self.assertEqual(decoded,msg)
+
+	def test_zero(self):
+		self.assertEqual(htsmsg.binary_write({'v':0}),_field(htsmsg.HMF_S64,'v',''))
+
+	def test_append(self):
+		buf=bytearray('prefix')
+		self.assertIs(htsmsg.encode({'a':1},buf),buf)
+		self.assertEqual(str(buf[6:]),htsmsg.serialize({'a':1}))
+
+	def test_types(self):
+		self.assertEqual(htsmsg.hmf_type({}),htsmsg.HMF_MAP)
+		self.assertEqual(htsmsg.hmf_type([]),htsmsg.HMF_LIST)
+		self.assertRaises(Exception,htsmsg.hmf_type,1.5)
+
+	def test_int2bin(self):
+		self.assertEqual(htsmsg.int2bin(0x01020304),'\x01\x02\x03\x04')
+		self.assertEqual(htsmsg.bin2int('\x01\x02\x03\x04'),0x01020304)
+
+class _Stream(object):
+	"""A stream handing out data at most chunk bytes per read"""
+
+	def __init__(self,data,chunk):
+		self._data=data
+		self._chunk=chunk
+
+	def readinto(self,buf):
+		num=min(len(buf),self._chunk,len(self._data))
+		buf[:num]=self._data[:num]
+		self._data=self._data[num:]
+		return num
+
+class StreamReaderTest(unittest.TestCase):
+	"""Buffered frame reading"""
+
+	def setUp(self):
+		self.messages=[{'seq':i,'title':'x'*(i*37)} for i in range(40)]
+		self.data=''.join(htsmsg.serialize(msg) for msg in self.messages)
+
+	def test_chunks(self):
+		for chunk in (1,3,64,65536):
+			reader=htsmsg.HTSMSGStreamReader(_Stream(self.data,chunk),bufsize=16)
+			self.assertEqual(list(reader),self.messages)
+
+	def test_lazy(self):
+		reader=htsmsg.HTSMSGStreamReader(_Stream(self.data,100),lazy=True)
+		messages=list(reader)
+		self.assertIsInstance(messages[1],htsmsg.HTSMSGView)
+		self.assertEqual([dict(msg) for msg in messages],self.messages)
+
+	def test_pending(self):
+		reader=htsmsg.HTSMSGStreamReader(_Stream(self.data,len(self.data)))
+		self.assertFalse(reader.pending())
+		reader.fill()
+		count=0
+		while reader.pending():
+			reader.next()
+			count+=1
+		self.assertEqual(count,40)
+
+	def test_truncated(self):
+		reader=htsmsg.HTSMSGStreamReader(_Stream(self.data[:-1],50))
+		self.assertRaises(Exception,list,reader)
+
+	def test_unsupported(self):
+		self.assertRaises(Exception,htsmsg.HTSMSGStreamReader,object())
+
+class ViewTest(unittest.TestCase):
+	"""Lazy HTSMSG views"""
+
+	def setUp(self):
+		self.msg={'method':'eventAdd','eventId':7,'title':'News','genre':[1,2],'extra':{'a':'b'}}
+		self.view=htsmsg.deserialize0(htsmsg.serialize(self.msg)[4:],lazy=True)
+
+	def test_read(self):
+		self.assertEqual(self.view['title'],'News')
+		self.assertEqual(self.view['genre'],[1,2])
+		self.assertEqual(self.view.get('missing',3),3)
+		self.assertRaises(KeyError,lambda:self.view['missing'])
+		self.assertEqual(len(self.view),5)
+		self.assertEqual(self.view,self.msg)
+		self.assertEqual(dict(self.view.iteritems()),self.msg)
+
+	def test_slots(self):
+		self.assertFalse(hasattr(self.view,'__dict__'))
+		self.assertIsInstance(self.view,htsmsg.collections.MutableMapping)
+
+	def test_changes(self):
+		self.view['title']='Weather'
+		self.view['new']=1
+		del self.view['genre']
+		self.assertEqual(self.view,{'method':'eventAdd','eventId':7,'title':'Weather','extra':{'a':'b'},'new':1})
+		self.assertNotIn('genre',self.view)
+		self.assertRaises(KeyError,self.view.__delitem__,'genre')
+
+	def test_copy(self):
+		copy=self.view.copy()
+		copy['title']='Weather'
+		self.assertEqual(self.view['title'],'News')
+		self.assertEqual(copy['title'],'Weather')
+		self.assertIs(copy._data,self.view._data)
+
+	def test_deserialize_all(self):
+		data=htsmsg.serialize(self.msg)+htsmsg.serialize({'seq':1})
+		self.assertEqual(list(htsmsg.deserialize_all(data)),[self.msg,{'seq':1}])
+		self.assertEqual(list(htsmsg.deserialize_all(data,lazy=True)),[self.msg,{'seq':1}])
+
+	def test_truncated(self):
+		self.assertRaises(Exception,htsmsg.HTSMSGView,htsmsg.serialize(self.msg)[4:-1])
+
+	def test_scanned_once(self):
+		data=htsmsg.serialize(self.msg)[4:]
+		unpacked=[]
+		header=htsmsg._HDR
+		class CountingStruct(object):
+			def unpack_from(self,data,off):
+				unpacked.append(off)
+				return header.unpack_from(data,off)
+		htsmsg._HDR=CountingStruct()
+		try:
+			view=htsmsg.HTSMSGView(data)
+			self.assertEqual(len(unpacked),5)
+			del unpacked[:]
+			# lookups go by the index, reading only the header of the field found
+			self.assertNotIn('missing',view)
+			self.assertEqual(view.get('missing'),None)
+			self.assertEqual(list(view),list(self.view))
+			self.assertEqual(unpacked,[])
+			self.assertEqual((view['title'],view['title']),('News','News'))
+			self.assertEqual(len(unpacked),2)
+		finally:
+			htsmsg._HDR=header
+
+	def test_shared_shape(self):
+		self.msg['title']='Weather'
+		other=htsmsg.deserialize0(htsmsg.serialize(self.msg)[4:],lazy=True)
+		self.assertIs(other._shape,self.view._shape)
+		self.assertEqual(other['title'],'Weather')
+
+	def test_repeated_name(self):
+		data=str(bytearray(htsmsg._HDR.pack(htsmsg.HMF_S64,1,1))+'a\x01'+bytearray(htsmsg._HDR.pack(htsmsg.HMF_S64,1,1))+'a\x02')
+		view=htsmsg.HTSMSGView(data)
+		self.assertEqual((view['a'],list(view),len(view)),(2,['a'],1))
+		self.assertEqual(view,htsmsg.deserialize0(data))
+
+	def test_decode(self):
+		self.view['title']='Weather'
+		del self.view['genre']
+		decoded=self.view.decode()
+		self.assertIs(type(decoded),dict)
+		self.assertEqual(decoded,{'method':'eventAdd','eventId':7,'title':'Weather','extra':{'a':'b'}})
+
+if __name__=='__main__':
+	unittest.main()
@@ -0,0 +1,80 @@
+"""Tests for HTSPSessionPool"""
+
+import datetime
+import unittest
+
+from python_htsp.htsp_pool import HTSPSessionPool, _PooledHTSPSession
+from python_htsp.htsp_session import RequestError
+from tests.support import FakeServer
+
+class PoolTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.pool=HTSPSessionPool('127.0.0.1',self.server.port,size=2)
+
+	def tearDown(self):
+		self.pool.close()
+		self.server.close()
+
+	def _entry(self,session,title):
+		entry=session.create_dvr_entry()
+		entry.title=title
+		entry.channel=session.channels[0]
+		entry.start=datetime.datetime.now()+datetime.timedelta(hours=1)
+		entry.stop=entry.start+datetime.timedelta(hours=1)
+		return entry
+
+	def test_shared_metadata(self):
+		with self.pool.session() as session:
+			self.assertEqual(sorted(channel.id for channel in session.channels),[1,2,3,4,5])
+			self.assertIs(session._channels,self.pool.metadata._channels)
+
+	def test_state_replaced(self):
+		with self.pool.session() as session:
+			metadata=self.pool.metadata
+			with metadata._lock:
+				metadata._reset_events(True,False)
+			self.assertIs(session._events,metadata._events)
+			self.assertIs(session._epg_index,metadata._epg_index)
+			self.assertIs(session._state,metadata._state)
+
+	def test_responses_applied_by_metadata_session(self):
+		with self.pool.session() as session:
+			events=session.get_events([1002,1003])
+		self.assertEqual([event.id for event in events],[1002,1003])
+		self.assertIs(events[0]._session,self.pool.metadata)
+		self.assertIs(self.pool.metadata._event_cache.get(1002),events[0])
+
+	def test_autorec_locked(self):
+		engine=self.pool.metadata._autorec_engine
+		(flush,owned)=(engine._flush,[])
+		def locked_flush():
+			owned.append(self.pool.metadata._lock._is_owned())
+			flush()
+		engine._flush=locked_flush
+		with self.pool.session() as session:
+			session.autorec_matches('abc')
+			session.event_autorecs(1005)
+		self.assertEqual(owned,[True]*2)
+
+	def test_add_dvr_entry(self):
+		with self.pool.session() as session:
+			entry=self._entry(session,'Added')
+			added=session.add_dvr_entry(entry)
+		self.assertEqual(added.title,'Added')
+		self.assertIs(added._session,self.pool.metadata)
+
+	def test_add_dvr_entry_timeout(self):
+		self.server.notify_dvr=False
+		timeout=_PooledHTSPSession._NOTIFICATION_TIMEOUT
+		_PooledHTSPSession._NOTIFICATION_TIMEOUT=0.2
+		try:
+			with self.pool.session() as session:
+				entry=self._entry(session,'Lost')
+				self.assertRaises(RequestError,session.add_dvr_entry,entry)
+		finally:
+			_PooledHTSPSession._NOTIFICATION_TIMEOUT=timeout
+
+if __name__=='__main__':
+	unittest.main()
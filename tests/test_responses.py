@@ -0,0 +1,32 @@
+"""Tests for the response wrappers"""
+
+import unittest
+
+from python_htsp.htsp_session import HTSPEvent
+from tests.support import make_data
+
+class EventTest(unittest.TestCase):
+
+	def setUp(self):
+		self.message=dict(make_data(1,1)[4][0])
+
+	def test_no_dict(self):
+		event=HTSPEvent(None,self.message)
+		event.start
+		self.assertFalse(hasattr(event,'__dict__'))
+
+	def test_datetime_follows_field(self):
+		event=HTSPEvent(None,self.message)
+		start=event.start
+		self.assertIs(event.start,start)
+		self.message['start']+=60
+		self.assertEqual((event.start-start).seconds,60)
+
+	def test_interning(self):
+		HTSPEvent(None,self.message)
+		# interning an equal copy returns the stored string only if that was interned
+		self.assertIs(intern(str(bytearray(self.message['title']))),self.message['title'])
+		self.assertIsNot(intern(str(bytearray(self.message['description']))),self.message['description'])
+
+if __name__=='__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+"""Tests for session snapshots"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from python_htsp.htsp_session import HTSPSession
+from tests.support import FakeServer
+
+class SnapshotTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.directory=tempfile.mkdtemp()
+		self.path=os.path.join(self.directory,'snapshot')
+		self.sessions=[]
+
+	def tearDown(self):
+		for session in self.sessions:
+			session.close()
+		self.server.close()
+		shutil.rmtree(self.directory)
+
+	def _session(self,**kwargs):
+		session=HTSPSession('127.0.0.1',self.server.port,**kwargs)
+		self.sessions.append(session)
+		return session
+
+	def _save(self,**kwargs):
+		session=self._session()
+		session.fetch_initial_data(**kwargs)
+		session.save_snapshot(self.path)
+		return session
+
+	def test_round_trip(self):
+		for lazy in (False,True):
+			saved=self._save(events=True)
+			session=self._session(lazy=lazy)
+			self.assertTrue(session.load_snapshot(self.path,refresh=False))
+			self.assertEqual(sorted(channel.name for channel in session.channels),sorted(channel.name for channel in saved.channels))
+			self.assertEqual(len(session._events),100)
+			self.assertEqual([event.id for event in session._channels[2].events],range(1020,1040))
+			self.assertEqual([entry.id for entry in session.scheduled],[1])
+			self.assertEqual(sorted(tag.name for tag in session.tags),['All','HD'])
+
+	def test_columnar(self):
+		self._save(events=True,columnar=True)
+		session=self._session()
+		self.assertTrue(session.load_snapshot(self.path,refresh=False))
+		self.assertEqual(session.event_at(1,self.server.events[2]['start']).title,'Show 1 2')
+
+	def test_refresh(self):
+		self._save()
+		session=self._session()
+		self.assertTrue(session.load_snapshot(self.path))
+		self.assertEqual(len(session.channels),5)
+		self.assertEqual(len([message for message in self.server.received if message['method']=='enableAsyncMetadata']),2)
+
+	def test_empty(self):
+		open(self.path,'wb').close()
+		session=self._session()
+		self.assertFalse(session.load_snapshot(self.path))
+		self.assertFalse(session._initial_data)
+		self.assertEqual(self.server.received,[])
+
+	def test_truncated(self):
+		self._save(events=True)
+		with open(self.path,'rb') as f:
+			data=f.read()
+		for size in (2,len(data)/2,len(data)-1):
+			with open(self.path,'wb') as f:
+				f.write(data[:size])
+			session=self._session()
+			self.assertFalse(session.load_snapshot(self.path,refresh=False))
+			self.assertEqual(session._channels,{})
+
+	def test_not_a_snapshot(self):
+		with open(self.path,'wb') as f:
+			f.write('\0\0\0\0')
+		self.assertRaises(Exception,self._session().load_snapshot,self.path)
+
+if __name__=='__main__':
+	unittest.main()
@@ -0,0 +1,156 @@
+"""Tests for the versioned session state behind snapshots and change deltas"""
+
+import unittest
+
+from python_htsp.htsp_session import HTSPSession, HTSPTag
+from python_htsp.htsp_state import Change, ChangeJournal, SessionState
+from python_htsp.tvh import htsmsg
+from tests.support import FakeServer
+
+class SessionStateTest(unittest.TestCase):
+
+	def setUp(self):
+		self.state=SessionState()
+		self.tag=HTSPTag(None,{'tagId':1,'tagName':'All'})
+
+	def test_capture_on_demand(self):
+		self.state.record('tag','add',1,self.tag,self.tag._message)
+		self.assertFalse(self.state.capturing)
+		self.assertEqual(len(self.state._maps['tag']),0)
+		self.assertEqual(self.state.changes_since(0).changes[0].action,'add')
+
+		self.state.capture({'tag':[(1,self.tag)]})
+		snapshot=self.state.snapshot()
+		self.assertEqual(snapshot.tags[1].name,'All')
+		self.assertIs(self.state.snapshot(),snapshot)
+
+	def test_frozen_versions(self):
+		self.state.capture({'tag':[(1,self.tag)]})
+		snapshot=self.state.snapshot()
+		self.tag._message=dict(self.tag._message,tagName='Some')
+		self.state.record('tag','update',1,self.tag,{'tagName':'Some'})
+		self.assertEqual(snapshot.tags[1].name,'All')
+		self.assertEqual(self.state.snapshot().tags[1].name,'Some')
+		self.assertEqual(self.state.snapshot().version,snapshot.version+1)
+
+class ChangeJournalTest(unittest.TestCase):
+
+	def setUp(self):
+		self.journal=ChangeJournal(4)
+
+	def _compact(self,*changes):
+		entries=[]
+		for (version,(action,existed,fields)) in enumerate(changes):
+			entries.append((Change(version+1,'channel',action,1,fields),existed))
+		return [(change.version,change.action,change.fields) for change in ChangeJournal.compact(entries)]
+
+	def test_since(self):
+		for version in range(1,7):
+			self.journal.append(Change(version,'tag','update',version,{}),True)
+		self.assertEqual(self.journal.since(1),None)
+		self.assertEqual([change.version for (change,existed) in self.journal.since(2)],[3,4,5,6])
+		self.assertEqual(self.journal.since(6),[])
+
+	def test_merge_updates(self):
+		self.assertEqual(self._compact(('add',False,{'a':1,'b':1}),('update',True,{'b':2})),[(2,'add',{'a':1,'b':2})])
+		self.assertEqual(self._compact(('update',True,{'a':1}),('update',True,{'b':2})),[(2,'update',{'a':1,'b':2})])
+
+	def test_add_delete(self):
+		self.assertEqual(self._compact(('add',False,{'a':1}),('delete',True,None)),[])
+
+	def test_delete_add(self):
+		self.assertEqual(self._compact(('delete',True,None),('add',False,{'a':1})),[(2,'add',{'a':1})])
+
+	def test_delete_add_delete(self):
+		self.assertEqual(self._compact(('delete',True,None),('add',False,{'a':1}),('delete',True,None)),[(3,'delete',None)])
+
+	def test_add_existing_delete(self):
+		# added again while held (e.g. a repeated add), then deleted: the client has to delete it
+		self.assertEqual(self._compact(('add',True,{'a':1}),('delete',True,None)),[(2,'delete',None)])
+
+class SessionSnapshotTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.sessions=[]
+
+	def tearDown(self):
+		for session in self.sessions:
+			session.close()
+		self.server.close()
+
+	def _session(self,**kwargs):
+		session=HTSPSession('127.0.0.1',self.server.port,**kwargs)
+		self.sessions.append(session)
+		session.fetch_initial_data(events=True)
+		return session
+
+	def test_snapshot(self):
+		session=self._session()
+		self.assertFalse(session._state.capturing)
+		snapshot=session.snapshot()
+		self.assertEqual((len(snapshot.tags),len(snapshot.channels),len(snapshot.events)),(2,5,100))
+
+		session._handleMessage({'method':'channelUpdate','channelId':1,'channelName':'Renamed','channelNumber':0})
+		self.assertEqual(snapshot.channels[1].name,'Channel 1')
+		self.assertEqual(session.snapshot().channels[1].name,'Renamed')
+
+		delta=session.changes_since(snapshot.version)
+		self.assertEqual([(change.kind,change.action,change.id,change.fields) for change in delta.changes],
+			[('channel','update',1,{'channelName':'Renamed'})])
+
+	def test_delete_add_delete(self):
+		session=self._session()
+		version=session.snapshot().version
+		channel=dict(self.server.channels[4])
+		for message in ({'method':'channelDelete','channelId':5},channel,{'method':'channelDelete','channelId':5}):
+			session._handleMessage(message)
+		delta=session.changes_since(version)
+		self.assertEqual([(change.kind,change.action,change.id) for change in delta.changes],[('channel','delete',5)])
+		self.assertNotIn(5,session.snapshot().channels)
+
+	def test_update_keeps_view(self):
+		session=self._session(lazy=True)
+		session._handleMessage({'method':'channelUpdate','channelId':1,'channelName':'Renamed'})
+		message=session._get_channel(1)._message
+		self.assertIsInstance(message,htsmsg.HTSMSGView)
+		self.assertEqual((message['channelName'],message['channelNumber']),('Renamed',1))
+
+class ResyncTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data()
+		self.notified=[]
+		self.session._callbacks.append(lambda method,notification:self.notified.append((method,notification.id)))
+
+		# a change the session has seen, so the server's data matches it
+		self.server.channels[0]['channelName']='Renamed'
+		self.session._handleMessage({'method':'channelUpdate','channelId':1,'channelName':'Renamed'})
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _resync(self):
+		version=self.session.snapshot().version
+		self.server.drop()
+		self.session._connection_lost(Exception('Dropped'))
+		self.session._resync()
+		return self.session.changes_since(version)
+
+	def test_unchanged(self):
+		delta=self._resync()
+		self.assertEqual(self.notified,[])
+		self.assertEqual(delta.changes,[])
+
+	def test_changed(self):
+		self.server.dvr_entries[0]['title']='Other'
+		delta=self._resync()
+		self.assertEqual(self.notified,[('dvrEntryUpdate',1)])
+		self.assertEqual([(change.kind,change.action,change.id,change.fields) for change in delta.changes],
+			[('dvrEntry','update',1,{'title':'Other'})])
+
+if __name__=='__main__':
+	unittest.main()
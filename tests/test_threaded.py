@@ -0,0 +1,154 @@
+"""Tests for ThreadedHTSPSession"""
+
+import threading
+import time
+import unittest
+
+from python_htsp.htsp_session import HTSPSession, NotConnectedError
+from python_htsp.htsp_threaded import ThreadedHTSPSession
+from tests.support import FakeServer
+
+def _wait_for(predicate,timeout=10):
+	deadline=time.time()+timeout
+	while not predicate():
+		if time.time()>deadline:
+			raise AssertionError('timed out')
+		time.sleep(0.01)
+
+class ThreadedSessionTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server=FakeServer()
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def _receivers(self):
+		return [thread for thread in threading.enumerate() if thread.name=='htsp-receiver' and thread.is_alive()]
+
+	def test_concurrent_commands(self):
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data(events=True)
+		results=[]
+		def run():
+			for i in range(20):
+				results.append(self.session.diskspace.free_disk_space)
+		threads=[threading.Thread(target=run) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(results,[10]*80)
+
+	def test_autorec_locked(self):
+		# the engine updates its matches as it is queried, so must hold the lock notifications are applied under
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data(events=True)
+		engine=self.session._autorec_engine
+		(flush,owned)=(engine._flush,[])
+		def locked_flush():
+			owned.append(self.session._lock._is_owned())
+			flush()
+		engine._flush=locked_flush
+		self.assertEqual([event.id for event in self.session.autorec_matches('abc')],range(1000,1020))
+		self.assertEqual([entry.id for entry in self.session.event_autorecs(1005)],['abc'])
+		self.assertEqual(self.session.autorec_preview().keys(),['abc'])
+		self.assertEqual(owned,[True]*3)
+
+	def test_not_connected(self):
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data()
+		self.server.drop()
+		_wait_for(lambda:self.session._sock is None)
+		future=self.session.send_command('getSysTime')
+		self.assertTrue(future.done())
+		self.assertRaises(NotConnectedError,future.result)
+		_wait_for(lambda:not self._receivers())
+
+	def test_reconnect_one_receiver(self):
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port,reconnect=True)
+		self.session.fetch_initial_data(events=True)
+		receiver=self.session._thread
+		hellos=lambda:len([message for message in self.server.received if message['method']=='hello'])
+		for i in range(3):
+			self.server.drop()
+			_wait_for(lambda:hellos()==i+2 and self.session._initial_data)
+			self.assertIs(self.session._thread,receiver)
+			self.assertEqual(self._receivers(),[receiver])
+		time.sleep(0.1)
+		self.assertEqual(hellos(),4)
+		self.assertEqual(self.session.diskspace.free_disk_space,10)
+		self.assertEqual(len(self.session.channels),5)
+
+	def test_reconnect_by_hello(self):
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port)
+		self.session.fetch_initial_data()
+		self.server.drop()
+		_wait_for(lambda:self.session._sock is None)
+		_wait_for(lambda:not self._receivers())
+		self.assertEqual(self.session.diskspace.free_disk_space,10)
+		self.assertEqual(len(self._receivers()),1)
+
+class ReauthenticateTest(unittest.TestCase):
+	"""Sessions authenticate again with the challenge of a new connection"""
+
+	def setUp(self):
+		self.server=FakeServer(user='user',password='secret')
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def test_reconnect(self):
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port,reconnect=True)
+		self.session.hello()
+		self.session.authenticate('user','secret')
+		self.session.fetch_initial_data()
+		self.server.drop()
+		_wait_for(lambda:len([message for message in self.server.received if message['method']=='authenticate'])==2 and self.session._initial_data)
+		self.assertEqual(self.session.diskspace.free_disk_space,10)
+		self.assertEqual(self.server.refused,[])
+
+	def test_reconnect_on_demand(self):
+		self.session=HTSPSession('127.0.0.1',self.server.port)
+		self.session.hello()
+		self.session.authenticate('user','secret')
+		self.server.drop()
+		self.assertRaises(Exception,lambda:self.session.diskspace)
+		self.assertEqual(self.session.diskspace.free_disk_space,10)
+		self.assertEqual(self.server.refused,[])
+
+class CallbackThreadTest(unittest.TestCase):
+	"""Callbacks run on the receiver thread only"""
+
+	def setUp(self):
+		self.server=FakeServer()
+		self.session=ThreadedHTSPSession('127.0.0.1',self.server.port)
+
+	def tearDown(self):
+		self.session.close()
+		self.server.close()
+
+	def test_done_future(self):
+		self.session.hello()
+		future=self.session.send_command('getSysTime')
+		future.result()
+		threads=[]
+		future.add_done_callback(lambda future:threads.append(threading.current_thread()))
+		chained=future.then(lambda message:threading.current_thread())
+		self.assertIs(chained.result(),self.session._thread)
+		_wait_for(lambda:threads)
+		self.assertEqual(threads,[self.session._thread])
+
+	def test_notifications(self):
+		threads=[]
+		self.session.monitor(lambda method,notification:threads.append(threading.current_thread()))
+		for i in range(50):
+			self.server.notify({'method':'channelUpdate','channelId':1,'channelName':'Renamed %d'%i})
+			self.session.system_time
+		_wait_for(lambda:len(threads)==50)
+		self.assertEqual(set(threads),set([self.session._thread]))
+
+if __name__=='__main__':
+	unittest.main()